@@ -9,6 +9,27 @@ SET xmloption = content;
 SET client_min_messages = warning;
 SET row_security = off;
 
+--
+-- Name: notify_reply_status(); Type: FUNCTION; Schema: public; Owner: -
+--
+
+CREATE FUNCTION public.notify_reply_status() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    PERFORM pg_notify(
+        'reply_status',
+        json_build_object(
+            'id', NEW.id,
+            'message_id', NEW.message_id,
+            'status', NEW.status
+        )::TEXT
+    );
+    RETURN NEW;
+END;
+$$;
+
+
 SET default_tablespace = '';
 
 SET default_table_access_method = heap;
@@ -26,6 +47,18 @@ CREATE TABLE public.concepts (
 );
 
 
+--
+-- Name: concept_embeddings; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.concept_embeddings (
+    concept_id uuid NOT NULL,
+    "timestamp" timestamp with time zone NOT NULL,
+    model text NOT NULL,
+    embedding bytea NOT NULL
+);
+
+
 --
 -- Name: latest_concepts; Type: VIEW; Schema: public; Owner: -
 --
@@ -73,6 +106,20 @@ CREATE VIEW public.latest_replies AS
   ORDER BY id, "timestamp" DESC;
 
 
+--
+-- Name: reply_jobs; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.reply_jobs (
+    reply_id uuid NOT NULL,
+    message_id uuid NOT NULL,
+    enqueued_at timestamp with time zone NOT NULL,
+    worker_id uuid,
+    leased_until timestamp with time zone,
+    attempts integer DEFAULT 0 NOT NULL
+);
+
+
 --
 -- Name: system_prompts; Type: TABLE; Schema: public; Owner: -
 --
@@ -145,6 +192,36 @@ CREATE TABLE public.schema_migrations (
 );
 
 
+--
+-- Name: socketio_outbox; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.socketio_outbox (
+    id bigint NOT NULL,
+    created_at timestamp with time zone DEFAULT now() NOT NULL,
+    payload text NOT NULL
+);
+
+
+--
+-- Name: socketio_outbox_id_seq; Type: SEQUENCE; Schema: public; Owner: -
+--
+
+CREATE SEQUENCE public.socketio_outbox_id_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+--
+-- Name: socketio_outbox_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: -
+--
+
+ALTER SEQUENCE public.socketio_outbox_id_seq OWNED BY public.socketio_outbox.id;
+
+
 --
 -- Name: users; Type: TABLE; Schema: public; Owner: -
 --
@@ -156,6 +233,35 @@ CREATE TABLE public.users (
 );
 
 
+--
+-- Name: workers; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.workers (
+    id uuid NOT NULL,
+    status text NOT NULL,
+    started_at timestamp with time zone NOT NULL,
+    ready_at timestamp with time zone,
+    heartbeat_at timestamp with time zone NOT NULL,
+    startup jsonb
+);
+
+
+--
+-- Name: socketio_outbox id; Type: DEFAULT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.socketio_outbox ALTER COLUMN id SET DEFAULT nextval('public.socketio_outbox_id_seq'::regclass);
+
+
+--
+-- Name: concept_embeddings concept_embeddings_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.concept_embeddings
+    ADD CONSTRAINT concept_embeddings_pkey PRIMARY KEY (concept_id, "timestamp", model);
+
+
 --
 -- Name: concepts concepts_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
@@ -180,6 +286,14 @@ ALTER TABLE ONLY public.replies
     ADD CONSTRAINT replies_pkey PRIMARY KEY (id, "timestamp");
 
 
+--
+-- Name: reply_jobs reply_jobs_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.reply_jobs
+    ADD CONSTRAINT reply_jobs_pkey PRIMARY KEY (reply_id);
+
+
 --
 -- Name: schema_migrations schema_migrations_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
@@ -188,6 +302,14 @@ ALTER TABLE ONLY public.schema_migrations
     ADD CONSTRAINT schema_migrations_pkey PRIMARY KEY (version);
 
 
+--
+-- Name: socketio_outbox socketio_outbox_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.socketio_outbox
+    ADD CONSTRAINT socketio_outbox_pkey PRIMARY KEY (id);
+
+
 --
 -- Name: system_prompts system_prompts_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
@@ -212,6 +334,35 @@ ALTER TABLE ONLY public.users
     ADD CONSTRAINT users_pkey PRIMARY KEY (id);
 
 
+--
+-- Name: workers workers_pkey; Type: CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.workers
+    ADD CONSTRAINT workers_pkey PRIMARY KEY (id);
+
+
+--
+-- Name: idx_messages_conversation_id_timestamp_id; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX idx_messages_conversation_id_timestamp_id ON public.messages USING btree (conversation_id, "timestamp", id);
+
+
+--
+-- Name: idx_reply_jobs_enqueued_at; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX idx_reply_jobs_enqueued_at ON public.reply_jobs USING btree (enqueued_at);
+
+
+--
+-- Name: idx_socketio_outbox_created_at; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX idx_socketio_outbox_created_at ON public.socketio_outbox USING btree (created_at);
+
+
 --
 -- Name: idx_system_prompts_key; Type: INDEX; Schema: public; Owner: -
 --
@@ -233,6 +384,21 @@ CREATE INDEX idx_user_sessions_id ON public.user_sessions USING btree (id);
 CREATE INDEX idx_user_sessions_user_id ON public.user_sessions USING btree (user_id);
 
 
+--
+-- Name: replies replies_notify_status; Type: TRIGGER; Schema: public; Owner: -
+--
+
+CREATE TRIGGER replies_notify_status AFTER INSERT ON public.replies FOR EACH ROW EXECUTE FUNCTION public.notify_reply_status();
+
+
+--
+-- Name: concept_embeddings concept_embeddings_concept_id_timestamp_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.concept_embeddings
+    ADD CONSTRAINT concept_embeddings_concept_id_timestamp_fkey FOREIGN KEY (concept_id, "timestamp") REFERENCES public.concepts(id, "timestamp");
+
+
 --
 -- Name: messages messages_user_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
@@ -249,6 +415,14 @@ ALTER TABLE ONLY public.replies
     ADD CONSTRAINT replies_message_id_fkey FOREIGN KEY (message_id) REFERENCES public.messages(id);
 
 
+--
+-- Name: reply_jobs reply_jobs_message_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
+--
+
+ALTER TABLE ONLY public.reply_jobs
+    ADD CONSTRAINT reply_jobs_message_id_fkey FOREIGN KEY (message_id) REFERENCES public.messages(id);
+
+
 --
 -- Name: user_sessions user_sessions_user_id_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
@@ -268,4 +442,10 @@ ALTER TABLE ONLY public.user_sessions
 
 INSERT INTO public.schema_migrations (version) VALUES
     ('20250525155138'),
-    ('20250608101345');
+    ('20250608101345'),
+    ('20261018100000'),
+    ('20261018110000'),
+    ('20261018120000'),
+    ('20261018130000'),
+    ('20261018140000'),
+    ('20261018150000');
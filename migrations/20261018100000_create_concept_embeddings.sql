@@ -0,0 +1,12 @@
+-- migrate:up
+CREATE TABLE concept_embeddings (
+    concept_id UUID NOT NULL,
+    timestamp TIMESTAMPTZ NOT NULL,
+    model TEXT NOT NULL,
+    embedding BYTEA NOT NULL,
+    PRIMARY KEY (concept_id, timestamp, model),
+    FOREIGN KEY (concept_id, timestamp) REFERENCES concepts (id, timestamp)
+);
+
+-- migrate:down
+DROP TABLE concept_embeddings;
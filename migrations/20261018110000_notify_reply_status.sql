@@ -0,0 +1,24 @@
+-- migrate:up
+CREATE FUNCTION notify_reply_status() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify(
+        'reply_status',
+        json_build_object(
+            'id', NEW.id,
+            'message_id', NEW.message_id,
+            'status', NEW.status
+        )::TEXT
+    );
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER replies_notify_status
+AFTER INSERT ON replies
+FOR EACH ROW
+EXECUTE FUNCTION notify_reply_status();
+
+-- migrate:down
+DROP TRIGGER replies_notify_status ON replies;
+
+DROP FUNCTION notify_reply_status;
@@ -0,0 +1,27 @@
+-- migrate:up
+CREATE TABLE reply_jobs (
+    reply_id UUID PRIMARY KEY,
+    message_id UUID NOT NULL,
+    enqueued_at TIMESTAMPTZ NOT NULL,
+    worker_id UUID,
+    leased_until TIMESTAMPTZ,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY (message_id) REFERENCES messages (id)
+);
+
+CREATE INDEX idx_reply_jobs_enqueued_at ON reply_jobs (enqueued_at);
+
+-- Replies that are pending at the time of migration become jobs
+INSERT INTO
+    reply_jobs (reply_id, message_id, enqueued_at)
+SELECT
+    id,
+    message_id,
+    timestamp
+FROM
+    latest_replies
+WHERE
+    status = 'pending';
+
+-- migrate:down
+DROP TABLE reply_jobs;
@@ -0,0 +1,12 @@
+-- migrate:up
+CREATE TABLE workers (
+    id UUID PRIMARY KEY,
+    status TEXT NOT NULL,
+    started_at TIMESTAMPTZ NOT NULL,
+    ready_at TIMESTAMPTZ,
+    heartbeat_at TIMESTAMPTZ NOT NULL,
+    startup JSONB
+);
+
+-- migrate:down
+DROP TABLE workers;
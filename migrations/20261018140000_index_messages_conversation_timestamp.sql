@@ -0,0 +1,5 @@
+-- migrate:up transaction:false
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_conversation_id_timestamp_id ON messages (conversation_id, timestamp, id);
+
+-- migrate:down transaction:false
+DROP INDEX CONCURRENTLY IF EXISTS idx_messages_conversation_id_timestamp_id;
@@ -0,0 +1,11 @@
+-- migrate:up
+CREATE TABLE socketio_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    payload TEXT NOT NULL
+);
+
+CREATE INDEX idx_socketio_outbox_created_at ON socketio_outbox (created_at);
+
+-- migrate:down
+DROP TABLE socketio_outbox;
@@ -2,8 +2,8 @@ from flask import Flask, render_template, session, request, Response
 from flask_socketio import SocketIO, join_room, leave_room
 from src.config.config import Config
 import logging
-from src.models import ReplyingTo, SystemPromptKey
-from datetime import datetime, timezone
+from src.models import Message, PresenceDiff, ProcessPresence, ReplyingTo, SystemPromptKey
+from datetime import datetime, timedelta, timezone
 from psycopg_pool import ConnectionPool
 from psycopg import Connection
 from psycopg.rows import TupleRow
@@ -11,19 +11,31 @@ from src.repositories.users import UsersRepository
 from src.repositories.messages import MessagesRepository
 from src.repositories.concepts import ConceptsRepository
 from src.repositories.system_prompts import SystemPromptsRepository
+from src.repositories.notifications import NotificationsRepository
+from src.repositories.workers import WorkersRepository
 from src.services.users import UsersService
 from src.services.messages import MessagesService
 from src.services.concepts import ConceptsService
-from src.models import ReplyStatus
+from src.models import Reply, ReplyStatus, ReplyDelta, ReplyStatusChanged
+from src.notifications import NotificationListener, REPLY_DELTAS_CHANNEL, REPLY_STATUS_CHANNEL
+from src.conversation_state import ConversationState
+from src.message_queue import PostgresManager
+from src.leadership import AdvisoryLock
+from src.presence import PresenceBroadcaster, PresenceRegistry
+from src.metrics import CONTENT_TYPE, REGISTRY, REPLIES, REPLY_JOBS, SOCKETIO_EMITS, collect_pool_stats
 from uuid import UUID
 from functools import wraps
 import re
-from typing import List, Dict, Tuple, Optional, Iterable
+from typing import Any, Callable, List, Dict, Tuple, Optional, Iterable
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 config = Config.new_from_env()
 
+# Streamed chunks are only received by listening for them
+if config.STREAM_REPLIES and not config.WITH_REPLY_LISTENER:
+    raise ValueError("STREAM_REPLIES=true requires WITH_REPLY_LISTENER=true")
+
 pool = ConnectionPool(
     config.DATABASE_URL,
     connection_class=Connection[TupleRow]
@@ -34,6 +46,8 @@ users_repository = UsersRepository(pool)
 messages_repository = MessagesRepository(pool)
 concepts_repository = ConceptsRepository(pool)
 system_prompts_repository = SystemPromptsRepository(pool)
+notifications_repository = NotificationsRepository(pool)
+workers_repository = WorkersRepository(pool)
 
 # Services
 users_service = UsersService(
@@ -42,12 +56,30 @@ users_service = UsersService(
 )
 messages_service = MessagesService(
     config=config,
-    messages_repository=messages_repository
+    messages_repository=messages_repository,
+    notifications_repository=notifications_repository
 )
 concepts_service = ConceptsService(
     config=config,
     concepts_repository=concepts_repository,
-    system_prompts_repository=system_prompts_repository
+    system_prompts_repository=system_prompts_repository,
+    notifications_repository=notifications_repository
+)
+
+# Who is connected, user_sessions are written in batches
+presence_registry = PresenceRegistry(
+    users_repository=users_repository,
+    grace_period=config.PRESENCE_GRACE_PERIOD
+)
+
+# What the chat page shows, kept up to date by the events emitted to the room
+conversation_state = ConversationState(
+    conversation_id=config.CONVERSATION_ID,
+    assistant_user_id=config.ASSISTANT_USER_ID,
+    messages_repository=messages_repository,
+    users_repository=users_repository,
+    presence=presence_registry,
+    max_messages=config.MESSAGES_PAGE_SIZE
 )
 
 app = Flask(
@@ -58,56 +90,254 @@ app = Flask(
 app.config['SECRET_KEY'] = config.SECRET_KEY
 app.config['SESSION_TYPE'] = config.SESSION_TYPE
 
-io = SocketIO(app)
+# Emits of other web processes also update this one's conversation state
+client_manager = None
+if config.WITH_POSTGRES_MESSAGE_QUEUE:
+    client_manager = PostgresManager(
+        database_url=config.DATABASE_URL,
+        notifications_repository=notifications_repository,
+        on_remote_emit=conversation_state.apply
+    )
+
+io = SocketIO(app, client_manager=client_manager)
+
+# Advisory lock key of the reply publisher
+REPLY_PUBLISHER_LOCK = 4_357_212_001
 
 class ReplyWithoutBodyError(Exception):
     pass
 
-# A lightweight polling loop to check on Cheryl
-def poll_for_replies():
+def emit(event: str, data: Any, to: str, ignore_queue: bool = False):
+    SOCKETIO_EMITS.inc(event=event)
+    # ignore_queue is passed through to the server's emit, the signature of
+    # SocketIO.emit does not list it
+    io.emit(event, data, to=to, ignore_queue=ignore_queue)  # type: ignore[call-arg]
+
+def sleep(seconds: float):
+    # SocketIO.sleep accepts fractions of a second, only its default of 0
+    # makes the parameter look like an int
+    io.sleep(seconds)  # type: ignore[arg-type]
+
+def emit_message_created(message: Message):
+    conversation_state.add_message(message)
+    emit(
+        'message_created',
+        message.model_dump(mode='json'),
+        to=str(config.CONVERSATION_ID)
+    )
+
+# Every process tells its own clients about the presence changes it sees
+def emit_presence_diff(room: str, diff: PresenceDiff):
+    emit('presence_diff', diff.model_dump(mode='json'), to=room, ignore_queue=True)
+
+# Presence changes are broadcast once per PRESENCE_TICK
+presence = PresenceBroadcaster(emit_presence_diff)
+
+# No client joins this room, its events are only received by the other
+# web processes
+PRESENCE_ROOM = "presence"
+
+def emit_process_presence(process_presence: ProcessPresence):
+    emit('process_presence', process_presence.model_dump(mode='json'), to=PRESENCE_ROOM)
+
+def emit_replying_to(replying_to: ReplyingTo):
+    conversation_state.set_replying_to(replying_to)
+    emit(
+        'replying_to',
+        replying_to.model_dump(mode='json'),
+        to=str(config.CONVERSATION_ID)
+    )
+
+def publish_reply(reply: Reply):
+    """
+    Turns a ready reply into an assistant message and emits it to the room.
+    The reply is marked as published first, which only succeeds for one
+    process, so that a publisher that lost leadership without noticing does
+    not publish it a second time.
+    """
+    timestamp = datetime.now(timezone.utc)
+    logging.info(f"publish_reply: publishing reply {reply}")
+
+    # Mark the reply as published
+    if not messages_service.mark_reply_as_published(reply=reply, timestamp=timestamp):
+        logging.info(f"publish_reply: reply {reply.id} was already published")
+        return
+
+    # Create a new message
+    message = messages_service.create_assistant_message(
+        content=reply.message or "",
+        timestamp=timestamp,
+    );
+
+    # Emit the message
+    emit_message_created(message)
+
+    # Then tell the user we're ready for new requests, unless other replies
+    # are still on their way
+    if not messages_service.has_replies_in_progress():
+        emit_replying_to(ReplyingTo(user_id=None))
+
+def publish_ready_replies():
     while True:
-        timestamp = datetime.now(timezone.utc)
         reply = messages_service.get_next_reply_to_publish()
 
-        # If there are replies waiting to publish
-        if reply and reply.message:
-            logging.info(f"poll_for_replies: publishing reply {reply}")
-
-            # Create a new message
-            message = messages_service.create_assistant_message(
-                content=reply.message,
-                timestamp=timestamp,
-            );
-
-            # Emit the message
-            io.emit(
-                'message_created',
-                message.model_dump(mode='json'),
-                to=str(config.CONVERSATION_ID)
-            )
-
-            # Mark the reply as published
-            messages_service.mark_reply_as_published(
-                reply=reply,
-                timestamp=timestamp
-            )
-
-            # Then tell the user we're ready for new requests
-            io.emit(
-                'replying_to',
-                ReplyingTo(user_id=None).model_dump(mode='json'),
-                to=str(config.CONVERSATION_ID)
-            )
-
-        io.sleep(2)
+        # If there are no replies waiting to publish
+        if not reply or not reply.message:
+            return
+
+        publish_reply(reply)
+
+# A lightweight polling loop to check on Cheryl
+def poll_for_replies(is_leader: Callable[[], bool]):
+    while is_leader():
+        publish_ready_replies()
+        sleep(config.REPLY_POLLING_INTERVAL)
+
+# Publishes replies as soon as Cheryl marks them as ready, and forwards chunks
+# of replies that are still being generated. Polls as a fallback whenever
+# nothing has been heard for REPLY_POLL_INTERVAL seconds.
+def listen_for_replies(is_leader: Callable[[], bool]):
+    channels = [REPLY_STATUS_CHANNEL]
+    if config.STREAM_REPLIES:
+        channels.append(REPLY_DELTAS_CHANNEL)
+    listener = NotificationListener(config.DATABASE_URL, channels)
+    try:
+        forward_replies(listener, is_leader)
+    finally:
+        listener.close()
+
+def forward_replies(listener: NotificationListener, is_leader: Callable[[], bool]):
+    # Start listening before the first check so that no reply is missed
+    listener.wait(timeout=0)
+    publish_ready_replies()
+
+    while is_leader():
+        notifications = listener.wait(timeout=config.REPLY_POLL_INTERVAL)
+        should_publish = not notifications
+
+        for notification in notifications:
+            if notification.channel == REPLY_DELTAS_CHANNEL:
+                delta = ReplyDelta.model_validate_json(notification.payload)
+                emit(
+                    'message_delta',
+                    delta.model_dump(mode='json'),
+                    to=str(config.CONVERSATION_ID)
+                )
+                continue
+
+            changed = ReplyStatusChanged.model_validate_json(notification.payload)
+            if changed.status == ReplyStatus.READY:
+                should_publish = True
+            elif changed.status == ReplyStatus.FAILED:
+                # Cheryl gave up, tell the user we're ready for new requests
+                if not messages_service.has_replies_in_progress():
+                    emit_replying_to(ReplyingTo(user_id=None))
+
+        if should_publish:
+            publish_ready_replies()
+
+# Reloads the conversation state every now and then, correcting drift from
+# changes this process did not see, e.g. replies failing while polling
+def refresh_conversation_state():
+    while True:
+        try:
+            conversation_state.prime()
+        except Exception as e:
+            logging.error(f"refresh_conversation_state: could not load the conversation state: {e}")
+        if config.CONVERSATION_STATE_REFRESH <= 0:
+            return
+        sleep(config.CONVERSATION_STATE_REFRESH)
+
+# Broadcasts, announces and writes the presence changes of every tick.
+# Sessions that were connected before the process started are recovered first.
+def maintain_presence():
+    recovered = False
+    while True:
+        if not recovered:
+            try:
+                presence_registry.recover()
+                recovered = True
+            except Exception as e:
+                logging.error(f"maintain_presence: could not recover the connected sessions: {e}")
+
+        sleep(config.PRESENCE_TICK)
+
+        try:
+            presence_registry.expire()
+            joined, left = presence_registry.changes()
+            for user in joined:
+                presence.joined(str(config.CONVERSATION_ID), user)
+            for user_id in left:
+                presence.left(str(config.CONVERSATION_ID), user_id)
+            presence.flush()
+
+            announcement = presence_registry.announcement()
+            if announcement:
+                emit_process_presence(announcement)
+
+            presence_registry.flush()
+        except Exception as e:
+            logging.error(f"maintain_presence: {e}")
+
+# Only one web process publishes replies, the one holding the advisory lock.
+# The others take over when it goes away.
+def publish_replies_while_leader():
+    lock = AdvisoryLock(config.DATABASE_URL, REPLY_PUBLISHER_LOCK)
+    while True:
+        if lock.try_acquire():
+            logging.info("publish_replies_while_leader: this process publishes replies")
+            try:
+                if config.WITH_REPLY_LISTENER:
+                    listen_for_replies(lock.is_held)
+                else:
+                    poll_for_replies(lock.is_held)
+            except Exception as e:
+                logging.error(f"publish_replies_while_leader: stopped publishing replies: {e}")
+            finally:
+                lock.release()
+        sleep(config.REPLY_PUBLISHER_RETRY_INTERVAL)
 
 # Start the loop
-io.start_background_task(target=poll_for_replies)
+io.start_background_task(target=refresh_conversation_state)
+io.start_background_task(target=publish_replies_while_leader)
+io.start_background_task(target=maintain_presence)
 
 @app.route('/')
 def about():
     return render_template('about.html')
 
+def collect_reply_counts():
+    # Statuses without replies are reported as 0 rather than keeping their last count
+    counts = messages_repository.count_replies_by_status()
+    for status in ReplyStatus:
+        REPLIES.set(counts.get(status, 0), status=status.value)
+    REPLY_JOBS.set(messages_repository.count_reply_jobs())
+
+REGISTRY.add_collector(collect_pool_stats(pool))
+REGISTRY.add_collector(collect_reply_counts)
+
+@app.route('/health')
+def health():
+    """
+    Reports whether any worker is ready to reply. Workers heartbeat every
+    WORKER_POLL_INTERVAL from a background thread, also while generating,
+    so those that have been silent for several intervals are considered gone.
+    """
+    since = datetime.now(timezone.utc) - timedelta(seconds=3 * config.WORKER_POLL_INTERVAL)
+    workers = workers_repository.get_ready_workers(since)
+
+    return {
+        'ready': len(workers) > 0,
+        'workers': [
+            {
+                'id': str(w.id),
+                'ready_at': w.ready_at.isoformat() if w.ready_at else None,
+                'startup': w.startup,
+            }
+            for w in workers
+        ],
+    }, 200 if workers else 503
+
 def check_auth(username, password):
     return username == config.ADMIN_USERNAME and password == config.ADMIN_PASSWORD
 
@@ -126,6 +356,11 @@ def requires_auth(f):
         return f(*args, **kwargs)
     return decorated
 
+@app.route('/metrics')
+@requires_auth
+def metrics():
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
 CONCEPT_KEY_PATTERN = re.compile(r"concept\(([\w-]+)\)-(\w+)")
 PROMPT_KEYS = [spk.value for spk in SystemPromptKey]
 
@@ -246,11 +481,7 @@ def message():
     )
 
     # Emit it to the room
-    io.emit(
-        'message_created',
-        message.model_dump(mode='json'),
-        to=str(config.CONVERSATION_ID)
-    )
+    emit_message_created(message)
 
     # Check if there are any replies in progress
     reply = messages_service.enqueue_if_available(
@@ -261,42 +492,60 @@ def message():
         logging.info(f"message.post: busy, ignoring message {message.id}")
         return "", 204
 
-    io.emit(
-        'replying_to',
-        ReplyingTo(user_id=message.user_id).model_dump(mode='json'),
-        to=str(config.CONVERSATION_ID)
-    )
+    emit_replying_to(ReplyingTo(user_id=message.user_id))
 
     return "", 204
 
+def parse_message_cursor(value: str | None) -> Optional[UUID]:
+    if not value:
+        return None
+    return UUID(value)
+
+@app.route('/messages', methods=["GET"])
+def messages():
+    """
+    Pages through the history of the conversation. `before` and `after` are
+    ids of messages, the page holds the messages right before or after it,
+    oldest first.
+    """
+    try:
+        before = parse_message_cursor(request.args.get('before'))
+        after = parse_message_cursor(request.args.get('after'))
+        limit = int(request.args.get('limit', config.MESSAGES_PAGE_SIZE))
+    except ValueError as e:
+        logging.error(f"messages.get: invalid query {request.args}: {e}")
+        return "", 400
+
+    if before and after:
+        logging.error("messages.get: expected at most one of before and after")
+        return "", 400
+    limit = max(1, min(limit, config.MESSAGES_PAGE_SIZE))
+
+    # One more than asked for tells whether there is more to load
+    page = messages_repository.get_messages(
+        conversation_id=config.CONVERSATION_ID,
+        before=before,
+        after=after,
+        limit=limit + 1
+    )
+    has_more = len(page) > limit
+    if has_more:
+        page = page[:limit] if after else page[1:]
+
+    return {
+        'messages': [m.model_dump(mode='json') for m in page],
+        'has_more': has_more,
+    }
+
 @app.route('/chat-with-cheryl')
 def chat():
     """Serves the main HTML page."""
-    messages = messages_repository.get_messages(
-        conversation_id=config.CONVERSATION_ID,
-        timestamp=None,
-        limit=100
-    )
-    user_ids_of_conversation = messages_repository.get_user_ids_of_conversation(conversation_id=config.CONVERSATION_ID)
-    user_ids = users_repository.get_connected_user_ids()
-    user_ids_of_conversation.append(config.ASSISTANT_USER_ID)
-    users = users_repository.get_users_by_id(user_ids_of_conversation)
-
-    replies_in_progress = messages_repository.get_replies(
-        status=[ReplyStatus.PENDING],
-        message_id=None,
-        limit=1
-    );
-    replying_to: ReplyingTo | None = None
-    if replies_in_progress:
-        reply_in_progress = replies_in_progress[0]
-        message = messages_repository.get_message(message_id=reply_in_progress.message_id)
-        replying_to = ReplyingTo(user_id=message.user_id)
+    snapshot = conversation_state.snapshot()
 
-    initial_messages = [msg.model_dump(mode='json') for msg in messages]
-    initial_connected_user_ids = [str(id) for id in user_ids]
-    initial_users_of_conversation = [u.model_dump(mode='json') for u in users]
-    initial_replying_to = replying_to.model_dump(mode='json') if replying_to else None
+    initial_messages = [msg.model_dump(mode='json') for msg in snapshot.messages]
+    initial_connected_user_ids = [str(id) for id in snapshot.connected_user_ids]
+    initial_users_of_conversation = [u.model_dump(mode='json') for u in snapshot.users_of_conversation]
+    initial_replying_to = snapshot.replying_to.model_dump(mode='json') if snapshot.replying_to else None
 
     return render_template(
         'chat.html',
@@ -304,7 +553,9 @@ def chat():
         initial_connected_user_ids=initial_connected_user_ids,
         initial_users_of_conversation=initial_users_of_conversation,
         initial_replying_to=initial_replying_to,
-        assistant_user_id=config.ASSISTANT_USER_ID
+        assistant_user_id=config.ASSISTANT_USER_ID,
+        messages_page_size=config.MESSAGES_PAGE_SIZE,
+        websocket_only=config.WITH_POSTGRES_MESSAGE_QUEUE
     )
 
 
@@ -323,39 +574,32 @@ def on_connect():
         return
     user_id = UUID(user_id)
 
-    user = users_service.create_user(
-        user_id=user_id,
-        timestamp=timestamp,
-        name=None
-    )
-
-    sess = users_service.register_user_connection(
-        user_id=user_id,
-        timestamp=timestamp
-    )
+    # Only users that are new to this process are looked up
+    user = presence_registry.get_user(user_id)
+    if user is None:
+        user = users_service.create_user(
+            user_id=user_id,
+            timestamp=timestamp,
+            name=None
+        )
 
-    session['sid'] = sess.id
+    session['user_id'] = user_id
 
     join_room(str(config.CONVERSATION_ID))
 
-    io.emit(
-        "user_connected",
-        user.model_dump(mode='json'),
-        to=str(config.CONVERSATION_ID)
-    )
+    # The session is written and the change broadcast with the next tick
+    presence_registry.connect(user)
 
 @io.on('disconnect')
 def on_disconnect():
     """Handles WebSocket disconnections."""
     timestamp = datetime.now(timezone.utc)
-    sid = session['sid']
+    user_id = session.get('user_id')
 
-    logging.info(f"on_disconnect: user disconnected {timestamp}, sid: {sid}")
+    logging.info(f"on_disconnect: user disconnected {timestamp}, user_id: {user_id}")
 
-    users_service.register_user_disconnection(
-        sid=sid,
-        timestamp=timestamp
-    )
+    if user_id:
+        presence_registry.disconnect(user_id)
 
     leave_room(str(config.CONVERSATION_ID))
 
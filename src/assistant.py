@@ -0,0 +1,935 @@
+import abc
+import copy
+import logging
+import math
+from threading import Thread
+from time import monotonic
+from typing import Any, Callable, Hashable, List, Tuple
+import numpy as np
+from src.embeddings import ConceptEmbeddingsSource, ConceptEmbeddingStore, ConceptsSource
+from src.encoders import AbstractEncoder
+from src.lexical import LexicalConceptMatcher
+from src.models import ChatTemplate, ChatTemplateRecord, Concept, GenerationLimits, GenerationStats, Message, Role, SystemPrompt, SystemPromptKey
+from src.notifications import CONCEPTS_CHANNEL, SYSTEM_PROMPTS_CHANNEL
+from src.precision import Precision, quantize_if_int8, torch_dtype
+from src.prompt_budget import TokenBudget, TokenCounter
+from src.prompts import SystemPromptsCache
+from src.reply_cache import SemanticReplyCache
+from src.retrieval import ConceptRetriever
+
+# torch and transformers are slow to import and only needed when running
+# the real assistant, so they are imported where used.
+
+class PreparedPrompt:
+    """
+    A message made ready for generation: contextualized, rendered with the
+    chat template and tokenized. The prefix is the part of the prompt whose
+    prefill is cached, it is prefilled when generating.
+    """
+    message: str
+    history: List[Message] | None
+    input: Any
+    prefix: str | None
+    cached_reply: str | None
+    cache_key: Tuple[np.ndarray, Hashable] | None
+
+    def __init__(
+        self, *,
+        message: str,
+        history: List[Message] | None = None,
+        input: Any = None,
+        prefix: str | None = None,
+        cached_reply: str | None = None,
+        cache_key: Tuple[np.ndarray, Hashable] | None = None
+    ):
+        self.message = message
+        self.history = history
+        self.input = input
+        self.prefix = prefix
+        self.cached_reply = cached_reply
+        self.cache_key = cache_key
+
+class AbstractAssistant(abc.ABC):
+    # Measurements of the last generation, if the assistant takes them
+    last_stats: GenerationStats | None = None
+
+    @abc.abstractmethod
+    def formulate(
+        self,
+        message: str,
+        on_delta: Callable[[str], None] | None = None,
+        history: List[Message] | None = None
+    ) -> str:
+        """
+        Formulates a reply to the message. If `on_delta` is given it is called
+        with chunks of the reply as they are generated. `history` holds the
+        preceding messages of the conversation, newest first.
+        """
+        pass
+
+    def formulate_batch(
+        self,
+        messages: List[str],
+        histories: List[List[Message]] | None = None,
+        limits: GenerationLimits | None = None
+    ) -> List[str]:
+        """
+        Formulates replies to several messages, in order. Assistants that can
+        generate for several inputs at once should override this.
+        """
+        histories = histories or [[] for _ in messages]
+        return [self.formulate(m, history=h) for m, h in zip(messages, histories)]
+
+    def prepare(self, message: str, history: List[Message] | None = None) -> PreparedPrompt:
+        """
+        Does all the work of formulating a reply that comes before generation.
+        May run on another thread while `generate` runs.
+        """
+        return PreparedPrompt(message=message, history=history)
+
+    def generate(
+        self,
+        prepared: PreparedPrompt,
+        on_delta: Callable[[str], None] | None = None,
+        limits: GenerationLimits | None = None
+    ) -> str:
+        """
+        Generates the reply to a prepared prompt, see `formulate`. `limits`
+        overrides the default length of the reply.
+        """
+        return self.formulate(prepared.message, on_delta, prepared.history)
+
+    def warmup(self) -> None:
+        """
+        Runs a throwaway generation so the first real reply does not pay for
+        lazy initialization.
+        """
+        pass
+
+    def invalidate_cache(self, channel: str | None) -> None:
+        """
+        Drops cached state that a notification on the channel announced a
+        change of. None means notifications may have been missed.
+        """
+        pass
+
+class AbstractContextualizer(abc.ABC):
+    @abc.abstractmethod
+    def get_contextualized_system_prompt(self, message: str, budget: TokenBudget | None = None) -> str:
+        """
+        The system prompt for a reply to the message. With a budget, optional
+        parts are only included as far as they fit and their tokens are taken
+        from it.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_base_prompt(self) -> SystemPrompt | None:
+        """
+        The static part of the system prompt that every contextualized system
+        prompt starts with, if any.
+        """
+        pass
+
+    def invalidate_cache(self, channel: str | None) -> None:
+        """See AbstractAssistant.invalidate_cache"""
+        pass
+
+    def get_reply_cache_key(self, message: str) -> Tuple[np.ndarray, Hashable] | None:
+        """
+        The normalized embedding of the message and the version of everything
+        the contextualized system prompt depends on, if supported.
+        """
+        return None
+
+class MockedAssistant(AbstractAssistant):
+    def formulate(
+        self,
+        message: str,
+        on_delta: Callable[[str], None] | None = None,
+        history: List[Message] | None = None
+    ) -> str:
+        if on_delta:
+            on_delta("mocked")
+        return "mocked"
+
+class Contextualizer(AbstractContextualizer):
+    concepts_repository: ConceptsSource
+    system_prompts: SystemPromptsCache
+    encoder: AbstractEncoder
+    embeddings: ConceptEmbeddingStore
+    retriever: ConceptRetriever
+    lexical: LexicalConceptMatcher | None
+    lexical_boost: float
+    last_message: Tuple[str, np.ndarray] | None
+
+    def __init__(
+        self, *,
+        concepts_repository: ConceptsSource,
+        concept_embeddings_repository: ConceptEmbeddingsSource,
+        system_prompts: SystemPromptsCache,
+        retriever: ConceptRetriever,
+        encoder: AbstractEncoder,
+        with_lexical_matching: bool = False,
+        lexical_boost: float = 0.2,
+    ):
+        self.encoder = encoder
+        self.concepts_repository = concepts_repository
+        self.system_prompts = system_prompts
+
+        self.embeddings = ConceptEmbeddingStore(
+            model_name=encoder.name,
+            encode=self.encode,
+            concepts_repository=concepts_repository,
+            concept_embeddings_repository=concept_embeddings_repository,
+        )
+        self.retriever = retriever
+        self.lexical = LexicalConceptMatcher() if with_lexical_matching else None
+        self.lexical_boost = lexical_boost
+        self.last_message = None
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        return self.encoder.encode(texts)
+
+    def encode_message(self, message: str) -> np.ndarray:
+        """
+        Encodes a single message. The last one is remembered, as both the
+        reply cache and retrieval need it.
+        """
+        if self.last_message is None or self.last_message[0] != message:
+            self.last_message = (message, self.encode([message])[0])
+        return self.last_message[1]
+
+    def get_reply_cache_key(self, message: str) -> Tuple[np.ndarray, Hashable] | None:
+        # Brings both versions up to date first
+        self.embeddings.refresh()
+        self.system_prompts.get(SystemPromptKey.BASE)
+        version = (self.system_prompts.version, self.embeddings.version)
+        return self.encode_message(message), version
+
+    def get_related_concepts(self, message: str, n: int) -> list[Concept]:
+        self.embeddings.refresh()
+        concepts = self.embeddings.concepts
+
+        if not concepts:
+            return []
+
+        hits: List[int] = []
+        if self.lexical is not None:
+            self.lexical.update(concepts)
+            hits = self.lexical.match(message)
+
+        if len(hits) >= n:
+            # Mentioned concepts fill the top n, the message need not be embedded
+            logging.info(f"Most relevant concepts (top {n}, mentioned): {[concepts[i].concept for i in hits[:n]]}")
+            return [concepts[i] for i in hits[:n]]
+
+        self.retriever.build(self.embeddings.matrix)
+
+        input = self.encode_message(message)
+        indices, scores = self.retriever.search(input, n)
+
+        # Mentioned concepts are ranked by their embedding score plus a boost
+        ranked = {int(i): float(score) for i, score in zip(indices, scores)}
+        if hits:
+            hit_scores = self.embeddings.matrix[hits] @ input
+            for i, score in zip(hits, hit_scores):
+                ranked[i] = float(score) + self.lexical_boost
+        top = sorted(ranked.items(), key=lambda item: item[1], reverse=True)[:n]
+
+        concepts_to_use = []
+        scores_to_log = []
+        for i, score in top:
+            concepts_to_use.append(concepts[i])
+            scores_to_log.append({'concept': concepts[i].concept, 'score': score, 'mentioned': i in hits})
+
+        logging.info(f"Most relevant concepts (top {n}): {scores_to_log}")
+        return concepts_to_use
+
+    CONCEPTS_HEADER = "\nREFERENCE CONCEPTS FOR CHERYL'S VOCABULARY:\n"
+    CONCEPTS_FOOTER = "\nEND OF REFERENCE CONCEPTS.\n"
+
+    @staticmethod
+    def template_concept(concept: Concept) -> str:
+        return f"Concept: {concept.concept}\nMeaning: {concept.meaning}\n\n"
+
+    @staticmethod
+    def template_concepts(concepts: List[Concept]) -> str:
+        buf = Contextualizer.CONCEPTS_HEADER
+        for c in concepts:
+            buf += Contextualizer.template_concept(c)
+        buf += Contextualizer.CONCEPTS_FOOTER
+        return buf
+
+    @staticmethod
+    def select_concepts(concepts: List[Concept], overhead: str, budget: TokenBudget) -> List[Concept]:
+        """
+        The concepts, best first, that fit in the budget along with the text
+        that introduces them. A concept that does not fit is skipped in favour
+        of shorter ones further down.
+        """
+        if not budget.take(overhead):
+            return []
+
+        selected = [
+            c for c in concepts
+            if budget.take(Contextualizer.template_concept(c), key=(c.id, c.timestamp))
+        ]
+        if not selected:
+            budget.give_back(overhead)
+        elif len(selected) < len(concepts):
+            logging.info(f"Contextualizer.select_concepts: {len(selected)} of {len(concepts)} concepts fit the token budget")
+        return selected
+
+    def invalidate_cache(self, channel: str | None) -> None:
+        if channel in (SYSTEM_PROMPTS_CHANNEL, None):
+            self.system_prompts.invalidate()
+        if channel in (CONCEPTS_CHANNEL, None):
+            self.embeddings.invalidate()
+
+    def get_base_prompt(self) -> SystemPrompt | None:
+        return self.system_prompts.get(SystemPromptKey.BASE)
+
+    def get_contextualized_system_prompt(self, message: str, budget: TokenBudget | None = None) -> str:
+        """
+        Retrieves related concepts and formats them into a prompt string.
+        """
+        parts = []
+
+        base = self.get_base_prompt()
+        if base and base.prompt:
+            parts.append(base.prompt)
+            if budget is not None:
+                budget.spend(base.prompt)
+
+        concepts = self.get_related_concepts(message, 5)
+        related_concepts = self.system_prompts.get(SystemPromptKey.RELATED_CONCEPTS)
+        related_concepts_prompt = related_concepts.prompt if related_concepts else ""
+
+        if concepts and budget is not None:
+            overhead = related_concepts_prompt + Contextualizer.CONCEPTS_HEADER + Contextualizer.CONCEPTS_FOOTER
+            concepts = Contextualizer.select_concepts(concepts, overhead, budget)
+
+        if concepts and related_concepts_prompt:
+            parts.append(related_concepts_prompt)
+
+        if concepts:
+            parts.append(Contextualizer.template_concepts(concepts))
+
+        prompt = "\n".join(parts).strip()
+
+        return prompt
+
+class PrefixCache:
+    """
+    The key/value cache of a static prompt prefix, so that its prefill only
+    has to be computed once rather than for every generation.
+    """
+    prefix: str | None
+    input_ids: Any
+    past_key_values: Any
+
+    def __init__(self):
+        self.prefix = None
+        self.input_ids = None
+        self.past_key_values = None
+
+    def update(self, *, prefix: str, tokenizer: Any, model: Any, device: str) -> None:
+        if prefix == self.prefix:
+            return
+
+        import torch
+
+        started_at = monotonic()
+        input_ids = tokenizer(prefix, return_tensors="pt").input_ids.to(device)
+        with torch.no_grad():
+            output = model(input_ids, use_cache=True)
+
+        self.prefix = prefix
+        self.input_ids = input_ids
+        self.past_key_values = output.past_key_values
+        logging.info(f"PrefixCache.update: prefilled {input_ids.shape[1]} prefix tokens in {monotonic() - started_at:.3f}s")
+
+WARMUP_MESSAGE = "Hello Cheryl!"
+
+class ForwardCounter:
+    """
+    Counts forward passes of a model while active, used to estimate how many
+    draft tokens the main model accepted during assisted generation.
+    """
+    model: Any
+    calls: int
+    handle: Any
+
+    def __init__(self, model: Any):
+        self.model = model
+        self.calls = 0
+        self.handle = None
+
+    def __enter__(self):
+        def count(*_):
+            self.calls += 1
+        self.handle = self.model.register_forward_hook(count)
+        return self
+
+    def __exit__(self, *args):
+        if self.handle:
+            self.handle.remove()
+
+class Assistant(AbstractAssistant):
+    """
+    Prompts may be prepared on another thread than the one generating. Fast
+    tokenizers must not be used from two threads at once, so preparing uses
+    a copy of the tokenizer, and the model is only run by `generate`.
+    """
+    contextualizer: AbstractContextualizer
+    tokenizer: Any
+    prepare_tokenizer: Any
+    model: Any
+    draft_model: Any
+    device: str
+    prefix_cache: PrefixCache | None
+    reply_cache: SemanticReplyCache | None
+    token_counter: TokenCounter
+    prompt_token_budget: int | None
+    template_overhead: tuple[int, int] | None
+    max_new_tokens: int
+
+    def __init__(
+        self,
+        tokenizer: Any,
+        model: Any,
+        contextualizer: AbstractContextualizer,
+        with_prefix_cache: bool = False,
+        draft_model: Any = None,
+        device: str = "cpu",
+        reply_cache: SemanticReplyCache | None = None,
+        prompt_token_budget: int | None = None,
+        max_new_tokens: int = 250
+    ):
+        self.contextualizer = contextualizer
+        self.tokenizer = tokenizer
+        self.prepare_tokenizer = copy.deepcopy(tokenizer)
+        self.model = model
+        self.device = device
+        self.reply_cache = reply_cache
+        self.token_counter = TokenCounter(self.prepare_tokenizer)
+        self.prompt_token_budget = prompt_token_budget
+        self.template_overhead = None
+        self.max_new_tokens = max_new_tokens
+        self.draft_model = draft_model
+        self.last_stats = None
+
+        if with_prefix_cache and draft_model is not None:
+            # The draft model would have to be prefilled with the same prefix
+            logging.info("Assistant: prefix cache is disabled during assisted generation")
+            with_prefix_cache = False
+        self.prefix_cache = PrefixCache() if with_prefix_cache else None
+
+    def build_prompt(self, message: str, history: List[Message] | None = None) -> str:
+        """
+        Contextualizes the message and renders it with the chat template,
+        preceded by as much of the conversation history as fits. With a token
+        budget the base prompt and the message are always included, then
+        related concepts and history as far as they fit.
+        """
+        budget: TokenBudget | None = None
+        if self.prompt_token_budget is not None:
+            fixed, _ = self.get_template_overhead()
+            budget = TokenBudget(self.token_counter, self.prompt_token_budget - fixed)
+            budget.spend(message)
+
+        system_prompt = self.contextualizer.get_contextualized_system_prompt(message, budget)
+        logging.info(f"Using prompt\n\n{system_prompt}")
+
+        turns = self.select_history(history or [], budget)
+        if budget is not None:
+            logging.info(f"Assistant.build_prompt: {len(turns)} of {len(history or [])} history messages fit, {budget.used} of {budget.total} budgeted tokens used")
+
+        templated = Assistant.template_one_off(
+            user=message,
+            system=system_prompt,
+            history=turns
+        ).model_dump(mode='json')
+
+        logging.info(f"Generating with template:\n{templated}")
+        prompt: str = self.prepare_tokenizer.apply_chat_template(
+            templated,
+            tokenize=False,
+            add_generation_prompt=True,
+            enable_thinking=False,
+        )
+        return prompt
+
+    def select_history(self, history: List[Message], budget: TokenBudget | None) -> List[ChatTemplateRecord]:
+        """
+        The most recent messages of the history that fit, in chronological
+        order. Stops at the first message that does not fit, so the history
+        has no gaps.
+        """
+        _, per_turn = self.get_template_overhead() if budget is not None else (0, 0)
+
+        turns: List[ChatTemplateRecord] = []
+        for m in history:
+            if not m.message:
+                continue
+            if budget is not None and not budget.take(m.message, key=m.id, extra=per_turn):
+                break
+            turns.append(ChatTemplateRecord(role=Role(m.role), content=m.message))
+
+        turns.reverse()
+        return turns
+
+    def get_template_overhead(self) -> tuple[int, int]:
+        """
+        The number of tokens the chat template adds to a prompt with a system
+        prompt and a user message, and to each additional turn
+        """
+        if self.template_overhead is None:
+            def count(template: ChatTemplate) -> int:
+                return len(self.prepare_tokenizer.apply_chat_template(
+                    template.model_dump(mode='json'),
+                    tokenize=True,
+                    add_generation_prompt=True,
+                    enable_thinking=False,
+                ))
+
+            one_off = count(Assistant.template_one_off(user="", system=""))
+            with_history = count(Assistant.template_one_off(user="", system="", history=[
+                ChatTemplateRecord(role=Role.USER, content=""),
+                ChatTemplateRecord(role=Role.ASSISTANT, content=""),
+            ]))
+            self.template_overhead = (one_off, math.ceil((with_history - one_off) / 2))
+
+        return self.template_overhead
+
+    def invalidate_cache(self, channel: str | None) -> None:
+        self.contextualizer.invalidate_cache(channel)
+
+    def warmup(self) -> None:
+        import torch
+
+        # Goes through contextualization too, which warms the embedding model
+        # and the prefix cache
+        prompt = self.build_prompt(WARMUP_MESSAGE)
+        input, prefix = self.encode_with_prefix_cache(prompt)
+        past_key_values = self.prefill(prefix)
+
+        with torch.no_grad():
+            self.model.generate(
+                input,
+                past_key_values=past_key_values,
+                max_new_tokens=1,
+                do_sample=False,
+                eos_token_id=self.tokenizer.eos_token_id,
+            )
+
+    def generate_kwargs(self, limits: GenerationLimits | None = None, prompt_length: int = 0) -> dict[str, Any]:
+        limits = limits or GenerationLimits(max_new_tokens=self.max_new_tokens, stop_at_sentence_after=None)
+        kwargs: dict[str, Any] = dict(
+            max_new_tokens=limits.max_new_tokens,
+            temperature=0.55,
+            top_p=0.95,
+            top_k=50,
+            do_sample=True,
+            repetition_penalty=1.3,
+            eos_token_id=self.tokenizer.eos_token_id,
+        )
+        if limits.stop_at_sentence_after is not None:
+            kwargs["stopping_criteria"] = sentence_boundary_criteria(
+                self.tokenizer,
+                prompt_length,
+                limits.stop_at_sentence_after
+            )
+        return kwargs
+
+    def encode_with_prefix_cache(self, prompt: str) -> tuple[Any, str | None]:
+        """
+        Tokenizes the prompt. When the prompt starts with the base system
+        prompt, that prefix is tokenized separately so that its tokens are
+        exactly the ones the prefix cache is computed for. Returns the input
+        ids and the prefix to prefill, if any.
+        """
+        import torch
+
+        base = self.contextualizer.get_base_prompt()
+        base_text = base.prompt.strip() if base else ""
+        index = prompt.find(base_text) if base_text else -1
+
+        if self.prefix_cache is None or index < 0:
+            input = self.prepare_tokenizer.encode(
+                prompt,
+                return_tensors="pt",
+                padding=True,
+            ).to(self.device)
+            return input, None
+
+        end = index + len(base_text)
+        prefix_ids = self.prepare_tokenizer(
+            prompt[:end],
+            return_tensors="pt"
+        ).input_ids.to(self.device)
+        suffix_ids = self.prepare_tokenizer(
+            prompt[end:],
+            return_tensors="pt",
+            add_special_tokens=False
+        ).input_ids.to(self.device)
+        input = torch.cat([prefix_ids, suffix_ids], dim=1)
+
+        logging.info(f"Assistant.encode_with_prefix_cache: {prefix_ids.shape[1]} of {input.shape[1]} prompt tokens are the cached prefix")
+        return input, prompt[:end]
+
+    def prefill(self, prefix: str | None) -> Any:
+        """
+        The past key values of the prefix to generate with, computing them
+        if the prefix changed. Runs the model, so it is called by the
+        generating thread.
+        """
+        if self.prefix_cache is None or prefix is None:
+            return None
+
+        self.prefix_cache.update(
+            prefix=prefix,
+            tokenizer=self.tokenizer,
+            model=self.model,
+            device=self.device
+        )
+
+        # Generation appends to the cache, so it gets a copy of its own
+        return copy.deepcopy(self.prefix_cache.past_key_values)
+
+    def lookup_reply(self, message: str, history: List[Message] | None = None) -> tuple[str | None, Tuple[np.ndarray, Hashable] | None]:
+        """
+        A cached reply to a similar message, or the key to cache the generated
+        reply under. Replies are keyed by the message alone, so messages with
+        a history to reply in are neither looked up nor cached.
+        """
+        if self.reply_cache is None:
+            return None, None
+
+        if any(m.message for m in history or []):
+            return None, None
+
+        key = self.contextualizer.get_reply_cache_key(message)
+        if key is None:
+            return None, None
+
+        return self.reply_cache.lookup(*key), key
+
+    def prepare(self, message: str, history: List[Message] | None = None) -> PreparedPrompt:
+        cached_reply, cache_key = self.lookup_reply(message, history)
+        if cached_reply is not None:
+            return PreparedPrompt(message=message, history=history, cached_reply=cached_reply)
+
+        prompt = self.build_prompt(message, history)
+        input, prefix = self.encode_with_prefix_cache(prompt)
+        logging.info(f"Assistant.prepare: prefill length {input.shape[1]} tokens (budget {self.prompt_token_budget})")
+        return PreparedPrompt(
+            message=message,
+            history=history,
+            input=input,
+            prefix=prefix,
+            cache_key=cache_key
+        )
+
+    def formulate(
+        self,
+        message: str,
+        on_delta: Callable[[str], None] | None = None,
+        history: List[Message] | None = None
+    ) -> str:
+        return self.generate(self.prepare(message, history), on_delta)
+
+    def generate(
+        self,
+        prepared: PreparedPrompt,
+        on_delta: Callable[[str], None] | None = None,
+        limits: GenerationLimits | None = None
+    ) -> str:
+        import torch
+
+        if prepared.cached_reply is not None:
+            self.last_stats = None
+            if on_delta:
+                on_delta(prepared.cached_reply)
+            return prepared.cached_reply
+
+        input = prepared.input
+        input_token_length = input.shape[1]
+
+        generate_kwargs = self.generate_kwargs(limits, input_token_length)
+        past_key_values = self.prefill(prepared.prefix)
+        if past_key_values is not None:
+            generate_kwargs["past_key_values"] = past_key_values
+        if self.draft_model is not None:
+            # The draft model proposes tokens that the model verifies in a
+            # single forward pass, the output is the model's own
+            generate_kwargs["assistant_model"] = self.draft_model
+
+        started_at = monotonic()
+        time_to_first_token: float | None = None
+        with ForwardCounter(self.model) as model_calls:
+            with ForwardCounter(self.draft_model or self.model) as draft_calls:
+                if on_delta:
+                    output, time_to_first_token = self.generate_streaming(input, generate_kwargs, on_delta)
+                else:
+                    with torch.no_grad(): # Important for inference
+                        output = self.model.generate(input, **generate_kwargs)
+        duration = monotonic() - started_at
+
+        reply_tokens = output[0][input_token_length:]
+
+        reply: str = self.tokenizer.decode(
+            reply_tokens,
+            skip_special_tokens=True
+        ).strip()
+
+        # Each verification pass yields one token of the model's own in
+        # addition to the draft tokens it accepted
+        draft_acceptance_rate: float | None = None
+        if self.draft_model is not None and draft_calls.calls:
+            accepted = max(0, len(reply_tokens) - model_calls.calls)
+            draft_acceptance_rate = round(accepted / draft_calls.calls, 3)
+
+        self.last_stats = GenerationStats(
+            prompt_tokens=input_token_length,
+            new_tokens=len(reply_tokens),
+            duration=round(duration, 3),
+            tokens_per_second=round(len(reply_tokens) / duration, 2) if duration > 0 else 0,
+            max_new_tokens=generate_kwargs["max_new_tokens"],
+            time_to_first_token=round(time_to_first_token, 3) if time_to_first_token is not None else None,
+            draft_acceptance_rate=draft_acceptance_rate,
+        )
+        logging.info(f"Assistant.generate: {self.last_stats.model_dump()}")
+
+        if self.reply_cache is not None and prepared.cache_key is not None:
+            self.reply_cache.insert(*prepared.cache_key, reply)
+
+        return reply
+
+    def formulate_batch(
+        self,
+        messages: List[str],
+        histories: List[List[Message]] | None = None,
+        limits: GenerationLimits | None = None
+    ) -> List[str]:
+        """
+        Serves what it can from the reply cache and generates the remaining
+        replies in a single batch.
+        """
+        histories = histories or [[] for _ in messages]
+
+        if len(messages) == 1 or self.draft_model is not None:
+            # Assisted generation only supports a single sequence
+            return [self.generate(self.prepare(m, h), limits=limits) for m, h in zip(messages, histories)]
+
+        replies: List[str | None] = []
+        cache_keys: List[Tuple[np.ndarray, Hashable] | None] = []
+        for m, h in zip(messages, histories):
+            cached_reply, cache_key = self.lookup_reply(m, h)
+            replies.append(cached_reply)
+            cache_keys.append(cache_key)
+
+        to_generate = [i for i, r in enumerate(replies) if r is None]
+        if to_generate:
+            generated = self.generate_batch(
+                [messages[i] for i in to_generate],
+                [histories[i] for i in to_generate],
+                limits
+            )
+            for i, reply in zip(to_generate, generated):
+                replies[i] = reply
+                key = cache_keys[i]
+                if self.reply_cache is not None and key is not None:
+                    self.reply_cache.insert(*key, reply)
+
+        return [r or "" for r in replies]
+
+    def generate_batch(
+        self,
+        messages: List[str],
+        histories: List[List[Message]],
+        limits: GenerationLimits | None = None
+    ) -> List[str]:
+        """
+        Generates replies to several messages in a single batch. Prompts are
+        left-padded so that generation continues right after each prompt.
+        Batches do not use the prefix cache, as each prompt is padded by a
+        different amount.
+        """
+        import torch
+
+        prompts = [self.build_prompt(m, h) for m, h in zip(messages, histories)]
+
+        # The tokenizer is shared with single replies, so the pad token is
+        # only borrowed for this batch
+        pad_token = self.tokenizer.pad_token
+        if pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        try:
+            pad_token_id = self.tokenizer.pad_token_id
+            inputs = self.tokenizer(
+                prompts,
+                return_tensors="pt",
+                padding=True,
+                padding_side="left",
+            ).to(self.device)
+        finally:
+            self.tokenizer.pad_token = pad_token
+
+        input_token_length = inputs["input_ids"].shape[1]
+        generate_kwargs = self.generate_kwargs(limits, input_token_length)
+
+        started_at = monotonic()
+        with torch.no_grad(): # Important for inference
+            output = self.model.generate(
+                **inputs,
+                pad_token_id=pad_token_id,
+                **generate_kwargs
+            )
+        duration = monotonic() - started_at
+
+        reply_tokens = output[:, input_token_length:]
+        new_tokens = int((reply_tokens != pad_token_id).sum())
+
+        # Throughput per sequence, which is how fast each reply of the batch
+        # was generated
+        self.last_stats = GenerationStats(
+            prompt_tokens=int(inputs["attention_mask"].sum()),
+            new_tokens=new_tokens,
+            duration=round(duration, 3),
+            tokens_per_second=round(new_tokens / len(messages) / duration, 2) if duration > 0 else 0,
+            max_new_tokens=generate_kwargs["max_new_tokens"],
+            time_to_first_token=None,
+            draft_acceptance_rate=None,
+        )
+        logging.info(f"Assistant.generate_batch: {len(messages)} replies, {self.last_stats.model_dump()}")
+
+        replies: List[str] = self.tokenizer.batch_decode(
+            reply_tokens,
+            skip_special_tokens=True
+        )
+
+        return [r.strip() for r in replies]
+
+    def generate_streaming(
+        self,
+        input: Any,
+        generate_kwargs: dict[str, Any],
+        on_delta: Callable[[str], None]
+    ) -> tuple[Any, float | None]:
+        """
+        Runs generation on a separate thread and passes decoded text to
+        `on_delta` as it is produced. Returns the generated output and the
+        time to the first token.
+        """
+        import torch
+        from transformers.generation.streamers import TextIteratorStreamer
+
+        streamer = TextIteratorStreamer(
+            self.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True
+        )
+        result: dict[str, Any] = {}
+
+        def run():
+            try:
+                with torch.no_grad():
+                    result['output'] = self.model.generate(input, streamer=streamer, **generate_kwargs)
+            except Exception as e:
+                result['error'] = e
+                # Unblock the consumer
+                streamer.end()
+
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+
+        started_at = monotonic()
+        first_token_at: float | None = None
+        time_to_first_token: float | None = None
+        for text in streamer:
+            if not text:
+                continue
+            if first_token_at is None:
+                first_token_at = monotonic()
+                time_to_first_token = first_token_at - started_at
+                logging.info(f"Assistant.generate_streaming: first token after {time_to_first_token:.3f}s")
+            on_delta(text)
+
+        thread.join()
+
+        if 'error' in result:
+            raise result['error']
+
+        return result['output'], time_to_first_token
+
+    @staticmethod
+    def template_one_off(
+        *,
+        user: str,
+        system: str,
+        history: List[ChatTemplateRecord] | None = None
+    ) -> ChatTemplate:
+        return ChatTemplate([
+            ChatTemplateRecord(
+                role=Role.SYSTEM,
+                content=system
+            ),
+            *(history or []),
+            ChatTemplateRecord(
+                role=Role.USER,
+                content=user
+            )
+        ])
+
+SENTENCE_ENDINGS = (".", "!", "?")
+
+def sentence_boundary_criteria(tokenizer: Any, prompt_length: int, min_new_tokens: int) -> Any:
+    """
+    Stopping criteria that end a sequence at the first token that ends a
+    sentence, once at least `min_new_tokens` tokens have been generated
+    """
+    import torch
+    from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
+
+    class SentenceBoundaryCriteria(StoppingCriteria):
+        def __call__(self, input_ids: Any, scores: Any, **kwargs: Any) -> Any:
+            done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+            if input_ids.shape[1] - prompt_length < min_new_tokens:
+                return done
+
+            for i, token_id in enumerate(input_ids[:, -1].tolist()):
+                text = tokenizer.decode([token_id], skip_special_tokens=True).rstrip()
+                done[i] = text.endswith(SENTENCE_ENDINGS)
+            return done
+
+    return StoppingCriteriaList([SentenceBoundaryCriteria()])
+
+def load_generation_model(model_name: str, precision: Precision) -> tuple[Any, Any]:
+    """
+    Loads the tokenizer and causal LM. Weights are memory-mapped from
+    safetensors and loaded without first materializing a randomly initialized
+    copy of the model, then converted to the requested precision.
+    """
+    from transformers.models.auto.tokenization_auto import AutoTokenizer
+    from transformers.models.auto.modeling_auto import AutoModelForCausalLM
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    try:
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch_dtype(precision),
+            use_safetensors=True,
+            low_cpu_mem_usage=True,
+        )
+    except OSError:
+        logging.warning(f"No safetensors weights for '{model_name}', falling back to the default format")
+        model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch_dtype(precision),
+            low_cpu_mem_usage=True,
+        )
+
+    model.eval()
+    return tokenizer, quantize_if_int8(model, precision)
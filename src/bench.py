@@ -0,0 +1,303 @@
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+from typing import Any, Dict, List, Tuple
+from uuid import UUID
+import numpy as np
+from src.assistant import AbstractAssistant, Assistant, Contextualizer, MockedAssistant, load_generation_model
+from src.encoders import EMBEDDING_MODEL_NAME, EmbeddingBackend, load_encoder
+from src.models import Concept, ConceptEmbedding, SystemPrompt, SystemPromptKey
+from src.precision import Precision
+from src.prompts import SystemPromptsCache
+from src.retrieval import ConceptRetriever
+
+# Benchmarks reply generation against in-memory repositories, so it needs
+# neither a database nor the worker's environment:
+#
+#   python -m src.bench --concepts 10000 > bench.json
+#
+# Results are printed as JSON on stdout so they can be compared across commits.
+
+# A fixed corpus, so that runs on different commits generate for the same input
+CORPUS = [
+    "Hello Cheryl!",
+    "What does serendipity mean?",
+    "Can you explain the difference between affect and effect?",
+    "Is there a word for the smell of rain on dry earth?",
+    "How would you use the word ephemeral in a sentence?",
+    "What is the opposite of verbose?",
+    "Tell me a word that sounds like what it means.",
+    "Why do some words have silent letters?",
+]
+
+BENCH_TIMESTAMP = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+BASE_PROMPT = "You are Cheryl, a friendly assistant who answers questions about words and their meanings. Keep your replies short."
+RELATED_CONCEPTS_PROMPT = "The following concepts may be related to the question, use them if they help."
+
+SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "sa", "to", "vi", "ze", "qua", "bri", "dor", "fen", "gal", "hun"]
+WORDS = [
+    "light", "water", "sound", "memory", "a feeling", "the sea", "time", "a small", "an old", "quiet",
+    "bright", "a word", "something", "people", "the morning", "change", "a place", "slow", "warm", "sharp",
+]
+
+def synthetic_concepts(n: int, seed: int = 0) -> List[Concept]:
+    """
+    A deterministic table of made-up concepts with short meanings
+    """
+    rng = random.Random(seed)
+    concepts = []
+    for i in range(n):
+        concept = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        meaning = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 16)))
+        concepts.append(Concept(
+            id=UUID(int=rng.getrandbits(128)),
+            timestamp=BENCH_TIMESTAMP + timedelta(seconds=i),
+            concept=concept,
+            meaning=meaning.capitalize() + ".",
+            deleted=False
+        ))
+    return concepts
+
+class InMemoryConceptsRepository:
+    concepts: List[Concept]
+
+    def __init__(self, concepts: List[Concept]):
+        self.concepts = concepts
+
+    def get_concepts(self) -> List[Concept]:
+        return list(self.concepts)
+
+    def get_concepts_version(self) -> Tuple[int, datetime | None]:
+        return len(self.concepts), max((c.timestamp for c in self.concepts), default=None)
+
+class InMemoryConceptEmbeddingsRepository:
+    embeddings: Dict[Tuple[str, UUID, datetime], ConceptEmbedding]
+
+    def __init__(self):
+        self.embeddings = {}
+
+    def get_concept_embeddings(
+        self, *,
+        model: str,
+        keys: List[Tuple[UUID, datetime]]
+    ) -> List[ConceptEmbedding]:
+        return [self.embeddings[(model, *k)] for k in keys if (model, *k) in self.embeddings]
+
+    def insert_concept_embeddings(self, embeddings: List[ConceptEmbedding]) -> None:
+        for e in embeddings:
+            self.embeddings.setdefault((e.model, e.concept_id, e.timestamp), e)
+
+class InMemorySystemPromptsRepository:
+    def get_system_prompts(self) -> List[SystemPrompt]:
+        return [
+            SystemPrompt(key=SystemPromptKey.BASE, prompt=BASE_PROMPT, timestamp=BENCH_TIMESTAMP),
+            SystemPrompt(key=SystemPromptKey.RELATED_CONCEPTS, prompt=RELATED_CONCEPTS_PROMPT, timestamp=BENCH_TIMESTAMP),
+        ]
+
+def summarize(values: List[float]) -> Dict[str, float] | None:
+    """
+    Mean and p50/p95/p99 of the measurements, rounded to microseconds
+    """
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        "n": len(values),
+        "mean": round(float(np.mean(values)), 6),
+        "p50": round(float(p50), 6),
+        "p95": round(float(p95), 6),
+        "p99": round(float(p99), 6),
+    }
+
+def measure_prefill(assistant: Assistant, prompt: str) -> Tuple[float, int]:
+    """
+    Time of a single forward pass over the whole prompt, without the prefix
+    cache. Returns the duration and the number of prompt tokens.
+    """
+    import torch
+
+    input_ids = assistant.tokenizer(prompt, return_tensors="pt").input_ids.to(assistant.device)
+    started_at = monotonic()
+    with torch.no_grad():
+        assistant.model(input_ids, use_cache=True)
+    return monotonic() - started_at, input_ids.shape[1]
+
+def bench_mocked(messages: List[str], runs: int) -> Dict[str, Any]:
+    """
+    End-to-end latency of the mocked assistant, the overhead of the harness
+    """
+    assistant: AbstractAssistant = MockedAssistant()
+    latencies = []
+    for _ in range(runs):
+        for message in messages:
+            started_at = monotonic()
+            assistant.formulate(message, on_delta=lambda _: None)
+            latencies.append(monotonic() - started_at)
+    return {"latency": summarize(latencies)}
+
+def bench_assistant(assistant: Assistant, messages: List[str], runs: int) -> Dict[str, Any]:
+    import torch
+
+    contextualizer = assistant.contextualizer
+    assert isinstance(contextualizer, Contextualizer)
+
+    retrieval: List[float] = []
+    prefill: List[float] = []
+    prompt_tokens: List[float] = []
+    time_to_first_token: List[float] = []
+    tokens_per_second: List[float] = []
+    new_tokens: List[float] = []
+    draft_acceptance_rate: List[float] = []
+    latencies: List[float] = []
+
+    for run in range(runs):
+        # Sampling is seeded so that every commit generates the same replies
+        torch.manual_seed(run)
+        for message in messages:
+            started_at = monotonic()
+            contextualizer.get_related_concepts(message, 5)
+            retrieval.append(monotonic() - started_at)
+
+            duration, tokens = measure_prefill(assistant, assistant.build_prompt(message))
+            prefill.append(duration)
+            prompt_tokens.append(tokens)
+
+            # Streaming, so that the time to the first token is measured too
+            started_at = monotonic()
+            assistant.formulate(message, on_delta=lambda _: None)
+            latencies.append(monotonic() - started_at)
+
+            stats = assistant.last_stats
+            if stats is None:
+                continue
+            if stats.time_to_first_token is not None:
+                time_to_first_token.append(stats.time_to_first_token)
+            if stats.draft_acceptance_rate is not None:
+                draft_acceptance_rate.append(stats.draft_acceptance_rate)
+            tokens_per_second.append(stats.tokens_per_second)
+            new_tokens.append(stats.new_tokens)
+
+    return {
+        "retrieval": summarize(retrieval),
+        "prefill": summarize(prefill),
+        "prompt_tokens": summarize(prompt_tokens),
+        "time_to_first_token": summarize(time_to_first_token),
+        "tokens_per_second": summarize(tokens_per_second),
+        "new_tokens": summarize(new_tokens),
+        "draft_acceptance_rate": summarize(draft_acceptance_rate),
+        "latency": summarize(latencies),
+    }
+
+def get_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark reply generation")
+    parser.add_argument("--model", default="HuggingFaceTB/SmolLM2-135M-Instruct")
+    parser.add_argument("--draft-model", default=None)
+    parser.add_argument("--embedding-model", default=EMBEDDING_MODEL_NAME)
+    parser.add_argument("--precision", type=Precision, default=Precision.FP32)
+    parser.add_argument("--embedding-precision", type=Precision, default=Precision.FP32)
+    parser.add_argument("--embedding-backend", type=EmbeddingBackend, default=EmbeddingBackend.TORCH)
+    parser.add_argument("--embedding-onnx-dir", default="models")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--concepts", type=int, default=1000, help="size of the synthetic concept table")
+    parser.add_argument("--runs", type=int, default=3, help="passes over the message corpus")
+    parser.add_argument("--ann-threshold", type=int, default=10_000)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--no-prefix-cache", action="store_true")
+    parser.add_argument("--prompt-token-budget", type=int, default=None)
+    parser.add_argument("--lexical", action="store_true", help="match mentioned concept terms before embedding")
+    return parser.parse_args(argv)
+
+def main(argv: List[str]) -> None:
+    args = parse_args(argv)
+
+    # Only locally cached models are used so that downloads do not skew the
+    # results, set HF_HUB_OFFLINE=0 to allow them
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+    import torch
+
+    concepts_repository = InMemoryConceptsRepository(synthetic_concepts(args.concepts))
+    concept_embeddings_repository = InMemoryConceptEmbeddingsRepository()
+
+    started_at = monotonic()
+    tokenizer, model = load_generation_model(args.model, args.precision)
+    draft_model = None
+    if args.draft_model:
+        _, draft_model = load_generation_model(args.draft_model, args.precision)
+    model.to(args.device)
+    if draft_model is not None:
+        draft_model.to(args.device)
+
+    contextualizer = Contextualizer(
+        concepts_repository=concepts_repository,
+        concept_embeddings_repository=concept_embeddings_repository,
+        system_prompts=SystemPromptsCache(
+            system_prompts_repository=InMemorySystemPromptsRepository(),
+            max_age=float("inf"),
+        ),
+        retriever=ConceptRetriever(
+            ann_threshold=args.ann_threshold,
+            nprobe=args.nprobe,
+        ),
+        encoder=load_encoder(
+            backend=args.embedding_backend,
+            precision=args.embedding_precision,
+            onnx_directory=args.embedding_onnx_dir,
+            model_name=args.embedding_model,
+        ),
+        with_lexical_matching=args.lexical,
+    )
+    load_duration = monotonic() - started_at
+
+    started_at = monotonic()
+    contextualizer.embeddings.refresh()
+    embed_duration = monotonic() - started_at
+
+    assistant = Assistant(
+        contextualizer=contextualizer,
+        tokenizer=tokenizer,
+        model=model,
+        with_prefix_cache=not args.no_prefix_cache,
+        draft_model=draft_model,
+        device=args.device,
+        prompt_token_budget=args.prompt_token_budget
+    )
+    assistant.warmup()
+
+    result = {
+        "commit": get_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "args": {k: v.value if isinstance(v, (Precision, EmbeddingBackend)) else v for k, v in vars(args).items()},
+        "corpus": len(CORPUS),
+        "load": round(load_duration, 3),
+        "embed_concepts": round(embed_duration, 3),
+        "mocked": bench_mocked(CORPUS, args.runs),
+        "assistant": bench_assistant(assistant, CORPUS, args.runs),
+    }
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+if __name__ == '__main__':
+    # Logs go to stderr and would drown the measurements, warnings only
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    main(sys.argv[1:])
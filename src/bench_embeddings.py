@@ -0,0 +1,96 @@
+import argparse
+import json
+import logging
+import os
+import sys
+from time import monotonic
+from typing import Any, Dict, List
+from src.bench import CORPUS, get_commit, summarize, synthetic_concepts
+from src.encoders import EMBEDDING_MODEL_NAME, AbstractEncoder, EmbeddingBackend, load_encoder
+from src.precision import Precision, embedding_parity
+
+# Compares the encode latency of the embedding backends and checks that
+# they agree with the sentence transformers embeddings:
+#
+#   python -m src.bench_embeddings --backends torch:fp32,onnx:fp32,onnx:int8 > bench_embeddings.json
+
+def bench_encoder(
+    encoder: AbstractEncoder,
+    reference: AbstractEncoder,
+    concepts: List[str],
+    runs: int
+) -> Dict[str, Any]:
+    # The first call pays for lazy initialization
+    encoder.encode(CORPUS[:1])
+
+    single: List[float] = []
+    for _ in range(runs):
+        for message in CORPUS:
+            started_at = monotonic()
+            encoder.encode([message])
+            single.append(monotonic() - started_at)
+
+    started_at = monotonic()
+    embeddings = encoder.encode(concepts)
+    bulk_duration = monotonic() - started_at
+
+    sample = CORPUS + concepts[:100]
+    return {
+        "name": encoder.name,
+        "memory_mb": round(encoder.memory_bytes() / 1024 / 1024, 1),
+        "single_message": summarize(single),
+        "bulk": {
+            "n": len(concepts),
+            "duration": round(bulk_duration, 3),
+            "per_second": round(len(concepts) / bulk_duration, 1) if bulk_duration > 0 else None,
+        },
+        "dimensions": int(embeddings.shape[1]) if embeddings.size else None,
+        "parity": round(embedding_parity(reference.encode(sample), encoder.encode(sample)), 5),
+    }
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark embedding backends")
+    parser.add_argument("--model", default=EMBEDDING_MODEL_NAME)
+    parser.add_argument(
+        "--backends",
+        default="torch:fp32,onnx:fp32",
+        help="comma separated backend:precision pairs"
+    )
+    parser.add_argument("--onnx-dir", default="models")
+    parser.add_argument("--concepts", type=int, default=1000, help="number of concept meanings encoded in bulk")
+    parser.add_argument("--runs", type=int, default=5, help="passes over the message corpus")
+    return parser.parse_args(argv)
+
+def main(argv: List[str]) -> None:
+    args = parse_args(argv)
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+    concepts = [c.meaning for c in synthetic_concepts(args.concepts)]
+    reference = load_encoder(
+        backend=EmbeddingBackend.TORCH,
+        precision=Precision.FP32,
+        onnx_directory=args.onnx_dir,
+        model_name=args.model,
+    )
+
+    results = []
+    for spec in args.backends.split(","):
+        backend, precision = spec.strip().split(":")
+        encoder = load_encoder(
+            backend=EmbeddingBackend(backend),
+            precision=Precision(precision),
+            onnx_directory=args.onnx_dir,
+            model_name=args.model,
+        )
+        results.append({"backend": backend, "precision": precision, **bench_encoder(encoder, reference, concepts, args.runs)})
+
+    json.dump({
+        "commit": get_commit(),
+        "model": args.model,
+        "backends": results,
+    }, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    main(sys.argv[1:])
@@ -1,26 +1,36 @@
-from time import sleep
+from time import sleep, monotonic
+from threading import Event, Lock, Semaphore, Thread
+from queue import Empty, Queue
+from uuid import UUID, uuid4
+import json
 import logging
-from numpy._core.numeric import ndarray
+import math
 from src.repositories.concepts import ConceptsRepository
+from src.repositories.concept_embeddings import ConceptEmbeddingsRepository
 from src.repositories.messages import MessagesRepository
 from src.repositories.users import UsersRepository
 from src.config.config import Config
 from psycopg_pool import ConnectionPool
 from psycopg.rows import TupleRow
-from psycopg import Connection
-from datetime import datetime, timezone
+from psycopg import Connection, Notify
+from datetime import datetime, timedelta, timezone
 from src.services.messages import MessagesService
 from src.services.users import UsersService
-from transformers.models.auto.tokenization_auto import AutoTokenizer
-from transformers.models.auto.modeling_auto import AutoModelForCausalLM
-from src.models import ChatTemplate, ChatTemplateRecord, Role, SystemPromptKey, Concept
-import abc
-from typing import Any, List
-import torch
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-import numpy as np
+from src.models import GenerationLimits, GenerationStats, Message, ReplyJob, ReplyStatus, ReplyStatusChanged, Worker, WorkerStatus
+from contextlib import contextmanager
+from typing import Callable, Dict, List
 from src.repositories.system_prompts import SystemPromptsRepository
+from src.repositories.notifications import MAX_PAYLOAD_BYTES, NotificationsRepository
+from src.retrieval import ConceptRetriever
+from src.notifications import NotificationListener, CONCEPTS_CHANNEL, REPLY_STATUS_CHANNEL, SYSTEM_PROMPTS_CHANNEL
+from src.prompts import SystemPromptsCache
+from src.scheduling import GenerationBudgetPolicy
+from src.reply_cache import SemanticReplyCache
+from src.repositories.workers import WorkersRepository
+from src.precision import Precision, embedding_margin, generation_perplexity, log_footprint, model_memory_bytes
+from src.encoders import EmbeddingBackend, load_encoder
+from src.metrics import GENERATION_DURATION, GENERATION_NEW_TOKENS, GENERATION_PROMPT_TOKENS, GENERATION_TIME_TO_FIRST_TOKEN, REGISTRY, REPLY_JOBS, collect_pool_stats, serve_metrics
+from src.assistant import AbstractAssistant, Assistant, Contextualizer, MockedAssistant, PreparedPrompt, load_generation_model
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -35,7 +45,10 @@ pool = ConnectionPool(
 users_repository = UsersRepository(pool)
 messages_repository = MessagesRepository(pool)
 concepts_repository = ConceptsRepository(pool)
+concept_embeddings_repository = ConceptEmbeddingsRepository(pool)
 system_prompts_repository = SystemPromptsRepository(pool)
+notifications_repository = NotificationsRepository(pool)
+workers_repository = WorkersRepository(pool)
 
 # Services
 users_service = UsersService(
@@ -44,232 +57,686 @@ users_service = UsersService(
 )
 messages_service = MessagesService(
     config=config,
-    messages_repository=messages_repository
+    messages_repository=messages_repository,
+    notifications_repository=notifications_repository
 )
 
-class AbstractAssistant(abc.ABC):
-    @abc.abstractmethod
-    def formulate(self, message: str) -> str:
-        pass
-
-class AbstractContextualizer(abc.ABC):
-    @abc.abstractmethod
-    def get_contextualized_system_prompt(self, message: str) -> str:
-        pass
-
-class MockedAssistant(AbstractAssistant):
-    def formulate(self, message: str) -> str:
-        return "mocked"
-
-class Contextualizer(AbstractContextualizer):
-    concepts_repository: ConceptsRepository
-    system_prompts_repository: SystemPromptsRepository
-    model: SentenceTransformer
+def json_string_bytes(text: str) -> int:
+    """
+    The size of the text as a UTF-8 JSON string, without the quotes
+    """
+    return len(json.dumps(text, ensure_ascii=False).encode()) - 2
+
+class DeltaCoalescer:
+    """
+    Buffers streamed text and passes it on at most once per interval, so a
+    reply is published in a handful of chunks rather than one per token.
+    The first chunk is passed on immediately.
+
+    Chunks are published as notifications, whose payloads are limited in
+    bytes, so a chunk takes at most `max_bytes` bytes as a JSON string. That
+    leaves room for the rest of the ReplyDelta envelope.
+    """
+    interval: float
+    max_bytes: int
+    on_flush: Callable[[str], None]
+    buffer: str
+    buffer_bytes: int
+    flushed_at: float | None
 
     def __init__(
         self, *,
-        concepts_repository: ConceptsRepository,
-        system_prompts_repository: SystemPromptsRepository,
+        interval: float,
+        on_flush: Callable[[str], None],
+        max_bytes: int = MAX_PAYLOAD_BYTES - 512
     ):
-        self.model = SentenceTransformer("thenlper/gte-small")
-        self.concepts_repository = concepts_repository
-        self.system_prompts_repository = system_prompts_repository
-
-    def get_related_concepts(self, message: str, n: int) -> list[Concept]:
-        concepts = self.concepts_repository.get_concepts()
-        embeddings: ndarray = self.model.encode([c.meaning for c in concepts])
-
-        if not concepts:
-            return []
-
-        input = self.model.encode([message])[0]
-        scores = cosine_similarity([input], embeddings)[0]
-        sorted = np.argsort(scores)[::-1]
-
-        concepts_to_use = []
-        scores_to_log = []
-        for i in sorted[:n]:
-            concepts_to_use.append(concepts[i])
-            scores_to_log.append({'concept': concepts[i].concept, 'score': scores[i]})
-
-        logging.info(f"Most relevant concepts (top {n}): {scores_to_log}")
-        return concepts_to_use
-
-    @staticmethod
-    def template_concepts(concepts: List[Concept]) -> str:
-        buf = "\nREFERENCE CONCEPTS FOR CHERYL'S VOCABULARY:\n"
-        for c in concepts:
-            buf += f"Concept: {c.concept}\n"
-            buf += f"Meaning: {c.meaning}\n\n"
-        buf += "\nEND OF REFERENCE CONCEPTS.\n"
-        return buf
-
-    def get_contextualized_system_prompt(self, message: str) -> str:
-        """
-        Retrieves related concepts and formats them into a prompt string.
-        """
-        parts = []
-
-        base = self.system_prompts_repository.get_system_prompt(SystemPromptKey.BASE.value)
-        if base and base.prompt:
-            parts.append(base.prompt)
-
-        concepts = self.get_related_concepts(message, 5)
-        related_concepts = self.system_prompts_repository.get_system_prompt(SystemPromptKey.RELATED_CONCEPTS.value)
-        if concepts and related_concepts and related_concepts.prompt:
-            parts.append(related_concepts.prompt)
-
-        if concepts:
-            parts.append(Contextualizer.template_concepts(concepts))
-
-        prompt = "\n".join(parts).strip()
-
-        return prompt
-
-class Assistant(AbstractAssistant):
-    contextualizer: AbstractContextualizer
-    tokenizer: Any
-    model: Any
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.on_flush = on_flush
+        self.buffer = ""
+        self.buffer_bytes = 0
+        self.flushed_at = None
+
+    def push(self, text: str) -> None:
+        self.buffer += text
+        self.buffer_bytes += json_string_bytes(text)
+        now = monotonic()
+        if (
+            self.flushed_at is None
+            or now - self.flushed_at >= self.interval
+            or self.buffer_bytes >= self.max_bytes
+        ):
+            self.flush(now)
+
+    def flush(self, now: float | None = None) -> None:
+        if not self.buffer:
+            return
+
+        # Split what does not fit in one chunk
+        chunk = ""
+        chunk_bytes = 0
+        for c in self.buffer:
+            n = json_string_bytes(c)
+            if chunk and chunk_bytes + n > self.max_bytes:
+                self.on_flush(chunk)
+                chunk = ""
+                chunk_bytes = 0
+            chunk += c
+            chunk_bytes += n
+        self.on_flush(chunk)
+
+        self.buffer = ""
+        self.buffer_bytes = 0
+        self.flushed_at = now if now is not None else monotonic()
+
+class LeaseHeartbeat:
+    """
+    Keeps extending the leases of claimed jobs from a background thread
+    while they are being worked on. Jobs may be added and removed while
+    it runs.
+    """
+    messages_service: MessagesService
+    worker_id: UUID
+    jobs: List[ReplyJob]
+    interval: float
+    lock: Lock
+    stopped: Event
+    thread: Thread | None
 
     def __init__(
-        self,
-        tokenizer: Any,
-        model: Any,
-        contextualizer: AbstractContextualizer
+        self, *,
+        messages_service: MessagesService,
+        worker_id: UUID,
+        jobs: List[ReplyJob],
+        interval: float
     ):
-        self.contextualizer = contextualizer
-        self.tokenizer = tokenizer
-        self.model = model
-
-    def formulate(self, message: str) -> str:
-        system_prompt = self.contextualizer.get_contextualized_system_prompt(message)
-        logging.info(f"Using prompt\n\n{system_prompt}")
-
-        templated = Assistant.template_one_off(
-            user=message,
-            system=system_prompt
-        ).model_dump(mode='json')
-
-        logging.info(f"Generating with template:\n{templated}")
-        prompt = self.tokenizer.apply_chat_template(
-            templated,
-            tokenize=False,
-            add_generation_prompt=True,
-            enable_thinking=False,
-        )
-
-        input = self.tokenizer.encode(
-            prompt,
-            return_tensors="pt",
-            padding=True,
-        ).to(config.DEVICE)
-
-        input_token_length = input.shape[1]
-
-        with torch.no_grad(): # Important for inference
-            output = self.model.generate(
-                input,
-                max_new_tokens=250,
-                temperature=0.55,
-                top_p=0.95,
-                top_k=50,
-                do_sample=True,
-                repetition_penalty=1.3,
-                eos_token_id=self.tokenizer.eos_token_id,
-            )
+        self.messages_service = messages_service
+        self.worker_id = worker_id
+        self.jobs = list(jobs)
+        self.interval = interval
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def add(self, job: ReplyJob) -> None:
+        with self.lock:
+            self.jobs.append(job)
+
+    def remove(self, job: ReplyJob) -> None:
+        with self.lock:
+            self.jobs = [j for j in self.jobs if j.reply_id != job.reply_id]
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                jobs = list(self.jobs)
+            if not jobs:
+                continue
+            try:
+                held = self.messages_service.extend_reply_job_leases(
+                    worker_id=self.worker_id,
+                    jobs=jobs
+                )
+                if len(held) < len(jobs):
+                    logging.warning(f"LeaseHeartbeat.run: holding {len(held)} of {len(jobs)} leases")
+            except Exception as e:
+                logging.error(f"LeaseHeartbeat.run: failed to extend leases, {e}")
+
+class WorkerHeartbeat:
+    """
+    Marks the worker as alive from a background thread, so that it keeps
+    being seen while a generation blocks the main loop.
+    """
+    workers_repository: WorkersRepository
+    worker: Worker
+    interval: float
+    stopped: Event
+    thread: Thread | None
 
-        reply_tokens = output[0][input_token_length:]
-
-        reply: str = self.tokenizer.decode(
-            reply_tokens,
-            skip_special_tokens=True
-        ).strip()
-
-        return reply
-
-    @staticmethod
-    def template_one_off(
-        *,
-        user: str,
-        system: str
-    ) -> ChatTemplate:
-        return ChatTemplate([
-            ChatTemplateRecord(
-                role=Role.SYSTEM,
-                content=system
-            ),
-            ChatTemplateRecord(
-                role=Role.USER,
-                content=user
-            )
-        ])
+    def __init__(
+        self, *,
+        workers_repository: WorkersRepository,
+        worker: Worker,
+        interval: float
+    ):
+        self.workers_repository = workers_repository
+        self.worker = worker
+        self.interval = interval
+        self.stopped = Event()
+        self.thread = None
+
+    def __enter__(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.workers_repository.update_worker_heartbeat(self.worker, datetime.now(timezone.utc))
+            except Exception as e:
+                logging.error(f"WorkerHeartbeat.run: failed to update the heartbeat, {e}")
 
 class AssistantService:
+    worker_id: UUID
     messages_repository: MessagesRepository
     concepts_repository: ConceptsRepository
     messages_service: MessagesService
     assistant: AbstractAssistant
+    budget_policy: GenerationBudgetPolicy
+    workers_repository: WorkersRepository
 
     def __init__(
         self, *,
+        worker_id: UUID,
         messages_repository: MessagesRepository,
         concepts_repository: ConceptsRepository,
+        workers_repository: WorkersRepository,
         messages_service: MessagesService,
-        assistant: AbstractAssistant
+        assistant: AbstractAssistant,
+        budget_policy: GenerationBudgetPolicy
         ):
+        self.worker_id = worker_id
         self.messages_repository = messages_repository
         self.concepts_repository = concepts_repository
+        self.workers_repository = workers_repository
         self.messages_service = messages_service
         self.assistant = assistant
+        self.budget_policy = budget_policy
 
-    def poll(self):
+    def poll(self) -> int:
+        """
+        Replies to the next batch of pending messages, returns the number of replies
+        """
         logging.info("AssistantService.poll")
-        reply = self.messages_service.get_next_enqueued_reply(
-            timestamp=datetime.now(timezone.utc)
-        )
-
-        if reply:
-            # Get the associated message
-            message = messages_repository.get_message(message_id=reply.message_id)
+        jobs = self.claim_batch()
 
-            # Ask cheryl to respond to it
-            response = self.assistant.formulate(message.message)
+        if not jobs:
+            return 0
 
-            # Update the reply with Cheryls response
-            messages_service.append_reply_content(
-                reply=reply,
+        with LeaseHeartbeat(
+            messages_service=self.messages_service,
+            worker_id=self.worker_id,
+            jobs=jobs,
+            interval=config.REPLY_JOB_LEASE / 3
+        ):
+            # Get the associated messages
+            messages = [
+                self.messages_repository.get_message(message_id=job.message_id)
+                for job in jobs
+            ]
+
+            histories = [self.get_history(m) for m in messages]
+            limits = self.choose_limits()
+
+            # Ask cheryl to respond to them
+            if len(jobs) == 1 and config.STREAM_REPLIES:
+                prepared = self.assistant.prepare(messages[0].message, histories[0])
+                responses = [self.generate_streaming(jobs[0], prepared, limits)]
+            else:
+                responses = self.assistant.formulate_batch([m.message for m in messages], histories, limits)
+            self.observe(self.assistant.last_stats)
+
+        # Update the replies with Cheryls responses
+        for job, response in zip(jobs, responses):
+            self.messages_service.complete_reply_job(
+                worker_id=self.worker_id,
+                job=job,
                 timestamp=datetime.now(timezone.utc),
                 content=response
             )
 
-def main():
+        return len(jobs)
+
+    def claim(self, limit: int) -> List[ReplyJob]:
+        """
+        Claims up to `limit` jobs, giving up on those that have been
+        attempted too many times
+        """
+        jobs: List[ReplyJob] = []
+        for job in self.messages_service.claim_reply_jobs(worker_id=self.worker_id, limit=limit):
+            if job.attempts > config.REPLY_JOB_MAX_ATTEMPTS:
+                self.messages_service.fail_reply_job(
+                    worker_id=self.worker_id,
+                    job=job,
+                    timestamp=datetime.now(timezone.utc)
+                )
+                continue
+            jobs.append(job)
+        return jobs
+
+    def claim_batch(self) -> List[ReplyJob]:
+        """
+        Claims up to REPLY_BATCH_SIZE reply jobs. Once the first job is
+        claimed, waits at most REPLY_BATCH_MAX_WAIT seconds for the batch to fill.
+        """
+        jobs = self.claim(config.REPLY_BATCH_SIZE)
+        if not jobs:
+            return []
+
+        deadline = monotonic() + config.REPLY_BATCH_MAX_WAIT
+        while len(jobs) < config.REPLY_BATCH_SIZE and monotonic() < deadline:
+            sleep(min(0.25, max(0, deadline - monotonic())))
+            jobs += self.claim(config.REPLY_BATCH_SIZE - len(jobs))
+
+        logging.info(f"AssistantService.claim_batch: claimed {len(jobs)} jobs")
+        return jobs
+
+    def prepare(self, job: ReplyJob) -> PreparedPrompt:
+        """
+        Reads the message of the job and prepares its prompt
+        """
+        message = self.messages_repository.get_message(message_id=job.message_id)
+        return self.assistant.prepare(message.message, self.get_history(message))
+
+    def get_history(self, message: Message) -> List[Message]:
+        """
+        The messages preceding the message in its conversation, newest first
+        """
+        if config.HISTORY_MESSAGES <= 0:
+            return []
+
+        return self.messages_repository.get_messages_before(
+            conversation_id=message.conversation_id,
+            timestamp=message.timestamp,
+            limit=config.HISTORY_MESSAGES
+        )
+
+    def reply(self, job: ReplyJob, prepared: PreparedPrompt) -> None:
+        """
+        Generates the reply to a prepared prompt and completes the job
+        """
+        limits = self.choose_limits()
+        if config.STREAM_REPLIES:
+            response = self.generate_streaming(job, prepared, limits)
+        else:
+            response = self.assistant.generate(prepared, limits=limits)
+        self.observe(self.assistant.last_stats)
+
+        self.messages_service.complete_reply_job(
+            worker_id=self.worker_id,
+            job=job,
+            timestamp=datetime.now(timezone.utc),
+            content=response
+        )
+
+    def observe(self, stats: GenerationStats | None) -> None:
+        """
+        Records a finished generation, cached replies have no stats
+        """
+        self.budget_policy.observe(stats)
+        if stats is None:
+            return
+
+        GENERATION_DURATION.observe(stats.duration)
+        GENERATION_PROMPT_TOKENS.inc(stats.prompt_tokens)
+        GENERATION_NEW_TOKENS.inc(stats.new_tokens)
+        if stats.time_to_first_token is not None:
+            GENERATION_TIME_TO_FIRST_TOKEN.observe(stats.time_to_first_token)
+
+    def choose_limits(self) -> GenerationLimits:
+        """
+        Limits the length of the next reply depending on how many replies
+        are waiting. Unclaimed jobs are shared by the ready workers, so this
+        worker can expect its share of them after the next reply.
+        """
+        if self.budget_policy.target_wait <= 0:
+            # The budget is disabled, the queue does not matter
+            return self.budget_policy.choose(0)
+
+        unclaimed = self.messages_repository.count_unclaimed_reply_jobs()
+        since = datetime.now(timezone.utc) - timedelta(seconds=3 * config.WORKER_POLL_INTERVAL)
+        workers = max(1, len(self.workers_repository.get_ready_workers(since)))
+        return self.budget_policy.choose(1 + math.ceil(unclaimed / workers))
+
+    def generate_streaming(self, job: ReplyJob, prepared: PreparedPrompt, limits: GenerationLimits) -> str:
+        seq = 0
+
+        def publish(delta: str):
+            nonlocal seq
+            self.messages_service.publish_reply_delta(
+                reply_id=job.reply_id,
+                seq=seq,
+                delta=delta
+            )
+            seq += 1
+
+        coalescer = DeltaCoalescer(
+            interval=config.STREAM_FLUSH_INTERVAL,
+            on_flush=publish
+        )
+        response = self.assistant.generate(prepared, on_delta=coalescer.push, limits=limits)
+        coalescer.flush()
+
+        return response
+
+class ReplyPipeline:
+    """
+    Replies in two stages connected by a bounded queue. A background thread
+    claims jobs, reads their messages and prepares their prompts (retrieval,
+    prompt building, tokenization) while the calling thread generates, so
+    under load the next prompt is ready when the current reply is done.
+
+    The preparing thread owns the notification listener, as it is the one
+    that claims jobs and reads the cached prompts and concepts.
+    """
+    assistant_service: AssistantService
+    listener: NotificationListener
+    queue: Queue
+    slots: Semaphore
+    heartbeat: LeaseHeartbeat
+    thread: Thread | None
+
+    def __init__(
+        self, *,
+        assistant_service: AssistantService,
+        listener: NotificationListener,
+        depth: int
+    ):
+        self.assistant_service = assistant_service
+        self.listener = listener
+        self.queue = Queue(maxsize=depth)
+        # Jobs are only claimed when there is room for them, so that no more
+        # than `depth` prepared jobs wait while holding a lease
+        self.slots = Semaphore(depth)
+        self.heartbeat = LeaseHeartbeat(
+            messages_service=assistant_service.messages_service,
+            worker_id=assistant_service.worker_id,
+            jobs=[],
+            interval=config.REPLY_JOB_LEASE / 3
+        )
+        self.thread = None
+
+    def start(self) -> None:
+        self.heartbeat.__enter__()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                self.slots.acquire()
+                handle_notifications(self.assistant_service.assistant, self.listener.wait(timeout=0))
+
+                jobs = self.assistant_service.claim(1)
+                if not jobs:
+                    self.slots.release()
+                    wait_for_enqueued_reply(self.listener, self.assistant_service.assistant, config.WORKER_POLL_INTERVAL)
+                    continue
+
+                job = jobs[0]
+                self.heartbeat.add(job)
+                started_at = monotonic()
+                prepared = self.assistant_service.prepare(job)
+                logging.info(f"ReplyPipeline.run: prepared reply {job.reply_id} in {monotonic() - started_at:.3f}s")
+                self.queue.put((job, prepared))
+        except Exception as e:
+            # Raised on the generating thread, which stops the worker
+            self.queue.put(e)
+
+    def next(self, timeout: float) -> bool:
+        """
+        Generates the next prepared reply, waiting at most `timeout` seconds
+        for one. Returns whether a reply was generated.
+        """
+        try:
+            item = self.queue.get(timeout=timeout)
+        except Empty:
+            return False
+
+        if isinstance(item, Exception):
+            raise item
+
+        job, prepared = item
+        self.slots.release()
+        try:
+            self.assistant_service.reply(job, prepared)
+        finally:
+            self.heartbeat.remove(job)
+        return True
+
+class StartupTimer:
+    """
+    Records how long each phase of the worker startup takes
+    """
+    phases: Dict[str, float]
+    values: Dict[str, float]
+    started_at: float
+
+    def __init__(self):
+        self.phases = {}
+        self.values = {}
+        self.started_at = monotonic()
+
+    @contextmanager
+    def phase(self, name: str):
+        started_at = monotonic()
+        yield
+        self.phases[name] = round(monotonic() - started_at, 3)
+        logging.info(f"StartupTimer: {name} took {self.phases[name]:.3f}s")
+
+    def record(self, name: str, value: float) -> None:
+        """Records a measurement that is not a duration, e.g. a memory footprint"""
+        self.values[name] = value
+
+    def summary(self) -> Dict[str, float]:
+        return {**self.phases, **self.values, "total": round(monotonic() - self.started_at, 3)}
+
+def load_assistant(timer: StartupTimer) -> AbstractAssistant:
     if config.WITH_MOCKED_ASSISTANT:
         logging.info("Mocking tokenizer and model")
-        assistant = MockedAssistant()
-    else:
-        logging.info(f"Using model '{config.MODEL_NAME}'")
-        tokenizer = AutoTokenizer.from_pretrained(config.MODEL_NAME)
-        model = AutoModelForCausalLM.from_pretrained(config.MODEL_NAME)
+        return MockedAssistant()
+
+    model_precision = Precision(config.MODEL_PRECISION)
+    embedding_precision = Precision(config.EMBEDDING_PRECISION)
+    embedding_backend = EmbeddingBackend(config.EMBEDDING_BACKEND)
+
+    with timer.phase("import"):
+        import torch  # noqa: F401
+        import transformers  # noqa: F401
+        if embedding_backend == EmbeddingBackend.TORCH:
+            import sentence_transformers  # noqa: F401
+
+    logging.info(f"Using model '{config.MODEL_NAME}' in {model_precision.value}")
+    with timer.phase("load_generation_model"):
+        tokenizer, model = load_generation_model(config.MODEL_NAME, model_precision)
+
+    draft_model = None
+    if config.DRAFT_MODEL_NAME:
+        logging.info(f"Using draft model '{config.DRAFT_MODEL_NAME}' for assisted generation")
+        with timer.phase("load_draft_model"):
+            _, draft_model = load_generation_model(config.DRAFT_MODEL_NAME, model_precision)
+
+    with timer.phase("load_embedding_model"):
         contextualizer = Contextualizer(
             concepts_repository=concepts_repository,
-            system_prompts_repository=system_prompts_repository,
-        )
-        assistant = Assistant(
-            contextualizer=contextualizer,
-            tokenizer=tokenizer,
-            model=model
+            concept_embeddings_repository=concept_embeddings_repository,
+            system_prompts=SystemPromptsCache(
+                system_prompts_repository=system_prompts_repository,
+                # A safety net in case a notification never arrives
+                max_age=10 * config.WORKER_POLL_INTERVAL,
+            ),
+            retriever=ConceptRetriever(
+                ann_threshold=config.CONCEPT_INDEX_ANN_THRESHOLD,
+                nprobe=config.CONCEPT_INDEX_NPROBE,
+            ),
+            encoder=load_encoder(
+                backend=embedding_backend,
+                precision=embedding_precision,
+                onnx_directory=config.EMBEDDING_ONNX_DIR,
+            ),
+            with_lexical_matching=config.WITH_LEXICAL_CONCEPTS,
+            lexical_boost=config.LEXICAL_CONCEPT_BOOST,
         )
 
+    with timer.phase("sanity_check"):
+        timer.record("generation_model_mb", log_footprint("Generation model", model_memory_bytes(model), model_precision))
+        timer.record("embedding_model_mb", log_footprint(f"Embedding model ({embedding_backend.value})", contextualizer.encoder.memory_bytes(), embedding_precision))
+
+        perplexity = generation_perplexity(tokenizer, model, config.DEVICE)
+        margin = embedding_margin(contextualizer.encode)
+        timer.record("generation_perplexity", round(perplexity, 3))
+        timer.record("embedding_margin", round(margin, 3))
+        logging.info(f"Sanity check: generation perplexity {perplexity:.2f}, embedding margin {margin:.3f}")
+        if margin <= 0:
+            logging.warning("Sanity check: the embedding model no longer separates paraphrases from unrelated text")
+
+    with timer.phase("embed_concepts"):
+        # Embed any new or changed concepts before serving the first reply
+        contextualizer.embeddings.refresh()
+
+    return Assistant(
+        contextualizer=contextualizer,
+        tokenizer=tokenizer,
+        model=model,
+        with_prefix_cache=config.WITH_PREFIX_CACHE,
+        draft_model=draft_model,
+        device=config.DEVICE,
+        reply_cache=SemanticReplyCache(
+            max_size=config.REPLY_CACHE_SIZE,
+            ttl=config.REPLY_CACHE_TTL,
+            threshold=config.REPLY_CACHE_THRESHOLD,
+            variants=config.REPLY_CACHE_VARIANTS,
+        ) if config.REPLY_CACHE_SIZE > 0 else None,
+        prompt_token_budget=config.PROMPT_TOKEN_BUDGET or None,
+        max_new_tokens=config.MAX_NEW_TOKENS
+    )
+
+def collect_reply_jobs():
+    REPLY_JOBS.set(messages_repository.count_reply_jobs())
+
+def main():
+    if config.METRICS_PORT > 0:
+        REGISTRY.add_collector(collect_pool_stats(pool))
+        REGISTRY.add_collector(collect_reply_jobs)
+        serve_metrics(config.METRICS_PORT)
+
+    timer = StartupTimer()
+    started_at = datetime.now(timezone.utc)
+    worker = workers_repository.upsert_worker(Worker(
+        id=uuid4(),
+        status=WorkerStatus.STARTING,
+        started_at=started_at,
+        ready_at=None,
+        heartbeat_at=started_at,
+        startup=None
+    ))
+    logging.info(f"Starting worker {worker.id}")
+
+    assistant = load_assistant(timer)
+
+    with timer.phase("warmup"):
+        assistant.warmup()
+
+    ready_at = datetime.now(timezone.utc)
+    worker = workers_repository.upsert_worker(Worker(
+        id=worker.id,
+        status=WorkerStatus.READY,
+        started_at=worker.started_at,
+        ready_at=ready_at,
+        heartbeat_at=ready_at,
+        startup=timer.summary()
+    ))
+    logging.info(f"Worker {worker.id} ready, startup timings: {worker.startup}")
+
     assistant_service = AssistantService(
+        worker_id=worker.id,
         messages_repository=messages_repository,
         concepts_repository=concepts_repository,
+        workers_repository=workers_repository,
         messages_service=messages_service,
-        assistant=assistant
+        assistant=assistant,
+        budget_policy=GenerationBudgetPolicy(
+            max_new_tokens=config.MAX_NEW_TOKENS,
+            min_new_tokens=config.MIN_NEW_TOKENS,
+            target_wait=config.TARGET_REPLY_WAIT,
+            stop_at_sentence=config.STOP_AT_SENTENCE,
+        )
     )
 
-    while True:
-        assistant_service.poll()
-        sleep(2)
+    # Listen before the first poll so that no enqueued reply is missed
+    listener = NotificationListener(
+        config.DATABASE_URL,
+        [REPLY_STATUS_CHANNEL, SYSTEM_PROMPTS_CHANNEL, CONCEPTS_CHANNEL],
+        on_connect=lambda: assistant.invalidate_cache(None)
+    )
+    listener.connect()
+
+    heartbeat = WorkerHeartbeat(
+        workers_repository=workers_repository,
+        worker=worker,
+        interval=config.WORKER_POLL_INTERVAL
+    )
+
+    try:
+        heartbeat.__enter__()
+        if config.PIPELINE_DEPTH > 0:
+            pipeline = ReplyPipeline(
+                assistant_service=assistant_service,
+                listener=listener,
+                depth=config.PIPELINE_DEPTH
+            )
+            pipeline.start()
+            while True:
+                pipeline.next(timeout=config.WORKER_POLL_INTERVAL)
+        else:
+            while True:
+                # Apply cache invalidations that arrived while busy
+                handle_notifications(assistant, listener.wait(timeout=0))
+
+                if assistant_service.poll():
+                    # There may be more replies queued up, check again right away
+                    continue
+                wait_for_enqueued_reply(listener, assistant, config.WORKER_POLL_INTERVAL)
+    finally:
+        heartbeat.__exit__()
+        stopped_at = datetime.now(timezone.utc)
+        workers_repository.upsert_worker(Worker(
+            id=worker.id,
+            status=WorkerStatus.STOPPED,
+            started_at=worker.started_at,
+            ready_at=worker.ready_at,
+            heartbeat_at=stopped_at,
+            startup=worker.startup
+        ))
+
+def handle_notifications(assistant: AbstractAssistant, notifications: List[Notify]) -> bool:
+    """
+    Invalidates caches as announced, returns whether a reply was enqueued
+    """
+    enqueued = False
+    for notification in notifications:
+        if notification.channel == REPLY_STATUS_CHANNEL:
+            changed = ReplyStatusChanged.model_validate_json(notification.payload)
+            enqueued = enqueued or changed.status == ReplyStatus.PENDING
+        else:
+            assistant.invalidate_cache(notification.channel)
+    return enqueued
+
+def wait_for_enqueued_reply(listener: NotificationListener, assistant: AbstractAssistant, timeout: float):
+    """
+    Blocks until a pending reply is inserted or the timeout passes. The
+    timeout makes polling a safety net for missed notifications.
+    """
+    deadline = monotonic() + timeout
+    while (remaining := deadline - monotonic()) > 0:
+        if handle_notifications(assistant, listener.wait(timeout=remaining)):
+            return
 
 
 if __name__ == '__main__':
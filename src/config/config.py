@@ -1,6 +1,10 @@
 import os
+from typing import Tuple
 from uuid import UUID
 
+PRECISIONS = ("fp32", "bf16", "int8")
+EMBEDDING_BACKENDS = ("torch", "onnx")
+
 class Config:
     """
     Configuration settings for the application. Loads settings from environment variables.
@@ -17,6 +21,45 @@ class Config:
     ADMIN_USERNAME: str
     ADMIN_PASSWORD: str
     DEBUG: bool
+    CONCEPT_INDEX_ANN_THRESHOLD: int
+    CONCEPT_INDEX_NPROBE: int
+    STREAM_REPLIES: bool
+    STREAM_FLUSH_INTERVAL: float
+    REPLY_BATCH_SIZE: int
+    REPLY_BATCH_MAX_WAIT: float
+    MAX_PENDING_REPLIES: int
+    WORKER_POLL_INTERVAL: float
+    WITH_REPLY_LISTENER: bool
+    REPLY_POLL_INTERVAL: float
+    REPLY_POLLING_INTERVAL: float
+    REPLY_JOB_LEASE: float
+    REPLY_JOB_MAX_ATTEMPTS: int
+    WITH_PREFIX_CACHE: bool
+    MODEL_PRECISION: str
+    EMBEDDING_PRECISION: str
+    DRAFT_MODEL_NAME: str | None
+    PIPELINE_DEPTH: int
+    REPLY_CACHE_SIZE: int
+    REPLY_CACHE_TTL: float
+    REPLY_CACHE_THRESHOLD: float
+    REPLY_CACHE_VARIANTS: int
+    PROMPT_TOKEN_BUDGET: int
+    HISTORY_MESSAGES: int
+    MAX_NEW_TOKENS: int
+    MIN_NEW_TOKENS: int
+    TARGET_REPLY_WAIT: float
+    STOP_AT_SENTENCE: bool
+    EMBEDDING_BACKEND: str
+    EMBEDDING_ONNX_DIR: str
+    WITH_LEXICAL_CONCEPTS: bool
+    LEXICAL_CONCEPT_BOOST: float
+    CONVERSATION_STATE_REFRESH: float
+    MESSAGES_PAGE_SIZE: int
+    WITH_POSTGRES_MESSAGE_QUEUE: bool
+    REPLY_PUBLISHER_RETRY_INTERVAL: float
+    PRESENCE_TICK: float
+    PRESENCE_GRACE_PERIOD: float
+    METRICS_PORT: int
 
     def __init__(
         self,
@@ -32,7 +75,46 @@ class Config:
         with_mocked_assistant: bool,
         admin_username: str,
         admin_password,
-        debug: bool
+        debug: bool,
+        concept_index_ann_threshold: int,
+        concept_index_nprobe: int,
+        stream_replies: bool,
+        stream_flush_interval: float,
+        reply_batch_size: int,
+        reply_batch_max_wait: float,
+        max_pending_replies: int,
+        worker_poll_interval: float,
+        with_reply_listener: bool,
+        reply_poll_interval: float,
+        reply_polling_interval: float,
+        reply_job_lease: float,
+        reply_job_max_attempts: int,
+        with_prefix_cache: bool,
+        model_precision: str,
+        embedding_precision: str,
+        draft_model_name: str | None,
+        pipeline_depth: int,
+        reply_cache_size: int,
+        reply_cache_ttl: float,
+        reply_cache_threshold: float,
+        reply_cache_variants: int,
+        prompt_token_budget: int,
+        history_messages: int,
+        max_new_tokens: int,
+        min_new_tokens: int,
+        target_reply_wait: float,
+        stop_at_sentence: bool,
+        embedding_backend: str,
+        embedding_onnx_dir: str,
+        with_lexical_concepts: bool,
+        lexical_concept_boost: float,
+        conversation_state_refresh: float,
+        messages_page_size: int,
+        with_postgres_message_queue: bool,
+        reply_publisher_retry_interval: float,
+        presence_tick: float,
+        presence_grace_period: float,
+        metrics_port: int
     ):
         """Loads configuration from environment variables."""
         self.DATABASE_URL = database_url
@@ -47,6 +129,45 @@ class Config:
         self.ADMIN_USERNAME = admin_username
         self.ADMIN_PASSWORD = admin_password
         self.DEBUG = debug
+        self.CONCEPT_INDEX_ANN_THRESHOLD = concept_index_ann_threshold
+        self.CONCEPT_INDEX_NPROBE = concept_index_nprobe
+        self.STREAM_REPLIES = stream_replies
+        self.STREAM_FLUSH_INTERVAL = stream_flush_interval
+        self.REPLY_BATCH_SIZE = reply_batch_size
+        self.REPLY_BATCH_MAX_WAIT = reply_batch_max_wait
+        self.MAX_PENDING_REPLIES = max_pending_replies
+        self.WORKER_POLL_INTERVAL = worker_poll_interval
+        self.WITH_REPLY_LISTENER = with_reply_listener
+        self.REPLY_POLL_INTERVAL = reply_poll_interval
+        self.REPLY_POLLING_INTERVAL = reply_polling_interval
+        self.REPLY_JOB_LEASE = reply_job_lease
+        self.REPLY_JOB_MAX_ATTEMPTS = reply_job_max_attempts
+        self.WITH_PREFIX_CACHE = with_prefix_cache
+        self.MODEL_PRECISION = model_precision
+        self.EMBEDDING_PRECISION = embedding_precision
+        self.DRAFT_MODEL_NAME = draft_model_name
+        self.PIPELINE_DEPTH = pipeline_depth
+        self.REPLY_CACHE_SIZE = reply_cache_size
+        self.REPLY_CACHE_TTL = reply_cache_ttl
+        self.REPLY_CACHE_THRESHOLD = reply_cache_threshold
+        self.REPLY_CACHE_VARIANTS = reply_cache_variants
+        self.PROMPT_TOKEN_BUDGET = prompt_token_budget
+        self.HISTORY_MESSAGES = history_messages
+        self.MAX_NEW_TOKENS = max_new_tokens
+        self.MIN_NEW_TOKENS = min_new_tokens
+        self.TARGET_REPLY_WAIT = target_reply_wait
+        self.STOP_AT_SENTENCE = stop_at_sentence
+        self.EMBEDDING_BACKEND = embedding_backend
+        self.EMBEDDING_ONNX_DIR = embedding_onnx_dir
+        self.WITH_LEXICAL_CONCEPTS = with_lexical_concepts
+        self.LEXICAL_CONCEPT_BOOST = lexical_concept_boost
+        self.CONVERSATION_STATE_REFRESH = conversation_state_refresh
+        self.MESSAGES_PAGE_SIZE = messages_page_size
+        self.WITH_POSTGRES_MESSAGE_QUEUE = with_postgres_message_queue
+        self.REPLY_PUBLISHER_RETRY_INTERVAL = reply_publisher_retry_interval
+        self.PRESENCE_TICK = presence_tick
+        self.PRESENCE_GRACE_PERIOD = presence_grace_period
+        self.METRICS_PORT = metrics_port
 
     @staticmethod
     def new_from_env():
@@ -63,6 +184,64 @@ class Config:
         admin_username = Config._get_required_env_var("ADMIN_USERNAME")
         admin_password = Config._get_required_env_var("ADMIN_PASSWORD")
         debug = Config._get_required_env_var("DEBUG")
+        concept_index_ann_threshold = Config._get_optional_env_var("CONCEPT_INDEX_ANN_THRESHOLD", "10000")
+        concept_index_nprobe = Config._get_optional_env_var("CONCEPT_INDEX_NPROBE", "8")
+        stream_replies = Config._get_optional_env_var("STREAM_REPLIES", "false")
+        stream_flush_interval = Config._get_optional_env_var("STREAM_FLUSH_INTERVAL", "0.1")
+        reply_batch_size = Config._get_optional_env_var("REPLY_BATCH_SIZE", "1")
+        reply_batch_max_wait = Config._get_optional_env_var("REPLY_BATCH_MAX_WAIT", "0")
+        max_pending_replies = Config._get_optional_env_var("MAX_PENDING_REPLIES", "1")
+        worker_poll_interval = Config._get_optional_env_var("WORKER_POLL_INTERVAL", "30")
+        with_reply_listener = Config._get_optional_env_var("WITH_REPLY_LISTENER", "true")
+        # Seconds between fallback polls while listening for replies
+        reply_poll_interval = Config._get_optional_env_var("REPLY_POLL_INTERVAL", "30")
+        # Seconds between polls with WITH_REPLY_LISTENER=false
+        reply_polling_interval = Config._get_optional_env_var("REPLY_POLLING_INTERVAL", "2")
+        reply_job_lease = Config._get_optional_env_var("REPLY_JOB_LEASE", "60")
+        reply_job_max_attempts = Config._get_optional_env_var("REPLY_JOB_MAX_ATTEMPTS", "3")
+        with_prefix_cache = Config._get_optional_env_var("WITH_PREFIX_CACHE", "true")
+        model_precision = Config._get_optional_env_var("MODEL_PRECISION", "fp32")
+        embedding_precision = Config._get_optional_env_var("EMBEDDING_PRECISION", "fp32")
+        # A smaller model sharing MODEL_ID's tokenizer, e.g. HuggingFaceTB/SmolLM2-135M-Instruct
+        draft_model_name = Config._get_optional_env_var("DRAFT_MODEL_ID", "")
+        # Number of prompts prepared ahead of generation, 0 replies serially
+        pipeline_depth = Config._get_optional_env_var("PIPELINE_DEPTH", "0")
+        # Number of replies kept for near-duplicate messages, 0 disables the cache
+        reply_cache_size = Config._get_optional_env_var("REPLY_CACHE_SIZE", "0")
+        reply_cache_ttl = Config._get_optional_env_var("REPLY_CACHE_TTL", "3600")
+        # Minimum cosine similarity of two messages to share a reply
+        reply_cache_threshold = Config._get_optional_env_var("REPLY_CACHE_THRESHOLD", "0.95")
+        reply_cache_variants = Config._get_optional_env_var("REPLY_CACHE_VARIANTS", "1")
+        # Upper bound on the prompt length in tokens, 0 for no bound
+        prompt_token_budget = Config._get_optional_env_var("PROMPT_TOKEN_BUDGET", "1024")
+        # Number of preceding messages considered for the prompt
+        history_messages = Config._get_optional_env_var("HISTORY_MESSAGES", "10")
+        max_new_tokens = Config._get_optional_env_var("MAX_NEW_TOKENS", "250")
+        min_new_tokens = Config._get_optional_env_var("MIN_NEW_TOKENS", "48")
+        # Seconds the last queued reply should wait at most, 0 never shortens replies
+        target_reply_wait = Config._get_optional_env_var("TARGET_REPLY_WAIT", "0")
+        stop_at_sentence = Config._get_optional_env_var("STOP_AT_SENTENCE", "false")
+        # torch or onnx, the latter requires onnxruntime
+        embedding_backend = Config._get_optional_env_var("EMBEDDING_BACKEND", "torch")
+        # Where the ONNX export of the embedding model is kept
+        embedding_onnx_dir = Config._get_optional_env_var("EMBEDDING_ONNX_DIR", "models")
+        with_lexical_concepts = Config._get_optional_env_var("WITH_LEXICAL_CONCEPTS", "true")
+        # Added to the similarity of concepts whose term the message mentions
+        lexical_concept_boost = Config._get_optional_env_var("LEXICAL_CONCEPT_BOOST", "0.2")
+        # Seconds between reloads of the web process' conversation state, 0 never reloads
+        conversation_state_refresh = Config._get_optional_env_var("CONVERSATION_STATE_REFRESH", "300")
+        # Messages rendered with the chat page and loaded per scroll into the history
+        messages_page_size = Config._get_optional_env_var("MESSAGES_PAGE_SIZE", "50")
+        # Shares Socket.IO emits between web processes, required with more than one
+        with_postgres_message_queue = Config._get_optional_env_var("WITH_POSTGRES_MESSAGE_QUEUE", "false")
+        # Seconds between attempts of a web process to become the reply publisher
+        reply_publisher_retry_interval = Config._get_optional_env_var("REPLY_PUBLISHER_RETRY_INTERVAL", "5")
+        # Seconds over which joins and leaves are collected into one broadcast
+        presence_tick = Config._get_optional_env_var("PRESENCE_TICK", "1")
+        # Seconds users connected before a restart have to reconnect before their sessions are closed
+        presence_grace_period = Config._get_optional_env_var("PRESENCE_GRACE_PERIOD", "30")
+        # Port of the worker's /metrics listener, 0 does not serve metrics
+        metrics_port = Config._get_optional_env_var("METRICS_PORT", "0")
 
         return Config(
             database_url=database_url,
@@ -76,7 +255,46 @@ class Config:
             with_mocked_assistant=with_mocked_assistant.lower() == 'true',
             admin_username=admin_username,
             admin_password=admin_password,
-            debug = debug.lower() == 'true'
+            debug = debug.lower() == 'true',
+            concept_index_ann_threshold=int(concept_index_ann_threshold),
+            concept_index_nprobe=int(concept_index_nprobe),
+            stream_replies=stream_replies.lower() == 'true',
+            stream_flush_interval=float(stream_flush_interval),
+            reply_batch_size=int(reply_batch_size),
+            reply_batch_max_wait=float(reply_batch_max_wait),
+            max_pending_replies=int(max_pending_replies),
+            worker_poll_interval=float(worker_poll_interval),
+            with_reply_listener=with_reply_listener.lower() == 'true',
+            reply_poll_interval=float(reply_poll_interval),
+            reply_polling_interval=float(reply_polling_interval),
+            reply_job_lease=float(reply_job_lease),
+            reply_job_max_attempts=int(reply_job_max_attempts),
+            with_prefix_cache=with_prefix_cache.lower() == 'true',
+            model_precision=Config._get_choice("MODEL_PRECISION", model_precision, PRECISIONS),
+            embedding_precision=Config._get_choice("EMBEDDING_PRECISION", embedding_precision, PRECISIONS),
+            draft_model_name=draft_model_name or None,
+            pipeline_depth=int(pipeline_depth),
+            reply_cache_size=int(reply_cache_size),
+            reply_cache_ttl=float(reply_cache_ttl),
+            reply_cache_threshold=float(reply_cache_threshold),
+            reply_cache_variants=int(reply_cache_variants),
+            prompt_token_budget=int(prompt_token_budget),
+            history_messages=int(history_messages),
+            max_new_tokens=int(max_new_tokens),
+            min_new_tokens=int(min_new_tokens),
+            target_reply_wait=float(target_reply_wait),
+            stop_at_sentence=stop_at_sentence.lower() == 'true',
+            embedding_backend=Config._get_choice("EMBEDDING_BACKEND", embedding_backend, EMBEDDING_BACKENDS),
+            embedding_onnx_dir=embedding_onnx_dir,
+            with_lexical_concepts=with_lexical_concepts.lower() == 'true',
+            lexical_concept_boost=float(lexical_concept_boost),
+            conversation_state_refresh=float(conversation_state_refresh),
+            messages_page_size=int(messages_page_size),
+            with_postgres_message_queue=with_postgres_message_queue.lower() == 'true',
+            reply_publisher_retry_interval=float(reply_publisher_retry_interval),
+            presence_tick=float(presence_tick),
+            presence_grace_period=float(presence_grace_period),
+            metrics_port=int(metrics_port)
         )
 
     @staticmethod
@@ -86,3 +304,19 @@ class Config:
         if not value:
             raise ValueError(f"Environment variable '{var_name}' not set")
         return value
+
+    @staticmethod
+    def _get_optional_env_var(var_name: str, default: str) -> str:
+        """Helper to get optional environment variables, falling back to a default."""
+        value = os.environ.get(var_name)
+        if not value:
+            return default
+        return value
+
+    @staticmethod
+    def _get_choice(var_name: str, value: str, choices: Tuple[str, ...]) -> str:
+        """Helper to check that an environment variable is one of the allowed values."""
+        value = value.lower()
+        if value not in choices:
+            raise ValueError(f"Environment variable '{var_name}' must be one of {', '.join(choices)}")
+        return value
@@ -0,0 +1,154 @@
+import logging
+from collections import deque
+from threading import Lock
+from typing import Any, Deque, Dict, List
+from uuid import UUID
+from src.models import Message, ProcessPresence, ReplyingTo, ReplyStatus, User
+from src.repositories.messages import MessagesRepository
+from src.repositories.users import UserNotFoundError, UsersRepository
+from src.presence import PresenceRegistry
+
+class ConversationSnapshot:
+    messages: List[Message]
+    users_of_conversation: List[User]
+    connected_user_ids: List[UUID]
+    replying_to: ReplyingTo | None
+
+    def __init__(
+        self, *,
+        messages: List[Message],
+        users_of_conversation: List[User],
+        connected_user_ids: List[UUID],
+        replying_to: ReplyingTo | None
+    ):
+        self.messages = messages
+        self.users_of_conversation = users_of_conversation
+        self.connected_user_ids = connected_user_ids
+        self.replying_to = replying_to
+
+class ConversationState:
+    """
+    What the chat page shows of the conversation, kept in memory by the web
+    process: the most recent messages, the users who took part, who is
+    connected and who is being replied to. It is primed from the database
+    once and then updated by the same events that are emitted to the room,
+    so rendering the page does not query the database. Who is connected is
+    taken from the presence registry.
+    """
+    conversation_id: UUID
+    assistant_user_id: UUID
+    messages_repository: MessagesRepository
+    users_repository: UsersRepository
+    presence: PresenceRegistry
+    messages: Deque[Message]
+    users: Dict[UUID, User]
+    participant_ids: set[UUID]
+    replying_to: ReplyingTo | None
+    primed: bool
+    lock: Lock
+
+    def __init__(
+        self, *,
+        conversation_id: UUID,
+        assistant_user_id: UUID,
+        messages_repository: MessagesRepository,
+        users_repository: UsersRepository,
+        presence: PresenceRegistry,
+        max_messages: int = 100
+    ):
+        self.conversation_id = conversation_id
+        self.assistant_user_id = assistant_user_id
+        self.messages_repository = messages_repository
+        self.users_repository = users_repository
+        self.presence = presence
+        self.messages = deque(maxlen=max_messages)
+        self.users = {}
+        self.participant_ids = set()
+        self.replying_to = None
+        self.primed = False
+        self.lock = Lock()
+
+    def prime(self) -> None:
+        """
+        Loads the state from the database, replacing what is held in memory
+        """
+        messages = self.messages_repository.get_messages(
+            conversation_id=self.conversation_id,
+            limit=self.messages.maxlen or 100
+        )
+
+        participant_ids = set(self.messages_repository.get_user_ids_of_conversation(conversation_id=self.conversation_id))
+        participant_ids.add(self.assistant_user_id)
+        users = self.users_repository.get_users_by_id(list(participant_ids))
+
+        replying_to: ReplyingTo | None = None
+        replies_in_progress = self.messages_repository.get_replies(
+            status=[ReplyStatus.PENDING],
+            message_id=None,
+            limit=1
+        )
+        if replies_in_progress:
+            message = self.messages_repository.get_message(message_id=replies_in_progress[0].message_id)
+            replying_to = ReplyingTo(user_id=message.user_id)
+
+        with self.lock:
+            self.messages.clear()
+            self.messages.extend(messages)
+            self.users = {u.id: u for u in users}
+            self.participant_ids = participant_ids
+            self.replying_to = replying_to
+            self.primed = True
+
+        logging.info(f"ConversationState.prime: {len(messages)} messages, {len(participant_ids)} participants")
+
+    def add_message(self, message: Message) -> None:
+        with self.lock:
+            self.messages.append(message)
+            if message.user_id in self.participant_ids:
+                return
+
+        # Users are normally known from connecting before they send anything
+        user = self.presence.get_user(message.user_id) or self._get_user(message.user_id)
+        with self.lock:
+            self.participant_ids.add(message.user_id)
+            if user:
+                self.users[user.id] = user
+
+    def set_replying_to(self, replying_to: ReplyingTo) -> None:
+        with self.lock:
+            self.replying_to = replying_to if replying_to.user_id else None
+
+    def apply(self, event: str, data: Any) -> None:
+        """
+        Applies an event emitted by another web process
+        """
+        if event == 'message_created':
+            self.add_message(Message.model_validate(data))
+        elif event == 'replying_to':
+            self.set_replying_to(ReplyingTo.model_validate(data))
+        elif event == 'process_presence':
+            self.presence.apply_process_presence(ProcessPresence.model_validate(data))
+
+    def snapshot(self) -> ConversationSnapshot:
+        if not self.primed:
+            self.prime()
+
+        with self.lock:
+            return ConversationSnapshot(
+                messages=list(self.messages),
+                users_of_conversation=[self.users[id] for id in self.participant_ids if id in self.users],
+                connected_user_ids=self.presence.connected_user_ids(),
+                replying_to=self.replying_to
+            )
+
+    def _get_user(self, user_id: UUID) -> User | None:
+        with self.lock:
+            user = self.users.get(user_id)
+        if user:
+            return user
+
+        try:
+            return self.users_repository.get_user(user_id)
+        except UserNotFoundError:
+            logging.error(f"ConversationState: user {user_id} of a message could not be found")
+            return None
@@ -0,0 +1,148 @@
+import logging
+from datetime import datetime
+from typing import Callable, Dict, List, Protocol, Tuple
+from uuid import UUID
+import numpy as np
+from numpy import ndarray
+from src.models import Concept, ConceptEmbedding
+
+ConceptKey = Tuple[UUID, datetime]
+
+class ConceptsSource(Protocol):
+    """
+    What the store reads of the concepts, implemented by ConceptsRepository
+    """
+    def get_concepts(self) -> List[Concept]: ...
+
+    def get_concepts_version(self) -> Tuple[int, datetime | None]: ...
+
+class ConceptEmbeddingsSource(Protocol):
+    """
+    Where the store persists embeddings, implemented by
+    ConceptEmbeddingsRepository
+    """
+    def get_concept_embeddings(
+        self, *,
+        model: str,
+        keys: List[Tuple[UUID, datetime]]
+    ) -> List[ConceptEmbedding]: ...
+
+    def insert_concept_embeddings(self, embeddings: List[ConceptEmbedding]) -> None: ...
+
+class ConceptEmbeddingStore:
+    """
+    Keeps the embeddings of the latest concepts in memory as a contiguous,
+    row-normalized float32 matrix. Embeddings are keyed by concept id, record
+    timestamp and embedding model, persisted to the database and only
+    computed for concept records that have not been embedded before.
+    """
+    model_name: str
+    encode: Callable[[List[str]], ndarray]
+    concepts_repository: ConceptsSource
+    concept_embeddings_repository: ConceptEmbeddingsSource
+    concepts: List[Concept]
+    matrix: ndarray
+    version: Tuple[int, datetime | None] | None
+    stale: bool
+    vectors: Dict[ConceptKey, ndarray]
+
+    def __init__(
+        self, *,
+        model_name: str,
+        encode: Callable[[List[str]], ndarray],
+        concepts_repository: ConceptsSource,
+        concept_embeddings_repository: ConceptEmbeddingsSource,
+    ):
+        self.model_name = model_name
+        self.encode = encode
+        self.concepts_repository = concepts_repository
+        self.concept_embeddings_repository = concept_embeddings_repository
+        self.concepts = []
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self.version = None
+        self.stale = True
+        self.vectors = {}
+
+    def invalidate(self) -> None:
+        """
+        Marks the store as possibly out of date, the next refresh checks
+        the database for changes.
+        """
+        self.stale = True
+
+    def refresh(self) -> None:
+        """
+        Brings the in-memory matrix up to date with the latest concepts.
+        This is free unless the store has been invalidated, and a single
+        cheap query when nothing has changed.
+        """
+        if not self.stale:
+            return
+
+        # Cleared before reading, so an invalidation during the refresh is kept
+        self.stale = False
+        try:
+            version = self.concepts_repository.get_concepts_version()
+            if version == self.version:
+                return
+
+            concepts = self.concepts_repository.get_concepts()
+            self.sync(concepts)
+            self.version = version
+        except Exception:
+            self.stale = True
+            raise
+
+    def sync(self, concepts: List[Concept]) -> None:
+        """
+        Rebuilds the matrix for the given concepts, loading stored embeddings
+        and encoding only those concept records that have none.
+        """
+        missing = [c for c in concepts if (c.id, c.timestamp) not in self.vectors]
+
+        if missing:
+            stored = self.concept_embeddings_repository.get_concept_embeddings(
+                model=self.model_name,
+                keys=[(c.id, c.timestamp) for c in missing]
+            )
+            for e in stored:
+                self.vectors[(e.concept_id, e.timestamp)] = np.frombuffer(e.embedding, dtype=np.float32)
+
+            to_encode = [c for c in missing if (c.id, c.timestamp) not in self.vectors]
+            if to_encode:
+                logging.info(f"ConceptEmbeddingStore.sync: encoding {len(to_encode)} of {len(concepts)} concepts")
+                encoded = normalize(self.encode([c.meaning for c in to_encode]))
+
+                records: List[ConceptEmbedding] = []
+                for c, vector in zip(to_encode, encoded):
+                    self.vectors[(c.id, c.timestamp)] = vector
+                    records.append(ConceptEmbedding(
+                        concept_id=c.id,
+                        timestamp=c.timestamp,
+                        model=self.model_name,
+                        embedding=vector.tobytes()
+                    ))
+                self.concept_embeddings_repository.insert_concept_embeddings(records)
+
+        # Drop embeddings of concept records that are no longer current
+        keys = {(c.id, c.timestamp) for c in concepts}
+        self.vectors = {k: v for k, v in self.vectors.items() if k in keys}
+
+        self.concepts = list(concepts)
+        if concepts:
+            self.matrix = np.ascontiguousarray(
+                np.stack([self.vectors[(c.id, c.timestamp)] for c in concepts]),
+                dtype=np.float32
+            )
+        else:
+            self.matrix = np.empty((0, 0), dtype=np.float32)
+
+def normalize(embeddings: ndarray) -> ndarray:
+    """
+    Casts embeddings to float32 and scales each row to unit length, so
+    cosine similarity reduces to a dot product.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return embeddings / norms
@@ -0,0 +1,223 @@
+import abc
+import enum
+import logging
+import os
+from typing import TYPE_CHECKING, Any, List
+import numpy as np
+from numpy import ndarray
+from src.embeddings import normalize
+from src.precision import EMBEDDING_SANITY_CHECK, Precision, embedding_parity, model_memory_bytes, quantize_if_int8, torch_dtype
+
+# torch and sentence_transformers are only needed by the torch backend, and
+# onnxruntime only by the onnx backend, so they are imported where used.
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+EMBEDDING_MODEL_NAME = "thenlper/gte-small"
+
+class EmbeddingBackend(enum.Enum):
+    TORCH = "torch"
+    ONNX = "onnx"
+
+class AbstractEncoder(abc.ABC):
+    # Identifies the embeddings the encoder produces. Embeddings of different
+    # backends and precisions differ slightly, so they are stored separately.
+    name: str
+
+    @abc.abstractmethod
+    def encode(self, texts: List[str]) -> ndarray:
+        """
+        Row-normalized float32 embeddings of the texts
+        """
+        pass
+
+    @abc.abstractmethod
+    def memory_bytes(self) -> int:
+        """
+        Size of the model's weights
+        """
+        pass
+
+class SentenceTransformerEncoder(AbstractEncoder):
+    model: "SentenceTransformer"
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL_NAME, precision: Precision = Precision.FP32):
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name)
+        if precision == Precision.BF16:
+            model = model.to(torch_dtype(precision))
+        self.model = quantize_if_int8(model, precision)
+
+        self.name = model_name
+        if precision != Precision.FP32:
+            self.name = f"{model_name}@{precision.value}"
+
+    def encode(self, texts: List[str]) -> ndarray:
+        embeddings = self.model.encode(
+            texts,
+            normalize_embeddings=True,
+            convert_to_tensor=True
+        )
+        # bf16 tensors can not be converted to numpy directly
+        return embeddings.float().cpu().numpy()
+
+    def memory_bytes(self) -> int:
+        return model_memory_bytes(self.model)
+
+def import_onnxruntime() -> Any:
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError("EMBEDDING_BACKEND=onnx requires onnxruntime, install it with `pip install onnxruntime`") from e
+    return onnxruntime
+
+class OnnxEncoder(AbstractEncoder):
+    """
+    Runs an ONNX export of the embedding model with ONNX Runtime, so neither
+    torch nor sentence_transformers are needed to encode. Pools like the
+    sentence transformers configuration of gte-small: the mean of the token
+    embeddings, then normalized. Texts are encoded in batches of similar
+    length to keep padding down.
+    """
+    path: str
+    batch_size: int
+    tokenizer: Any
+    session: Any
+    input_names: List[str]
+
+    def __init__(
+        self, *,
+        path: str,
+        model_name: str = EMBEDDING_MODEL_NAME,
+        quantized: bool = False,
+        batch_size: int = 32,
+        max_length: int = 512,
+        threads: int = 0
+    ):
+        onnxruntime = import_onnxruntime()
+        from tokenizers import Tokenizer
+
+        self.path = path
+        self.batch_size = batch_size
+        self.name = f"{model_name}@onnx-int8" if quantized else f"{model_name}@onnx"
+
+        self.tokenizer = Tokenizer.from_pretrained(model_name)
+        self.tokenizer.enable_truncation(max_length)
+        self.tokenizer.enable_padding()
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def encode(self, texts: List[str]) -> ndarray:
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+
+        order = np.argsort([len(t) for t in texts], kind='stable')
+        pooled: List[ndarray] = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = [texts[i] for i in order[start:start + self.batch_size]]
+            pooled.append(self._encode_batch(batch))
+
+        embeddings = np.empty((len(texts), pooled[0].shape[1]), dtype=np.float32)
+        embeddings[order] = np.concatenate(pooled)
+        return normalize(embeddings)
+
+    def _encode_batch(self, texts: List[str]) -> ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        attention_mask = np.array([e.attention_mask for e in encodings], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": attention_mask,
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+
+        hidden = self.session.run(None, {n: inputs[n] for n in self.input_names})[0]
+
+        mask = attention_mask[:, :, None].astype(np.float32)
+        return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def memory_bytes(self) -> int:
+        return os.path.getsize(self.path)
+
+def onnx_model_path(directory: str, model_name: str, quantized: bool) -> str:
+    suffix = "-int8" if quantized else ""
+    return os.path.join(directory, f"{model_name.replace('/', '--')}{suffix}.onnx")
+
+def export_onnx(model_name: str, path: str, quantized: bool) -> None:
+    """
+    Exports the transformer of the embedding model to ONNX, with dynamic
+    batch and sequence axes, and optionally quantizes its weights to int8.
+    Needs torch and transformers, but only once per model.
+    """
+    import torch
+    from transformers.models.auto.tokenization_auto import AutoTokenizer
+    from transformers.models.auto.modeling_auto import AutoModel
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    # In the order of the model's forward arguments
+    example = tokenizer(["An example sentence."], return_tensors="pt")
+    names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in example]
+    dynamic_axes = {n: {0: "batch", 1: "sequence"} for n in names + ["last_hidden_state"]}
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    export_path = f"{path}.fp32" if quantized else path
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(example[n] for n in names),
+            export_path,
+            input_names=names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+
+    if quantized:
+        import_onnxruntime()
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(export_path, path, weight_type=QuantType.QInt8)
+        os.remove(export_path)
+
+    logging.info(f"export_onnx: exported '{model_name}' to {path}")
+
+def load_encoder(
+    *,
+    backend: EmbeddingBackend,
+    precision: Precision,
+    onnx_directory: str,
+    model_name: str = EMBEDDING_MODEL_NAME
+) -> AbstractEncoder:
+    """
+    Loads the embedding model for the backend. The ONNX model is exported on
+    first use and checked against the sentence transformers embeddings.
+    """
+    if backend == EmbeddingBackend.TORCH:
+        return SentenceTransformerEncoder(model_name, precision)
+
+    if precision == Precision.BF16:
+        raise ValueError("EMBEDDING_BACKEND=onnx supports the fp32 and int8 precisions")
+
+    quantized = precision == Precision.INT8
+    path = onnx_model_path(onnx_directory, model_name, quantized)
+    if os.path.exists(path):
+        return OnnxEncoder(path=path, model_name=model_name, quantized=quantized)
+
+    export_onnx(model_name, path, quantized)
+    encoder = OnnxEncoder(path=path, model_name=model_name, quantized=quantized)
+
+    parity = embedding_parity(
+        SentenceTransformerEncoder(model_name).encode(list(EMBEDDING_SANITY_CHECK)),
+        encoder.encode(list(EMBEDDING_SANITY_CHECK))
+    )
+    logging.info(f"load_encoder: ONNX embeddings match sentence transformers with a cosine similarity of at least {parity:.4f}")
+    if parity < 0.99:
+        logging.warning(f"load_encoder: ONNX embeddings deviate from sentence transformers (min cosine similarity {parity:.4f})")
+
+    return encoder
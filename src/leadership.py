@@ -0,0 +1,82 @@
+import logging
+from time import monotonic
+import psycopg
+
+TRY_ADVISORY_LOCK = """
+SELECT pg_try_advisory_lock(%s);
+"""
+
+class AdvisoryLock:
+    """
+    Elects a single leader among processes with a session level Postgres
+    advisory lock, held on a dedicated connection. Postgres releases the lock
+    when that connection ends, so when the leader dies or loses its database
+    connection another process takes over.
+    """
+    database_url: str
+    key: int
+    check_interval: float
+    conn: psycopg.Connection | None
+    checked_at: float
+
+    def __init__(self, database_url: str, key: int, check_interval: float = 5):
+        self.database_url = database_url
+        self.key = key
+        self.check_interval = check_interval
+        self.conn = None
+        self.checked_at = 0
+
+    def try_acquire(self) -> bool:
+        """
+        Takes the lock if no other process holds it. Returns whether this
+        process holds it.
+        """
+        if self.conn is not None:
+            return self.is_held()
+
+        try:
+            conn = psycopg.connect(self.database_url, autocommit=True)
+            acquired = conn.execute(TRY_ADVISORY_LOCK, (self.key, )).fetchone()
+        except psycopg.OperationalError as e:
+            logging.error(f"AdvisoryLock.try_acquire: could not connect, {e}")
+            return False
+
+        if not acquired or not acquired[0]:
+            conn.close()
+            return False
+
+        self.conn = conn
+        self.checked_at = monotonic()
+        return True
+
+    def is_held(self) -> bool:
+        """
+        Whether the lock is still held. The connection is checked at most
+        every `check_interval` seconds, so a process may briefly act as the
+        leader after losing the lock. Leaders must not rely on it alone to
+        avoid doing the same work twice.
+        """
+        if self.conn is None:
+            return False
+        if monotonic() - self.checked_at < self.check_interval:
+            return True
+
+        try:
+            self.conn.execute("SELECT 1;")
+        except psycopg.OperationalError as e:
+            logging.error(f"AdvisoryLock.is_held: lost the connection holding lock {self.key}, {e}")
+            self.release()
+            return False
+
+        self.checked_at = monotonic()
+        return True
+
+    def release(self) -> None:
+        """
+        Releases the lock by closing its connection
+        """
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            finally:
+                self.conn = None
@@ -0,0 +1,113 @@
+import logging
+import re
+import unicodedata
+from datetime import datetime
+from typing import Dict, List, Tuple
+from uuid import UUID
+from src.models import Concept
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+Term = Tuple[str, ...]
+
+def normalize_token(token: str) -> str:
+    """
+    Lowercases, strips accents and folds simple plurals, so that "Cafés"
+    matches the term "cafe"
+    """
+    token = unicodedata.normalize("NFKD", token.lower())
+    token = "".join(c for c in token if not unicodedata.combining(c))
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        token = token[:-1]
+    return token
+
+def tokenize(text: str) -> List[str]:
+    return [normalize_token(t) for t in TOKEN_PATTERN.findall(text)]
+
+class LexicalConceptMatcher:
+    """
+    Finds mentions of concept terms in a message with an inverted index from
+    the first token of each term to the terms starting with it, so matching
+    costs a dictionary lookup per message token.
+
+    The index is updated incrementally: only concept records that changed
+    since the last update are tokenized.
+    """
+    terms: Dict[UUID, Tuple[datetime, Term]]
+    index: Dict[str, Dict[UUID, Term]]
+    positions: Dict[UUID, int]
+    concepts: List[Concept] | None
+
+    def __init__(self):
+        self.terms = {}
+        self.index = {}
+        self.positions = {}
+        self.concepts = None
+
+    def update(self, concepts: List[Concept]) -> None:
+        """
+        Brings the index up to date with the concepts. Matches are reported
+        as positions in this list.
+        """
+        if concepts is self.concepts:
+            return
+
+        current = {c.id: c for c in concepts}
+        removed = [id for id in self.terms if id not in current]
+        changed = [c for c in concepts if c.id not in self.terms or self.terms[c.id][0] != c.timestamp]
+
+        for id in removed:
+            self._remove(id)
+        for c in changed:
+            self._remove(c.id)
+            term = tuple(tokenize(c.concept))
+            self.terms[c.id] = (c.timestamp, term)
+            if term:
+                self.index.setdefault(term[0], {})[c.id] = term
+
+        self.positions = {c.id: i for i, c in enumerate(concepts)}
+        self.concepts = concepts
+        if removed or changed:
+            logging.info(f"LexicalConceptMatcher.update: {len(changed)} changed and {len(removed)} removed of {len(concepts)} concepts")
+
+    def _remove(self, id: UUID) -> None:
+        entry = self.terms.pop(id, None)
+        if entry is None or not entry[1]:
+            return
+
+        first = entry[1][0]
+        terms = self.index.get(first)
+        if terms is not None:
+            terms.pop(id, None)
+            if not terms:
+                del self.index[first]
+
+    def match(self, message: str) -> List[int]:
+        """
+        Positions of the concepts whose terms occur in the message, in order
+        of first occurrence. Longer terms are preferred where terms overlap.
+        """
+        tokens = tokenize(message)
+        matched: List[int] = []
+        seen = set()
+
+        i = 0
+        while i < len(tokens):
+            candidates = [
+                (id, len(term))
+                for id, term in self.index.get(tokens[i], {}).items()
+                if tuple(tokens[i:i + len(term)]) == term
+            ]
+            if not candidates:
+                i += 1
+                continue
+
+            # Concepts may share a term
+            length = max(n for _, n in candidates)
+            for id, n in candidates:
+                if n == length and id not in seen:
+                    seen.add(id)
+                    matched.append(self.positions[id])
+            i += length
+
+        return matched
@@ -0,0 +1,86 @@
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from time import monotonic
+from typing import Any, Callable, Dict, Iterator
+import socketio
+from src.notifications import NotificationListener, SOCKETIO_CHANNEL
+from src.repositories.notifications import MAX_PAYLOAD_BYTES, NotificationsRepository
+
+class PostgresManager(socketio.PubSubManager):
+    """
+    Shares emits, room changes and disconnects between the web processes
+    over Postgres LISTEN/NOTIFY, like the Redis manager of python-socketio
+    does over Redis. Every process emits to its own clients and forwards the
+    message to the others.
+
+    Messages that do not fit in a notification are stored in the
+    socketio_outbox table and the notification refers to the row. Rows are
+    deleted once they are `outbox_retention` seconds old.
+
+    `on_remote_emit` is called with the event and data of every emit that
+    reached this process from another one.
+    """
+    name = 'postgres'
+
+    database_url: str
+    notifications_repository: NotificationsRepository
+    outbox_retention: float
+    wait_timeout: float
+    on_remote_emit: Callable[[str, Any], None] | None
+    purged_at: float
+
+    def __init__(
+        self, *,
+        database_url: str,
+        notifications_repository: NotificationsRepository,
+        channel: str = SOCKETIO_CHANNEL,
+        outbox_retention: float = 60,
+        wait_timeout: float = 30,
+        on_remote_emit: Callable[[str, Any], None] | None = None,
+        write_only: bool = False
+    ):
+        super().__init__(channel=channel, write_only=write_only, logger=logging.getLogger(__name__))
+        self.database_url = database_url
+        self.notifications_repository = notifications_repository
+        self.outbox_retention = outbox_retention
+        self.wait_timeout = wait_timeout
+        self.on_remote_emit = on_remote_emit
+        self.purged_at = monotonic()
+
+    def _publish(self, data: Dict[str, Any]) -> None:
+        payload = json.dumps(data)
+        if len(payload.encode()) <= MAX_PAYLOAD_BYTES:
+            self.notifications_repository.notify(self.channel, payload)
+            return
+
+        self.notifications_repository.notify_via_outbox(self.channel, payload, self.host_id)
+        if monotonic() - self.purged_at > self.outbox_retention:
+            self.purged_at = monotonic()
+            before = datetime.now(timezone.utc) - timedelta(seconds=self.outbox_retention)
+            n = self.notifications_repository.delete_outbox_messages(before)
+            logging.info(f"PostgresManager._publish: deleted {n} outbox messages")
+
+    def _listen(self) -> Iterator[Dict[str, Any]]:
+        listener = NotificationListener(self.database_url, [self.channel])
+        while True:
+            for notification in listener.wait(timeout=self.wait_timeout):
+                message = json.loads(notification.payload)
+                if 'outbox_id' not in message:
+                    yield message
+                    continue
+
+                # Messages from this process have been handled already
+                if message.get('host_id') == self.host_id:
+                    continue
+
+                payload = self.notifications_repository.get_outbox_message(message['outbox_id'])
+                if payload is None:
+                    logging.error(f"PostgresManager._listen: outbox message {message['outbox_id']} could not be found")
+                    continue
+                yield json.loads(payload)
+
+    def _handle_emit(self, message: Dict[str, Any]) -> None:
+        super()._handle_emit(message)
+        if self.on_remote_emit and message.get('host_id') != self.host_id:
+            self.on_remote_emit(message['event'], message['data'])
@@ -0,0 +1,296 @@
+import abc
+import functools
+import logging
+import os
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Dict, Iterator, List, Tuple, TypeVar
+
+# A small subset of the Prometheus client: counters, gauges and histograms
+# with labels, rendered in the text exposition format.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = [
+        (k, v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for k, v in labels
+    ]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+def format_value(value: float) -> str:
+    value = float(value)
+    if value == float("inf"):
+        return "+Inf"
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class Metric(abc.ABC):
+    name: str
+    help: str
+    type: str
+    lock: Lock
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = Lock()
+
+    @abc.abstractmethod
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        pass
+
+    def render(self, labels: Labels = ()) -> List[str]:
+        """
+        The lines of the metric, `labels` are added to every sample
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for name, sample_labels, value in self.samples():
+            lines.append(f"{name}{format_labels(labels + sample_labels)} {format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    type = "counter"
+    values: Dict[Labels, float]
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+class Gauge(Metric):
+    type = "gauge"
+    values: Dict[Labels, float]
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self.values = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+class HistogramValues:
+    counts: List[int]
+    sum: float
+    count: int
+
+    def __init__(self, n: int):
+        self.counts = [0] * n
+        self.sum = 0
+        self.count = 0
+
+class Histogram(Metric):
+    type = "histogram"
+    buckets: Tuple[float, ...]
+    values: Dict[Labels, HistogramValues]
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            values = self.values.get(key)
+            if values is None:
+                values = self.values[key] = HistogramValues(len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values.counts[i] += 1
+                    break
+            values.sum += value
+            values.count += 1
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started_at = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - started_at, **labels)
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        samples: List[Tuple[str, Labels, float]] = []
+        with self.lock:
+            for labels, values in self.values.items():
+                cumulative = 0
+                for bound, n in zip(self.buckets, values.counts):
+                    cumulative += n
+                    samples.append((f"{self.name}_bucket", labels + (("le", format_value(bound)), ), cumulative))
+                samples.append((f"{self.name}_bucket", labels + (("le", "+Inf"), ), values.count))
+                samples.append((f"{self.name}_sum", labels, values.sum))
+                samples.append((f"{self.name}_count", labels, values.count))
+        return samples
+
+class MetricsRegistry:
+    """
+    The metrics of the process. Collectors are called on every render, to
+    update gauges whose values are read rather than tracked, like the state
+    of the connection pool.
+
+    Every web worker keeps metrics of its own and a scrape reaches any one
+    of them, so samples are labelled with the pid of the process. Each
+    worker's series are then consistent on their own and can be summed
+    across pids.
+    """
+    metrics: List[Metric]
+    collectors: List[Callable[[], None]]
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric: Metric) -> Any:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logging.error(f"MetricsRegistry.render: collector {collector.__name__} failed, {e}")
+
+        labels: Labels = (("pid", str(os.getpid())), )
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render(labels))
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+REPOSITORY_DURATION: Histogram = REGISTRY.register(Histogram(
+    "repository_duration_seconds",
+    "Duration of repository method calls"
+))
+POOL_CONNECTIONS: Gauge = REGISTRY.register(Gauge(
+    "pool_connections",
+    "Connections of the connection pool, by state"
+))
+POOL_REQUESTS_WAITING: Gauge = REGISTRY.register(Gauge(
+    "pool_requests_waiting",
+    "Requests waiting for a connection from the pool"
+))
+REPLIES: Gauge = REGISTRY.register(Gauge(
+    "replies",
+    "Replies by status"
+))
+REPLY_JOBS: Gauge = REGISTRY.register(Gauge(
+    "reply_jobs",
+    "Reply jobs that are not yet completed"
+))
+SOCKETIO_EMITS: Counter = REGISTRY.register(Counter(
+    "socketio_emits_total",
+    "Socket.IO events emitted, by event"
+))
+GENERATION_DURATION: Histogram = REGISTRY.register(Histogram(
+    "generation_duration_seconds",
+    "Duration of reply generations",
+    buckets=(0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+))
+GENERATION_TIME_TO_FIRST_TOKEN: Histogram = REGISTRY.register(Histogram(
+    "generation_time_to_first_token_seconds",
+    "Time until the first token of streamed replies",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+))
+GENERATION_PROMPT_TOKENS: Counter = REGISTRY.register(Counter(
+    "generation_prompt_tokens_total",
+    "Prompt tokens of reply generations"
+))
+GENERATION_NEW_TOKENS: Counter = REGISTRY.register(Counter(
+    "generation_new_tokens_total",
+    "Tokens generated for replies"
+))
+REPLY_CACHE_REQUESTS: Counter = REGISTRY.register(Counter(
+    "reply_cache_requests_total",
+    "Lookups in the semantic reply cache, by result"
+))
+REPLY_CACHE_EVICTIONS: Counter = REGISTRY.register(Counter(
+    "reply_cache_evictions_total",
+    "Entries removed from the semantic reply cache, by reason"
+))
+
+C = TypeVar("C", bound=type)
+
+def timed_repository(cls: C) -> C:
+    """
+    Times every public method of a repository class into
+    repository_duration_seconds
+    """
+    for name, method in list(vars(cls).items()):
+        if name.startswith("_") or not callable(method):
+            continue
+        setattr(cls, name, timed_method(method, cls.__name__, name))
+    return cls
+
+def timed_method(method: Callable, repository: str, name: str) -> Callable:
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with REPOSITORY_DURATION.time(repository=repository, method=name):
+            return method(*args, **kwargs)
+    return wrapper
+
+def collect_pool_stats(pool: Any) -> Callable[[], None]:
+    """
+    A collector of the statistics of a psycopg_pool ConnectionPool
+    """
+    def collect():
+        stats = pool.get_stats()
+        size = stats.get("pool_size", 0)
+        available = stats.get("pool_available", 0)
+        POOL_CONNECTIONS.set(size - available, state="in_use")
+        POOL_CONNECTIONS.set(available, state="available")
+        POOL_REQUESTS_WAITING.set(stats.get("requests_waiting", 0))
+    return collect
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    """
+    Serves /metrics on the port from a daemon thread
+    """
+    server = ThreadingHTTPServer(("0.0.0.0", port), MetricsHandler)
+    Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"serve_metrics: serving metrics on port {port}")
+    return server
@@ -2,7 +2,7 @@ from pydantic import BaseModel
 from datetime import datetime
 from uuid import UUID
 import enum
-from typing import List
+from typing import Dict, List
 
 from pydantic.root_model import RootModel
 
@@ -30,6 +30,7 @@ class ReplyStatus(enum.Enum):
     PENDING = "pending"
     READY = "ready"
     PUBLISHED = "published"
+    FAILED = "failed"
 
 class Reply(BaseModel):
     id: UUID
@@ -38,6 +39,24 @@ class Reply(BaseModel):
     status: ReplyStatus
     message: str | None
 
+class ReplyJob(BaseModel):
+    reply_id: UUID
+    message_id: UUID
+    enqueued_at: datetime
+    worker_id: UUID | None
+    leased_until: datetime | None
+    attempts: int
+
+class ReplyStatusChanged(BaseModel):
+    id: UUID
+    message_id: UUID
+    status: ReplyStatus
+
+class ReplyDelta(BaseModel):
+    reply_id: UUID
+    seq: int
+    delta: str
+
 class Concept(BaseModel):
     id: UUID
     timestamp: datetime
@@ -45,6 +64,12 @@ class Concept(BaseModel):
     meaning: str
     deleted: bool
 
+class ConceptEmbedding(BaseModel):
+    concept_id: UUID
+    timestamp: datetime
+    model: str
+    embedding: bytes
+
 class SystemPromptKey(enum.Enum):
     BASE = "base"
     RELATED_CONCEPTS = "related_concepts"
@@ -54,10 +79,47 @@ class SystemPrompt(BaseModel):
     prompt: str
     timestamp: datetime
 
+class WorkerStatus(enum.Enum):
+    STARTING = "starting"
+    READY = "ready"
+    STOPPED = "stopped"
+
+class Worker(BaseModel):
+    id: UUID
+    status: WorkerStatus
+    started_at: datetime
+    ready_at: datetime | None
+    heartbeat_at: datetime
+    startup: Dict[str, float] | None
+
+class GenerationStats(BaseModel):
+    prompt_tokens: int
+    new_tokens: int
+    duration: float
+    tokens_per_second: float
+    max_new_tokens: int
+    time_to_first_token: float | None
+    draft_acceptance_rate: float | None
+
+class GenerationLimits(BaseModel):
+    max_new_tokens: int
+    stop_at_sentence_after: int | None
+
 # Response models
 class ReplyingTo(BaseModel):
     user_id: UUID | None
 
+class PresenceDiff(BaseModel):
+    # Users who joined, with their names, and ids of users who left
+    joined: List[User]
+    left: List[UUID]
+
+class ProcessPresence(BaseModel):
+    # The users connected to a web process and their sessions
+    process_id: UUID
+    users: List[User]
+    sessions: List[UUID]
+
 class Role(enum.Enum):
     SYSTEM = "system"
     ASSISTANT = "assistant"
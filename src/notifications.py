@@ -0,0 +1,86 @@
+import logging
+import select
+from time import sleep
+from typing import Callable, List
+import psycopg
+from psycopg import Notify, sql
+
+# Channels
+REPLY_DELTAS_CHANNEL = "reply_deltas"
+# Notified by a trigger whenever a reply record is inserted
+REPLY_STATUS_CHANNEL = "reply_status"
+# Notified by ConceptsService when an admin saves system prompts or concepts
+SYSTEM_PROMPTS_CHANNEL = "system_prompts"
+CONCEPTS_CHANNEL = "concepts"
+# Socket.IO emits shared between the web processes
+SOCKETIO_CHANNEL = "socketio"
+
+class NotificationListener:
+    """
+    Holds a dedicated connection that LISTENs on a set of channels.
+
+    Waiting is done with `select`, so it cooperates with eventlet when the
+    web process is monkey patched and simply blocks the calling thread in
+    the worker.
+    """
+    database_url: str
+    channels: List[str]
+    on_connect: Callable[[], None] | None
+    conn: psycopg.Connection | None
+
+    def __init__(
+        self,
+        database_url: str,
+        channels: List[str],
+        on_connect: Callable[[], None] | None = None
+    ):
+        """
+        `on_connect` is called whenever the listener (re)connects, as any
+        notifications sent while disconnected have been missed.
+        """
+        self.database_url = database_url
+        self.channels = channels
+        self.on_connect = on_connect
+        self.conn = None
+
+    def connect(self) -> psycopg.Connection:
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg.connect(self.database_url, autocommit=True)
+            for channel in self.channels:
+                self.conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+            logging.info(f"NotificationListener: listening on {self.channels}")
+            if self.on_connect:
+                self.on_connect()
+        return self.conn
+
+    def wait(self, timeout: float) -> List[Notify]:
+        """
+        Waits up to `timeout` seconds and returns any notifications received.
+        Connection errors are logged and yield no notifications after the
+        timeout has passed, the connection is re-established on the next call.
+        """
+        try:
+            conn = self.connect()
+
+            # Notifications may already have been read off the socket
+            notifications = list(conn.notifies(timeout=0))
+            if notifications:
+                return notifications
+
+            readable, _, _ = select.select([conn.fileno()], [], [], timeout)
+            if not readable:
+                return []
+
+            return list(conn.notifies(timeout=0))
+        except psycopg.OperationalError as e:
+            logging.error(f"NotificationListener.wait: connection lost, {e}")
+            self.close()
+            sleep(timeout)
+            return []
+
+    def close(self) -> None:
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            finally:
+                self.conn = None
@@ -0,0 +1,105 @@
+import enum
+import logging
+import math
+import resource
+from typing import Any
+
+# torch is imported where used, see src/assistant.py
+
+class Precision(enum.Enum):
+    FP32 = "fp32"
+    BF16 = "bf16"
+    INT8 = "int8"
+
+# A plain sentence the generation model should find unsurprising, used to
+# compare the quality of precision profiles
+SANITY_CHECK_TEXT = "The quick brown fox jumps over the lazy dog. Cheryl is a friendly assistant who answers questions about words and their meanings."
+
+def torch_dtype(precision: Precision) -> Any:
+    """
+    The dtype to load weights in. int8 models are loaded in fp32 and
+    quantized afterwards.
+    """
+    import torch
+
+    if precision == Precision.BF16:
+        return torch.bfloat16
+    return torch.float32
+
+def quantize_if_int8(model: Any, precision: Precision) -> Any:
+    """
+    Replaces the linear layers of the model with dynamically quantized int8
+    versions: weights are stored in int8, activations are quantized on the fly.
+    """
+    if precision != Precision.INT8:
+        return model
+
+    import torch
+
+    return torch.ao.quantization.quantize_dynamic(
+        model,
+        {torch.nn.Linear},
+        dtype=torch.qint8
+    )
+
+def model_memory_bytes(model: Any) -> int:
+    """
+    Size of the model's weights and buffers, including quantized packed weights
+    """
+    import torch
+
+    def size(value: Any) -> int:
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(size(v) for v in value)
+        return 0
+
+    return sum(size(v) for v in model.state_dict().values())
+
+def max_rss_bytes() -> int:
+    """Peak resident set size of the process (Linux reports kilobytes)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def generation_perplexity(tokenizer: Any, model: Any, device: str) -> float:
+    """
+    Perplexity of the model on SANITY_CHECK_TEXT. A reduced precision profile
+    that is much worse than fp32 has lost too much.
+    """
+    import torch
+
+    input_ids = tokenizer(SANITY_CHECK_TEXT, return_tensors="pt").input_ids.to(device)
+    with torch.no_grad():
+        output = model(input_ids, labels=input_ids)
+    return math.exp(float(output.loss))
+
+def log_footprint(name: str, memory_bytes: int, precision: Precision) -> float:
+    """
+    Logs and returns the size of a model's weights in megabytes
+    """
+    mb = memory_bytes / 1024 / 1024
+    logging.info(f"{name} ({precision.value}): {mb:.1f} MB of weights, process peak RSS {max_rss_bytes() / 1024 / 1024:.1f} MB")
+    return round(mb, 1)
+
+# An embedding model should consider the paraphrase much closer than the
+# unrelated sentence
+EMBEDDING_SANITY_CHECK = (
+    "What does this word mean?",
+    "Can you explain the meaning of this term?",
+    "The train leaves from platform four at noon.",
+)
+
+def embedding_margin(encode: Any) -> float:
+    """
+    Similarity of the paraphrase minus similarity of the unrelated sentence,
+    for a function that encodes texts into normalized embeddings.
+    """
+    anchor, paraphrase, unrelated = encode(list(EMBEDDING_SANITY_CHECK))
+    return float(anchor @ paraphrase - anchor @ unrelated)
+
+def embedding_parity(reference: Any, candidate: Any) -> float:
+    """
+    The lowest cosine similarity between corresponding rows of two sets of
+    normalized embeddings of the same texts, e.g. from two backends.
+    """
+    return float(min((reference * candidate).sum(axis=-1)))
@@ -0,0 +1,304 @@
+import logging
+from datetime import datetime, timezone
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, List, Tuple
+from uuid import UUID, uuid4
+from src.models import PresenceDiff, ProcessPresence, User, UserSession
+from src.repositories.users import UsersRepository
+
+# Events of user sessions
+CONNECTED = "connected"
+DISCONNECTED = "disconnected"
+
+class PendingPresence:
+    joined: Dict[UUID, User]
+    left: set[UUID]
+
+    def __init__(self):
+        self.joined = {}
+        self.left = set()
+
+    def join(self, user: User) -> None:
+        if user.id in self.left:
+            self.left.remove(user.id)
+        else:
+            self.joined[user.id] = user
+
+    def leave(self, user_id: UUID) -> None:
+        if user_id in self.joined:
+            del self.joined[user_id]
+        else:
+            self.left.add(user_id)
+
+class PresenceBroadcaster:
+    """
+    Accumulates who joined and left each room and emits the changes as one
+    `presence_diff` event per room on every flush, instead of one event per
+    connection. Leaving and joining again before a flush, as tabs do when
+    they reconnect, cancels out.
+    """
+    emit: Callable[[str, PresenceDiff], None]
+    pending: Dict[str, PendingPresence]
+    lock: Lock
+
+    def __init__(self, emit: Callable[[str, PresenceDiff], None]):
+        """
+        `emit` is called with the room and its diff
+        """
+        self.emit = emit
+        self.pending = {}
+        self.lock = Lock()
+
+    def joined(self, room: str, user: User) -> None:
+        with self.lock:
+            self.pending.setdefault(room, PendingPresence()).join(user)
+
+    def left(self, room: str, user_id: UUID) -> None:
+        with self.lock:
+            self.pending.setdefault(room, PendingPresence()).leave(user_id)
+
+    def flush(self) -> None:
+        """
+        Emits the pending changes of every room. The changes of a room whose
+        emit fails are kept for the next flush.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        for room, p in pending.items():
+            if not p.joined and not p.left:
+                continue
+            try:
+                self.emit(room, PresenceDiff(joined=list(p.joined.values()), left=list(p.left)))
+            except Exception as e:
+                logging.error(f"PresenceBroadcaster.flush: could not emit the presence diff of room {room}, {e}")
+                self._restore(room, p)
+
+    def _restore(self, room: str, p: PendingPresence) -> None:
+        # Changes made since the flush come after the restored ones
+        with self.lock:
+            newer = self.pending.get(room)
+            if newer is not None:
+                for user in newer.joined.values():
+                    p.join(user)
+                for user_id in newer.left:
+                    p.leave(user_id)
+            self.pending[room] = p
+
+class PresenceRegistry:
+    """
+    Who is connected, as seen by one web process. Connecting and
+    disconnecting only update memory, the user_sessions events are written
+    by `flush`, with one insert per flush. A user's connections to the
+    process share a session, which is connected while any of them is open.
+
+    Every process announces the users connected to it, with their sessions,
+    whenever they change and every `announce_interval` seconds. Users count
+    as connected while any process has them, so one of two tabs on
+    different processes closing does not make the user leave. Processes
+    that have not announced themselves for `grace_period` seconds are
+    considered gone.
+
+    Sessions that were connected when the process started are recovered by
+    `recover`, and their users count as connected for `grace_period`
+    seconds. Sessions announced by another process in the meantime are its
+    own and are left to it, the others are closed once the grace period is
+    over.
+    """
+    users_repository: UsersRepository
+    grace_period: float
+    announce_interval: float
+    process_id: UUID
+    users: Dict[UUID, User]
+    sessions: Dict[UUID, UUID]
+    connections: Dict[UUID, int]
+    remote: Dict[UUID, Tuple[set[UUID], float]]
+    recovered: Dict[UUID, Tuple[UUID, float]]
+    reported: set[UUID]
+    announced: Tuple[frozenset[UUID], float] | None
+    persisted: Dict[UUID, str]
+    dirty: Dict[UUID, Tuple[UUID, datetime]]
+    lock: Lock
+
+    def __init__(self, *, users_repository: UsersRepository, grace_period: float):
+        self.users_repository = users_repository
+        self.grace_period = grace_period
+        self.announce_interval = grace_period / 3
+        self.process_id = uuid4()
+        self.users = {}
+        # Session id by user id
+        self.sessions = {}
+        # Open connections by user id
+        self.connections = {}
+        # User ids and when they were announced by process id
+        self.remote = {}
+        # User id and deadline by session id
+        self.recovered = {}
+        # The user ids last returned by `changes`
+        self.reported = set()
+        # The user ids last announced and when
+        self.announced = None
+        # The last event written by session id
+        self.persisted = {}
+        # User id and time of the change by session id, for sessions to write
+        self.dirty = {}
+        self.lock = Lock()
+
+    def recover(self) -> None:
+        """
+        Loads the sessions that are connected according to the database
+        """
+        sessions = self.users_repository.get_connected_user_sessions()
+        users = self.users_repository.get_users_by_id(list({s.user_id for s in sessions}))
+        deadline = monotonic() + self.grace_period
+
+        with self.lock:
+            for user in users:
+                self.users.setdefault(user.id, user)
+
+            own = set(self.sessions.values())
+            for s in sessions:
+                if s.id in own:
+                    continue
+                self.persisted[s.id] = CONNECTED
+                self.recovered[s.id] = (s.user_id, deadline)
+
+        logging.info(f"PresenceRegistry.recover: recovered {len(sessions)} connected sessions")
+
+    def get_user(self, user_id: UUID) -> User | None:
+        with self.lock:
+            return self.users.get(user_id)
+
+    def connect(self, user: User) -> None:
+        """
+        Counts a connection of the user to this process
+        """
+        with self.lock:
+            self.users[user.id] = user
+            n = self.connections.get(user.id, 0) + 1
+            self.connections[user.id] = n
+            if n == 1:
+                session = self.sessions.setdefault(user.id, uuid4())
+                self.dirty[session] = (user.id, datetime.now(timezone.utc))
+
+    def disconnect(self, user_id: UUID) -> None:
+        with self.lock:
+            n = self.connections.get(user_id, 0) - 1
+            if n > 0:
+                self.connections[user_id] = n
+                return
+            if self.connections.pop(user_id, None) is None:
+                return
+
+            self.dirty[self.sessions[user_id]] = (user_id, datetime.now(timezone.utc))
+
+    def apply_process_presence(self, presence: ProcessPresence) -> None:
+        """
+        Applies the announcement of another web process
+        """
+        if presence.process_id == self.process_id:
+            return
+
+        with self.lock:
+            for user in presence.users:
+                self.users[user.id] = user
+            self.remote[presence.process_id] = ({u.id for u in presence.users}, monotonic())
+
+            for session in presence.sessions:
+                if self.recovered.pop(session, None) is not None:
+                    self.persisted.pop(session, None)
+
+    def announcement(self) -> ProcessPresence | None:
+        """
+        The users connected to this process, if they changed since the last
+        announcement or it is time to announce them again
+        """
+        with self.lock:
+            user_ids = frozenset(self.connections)
+            if self.announced is not None:
+                announced_ids, announced_at = self.announced
+                if announced_ids == user_ids and monotonic() - announced_at < self.announce_interval:
+                    return None
+
+            self.announced = (user_ids, monotonic())
+            return ProcessPresence(
+                process_id=self.process_id,
+                users=[self.users[id] for id in user_ids],
+                sessions=[self.sessions[id] for id in user_ids]
+            )
+
+    def expire(self) -> None:
+        """
+        Closes the recovered sessions whose grace period is over and forgets
+        the processes that have not announced themselves within it
+        """
+        now = monotonic()
+        with self.lock:
+            expired = [(s, user_id) for s, (user_id, deadline) in self.recovered.items() if deadline <= now]
+            for session, user_id in expired:
+                del self.recovered[session]
+                self.dirty[session] = (user_id, datetime.now(timezone.utc))
+
+            for process_id, (_, seen_at) in list(self.remote.items()):
+                if now - seen_at > self.grace_period:
+                    logging.info(f"PresenceRegistry.expire: process {process_id} is gone")
+                    del self.remote[process_id]
+
+    def changes(self) -> Tuple[List[User], List[UUID]]:
+        """
+        The users who joined and the ids of the users who left since the
+        last call
+        """
+        with self.lock:
+            connected = self._connected_user_ids()
+            joined = [self.users[id] for id in connected - self.reported if id in self.users]
+            left = list(self.reported - connected)
+            self.reported = {u.id for u in joined} | (self.reported & connected)
+            return joined, left
+
+    def connected_user_ids(self) -> List[UUID]:
+        with self.lock:
+            return list(self._connected_user_ids())
+
+    def flush(self) -> None:
+        """
+        Writes the sessions that changed since the last flush
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            user_sessions = [
+                UserSession(id=session, user_id=user_id, timestamp=timestamp, event=event)
+                for session, (user_id, timestamp) in dirty.items()
+                if (event := self._session_event(session, user_id)) != self.persisted.get(session, DISCONNECTED)
+            ]
+
+        if not user_sessions:
+            return
+
+        try:
+            self.users_repository.create_user_sessions(user_sessions)
+        except Exception as e:
+            logging.error(f"PresenceRegistry.flush: could not write {len(user_sessions)} user sessions, {e}")
+            with self.lock:
+                for s in user_sessions:
+                    self.dirty.setdefault(s.id, (s.user_id, s.timestamp))
+            return
+
+        with self.lock:
+            for s in user_sessions:
+                self.persisted[s.id] = s.event
+
+    def _session_event(self, session: UUID, user_id: UUID) -> str:
+        if session in self.recovered:
+            return CONNECTED
+        if self.sessions.get(user_id) == session and user_id in self.connections:
+            return CONNECTED
+        return DISCONNECTED
+
+    def _connected_user_ids(self) -> set[UUID]:
+        ids = set(self.connections)
+        for user_ids, _ in self.remote.values():
+            ids |= user_ids
+        ids.update(user_id for user_id, _ in self.recovered.values())
+        return ids
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+from typing import Any, Hashable
+
+class TokenCounter:
+    """
+    Counts tokens with the model's tokenizer. Counts are remembered by key,
+    e.g. the id and timestamp of a concept record or the id of a stored
+    message, as the same texts are counted for many prompts.
+    """
+    tokenizer: Any
+    max_size: int
+    counts: OrderedDict[Hashable, int]
+
+    def __init__(self, tokenizer: Any, max_size: int = 10_000):
+        self.tokenizer = tokenizer
+        self.max_size = max_size
+        self.counts = OrderedDict()
+
+    def count(self, text: str, key: Hashable | None = None) -> int:
+        if key is None:
+            key = text
+
+        n = self.counts.get(key)
+        if n is not None:
+            self.counts.move_to_end(key)
+            return n
+
+        n = len(self.tokenizer.encode(text, add_special_tokens=False))
+        self.counts[key] = n
+        if len(self.counts) > self.max_size:
+            self.counts.popitem(last=False)
+        return n
+
+class TokenBudget:
+    """
+    The number of tokens left for a prompt that is being assembled
+    """
+    counter: TokenCounter
+    total: int
+    remaining: int
+
+    def __init__(self, counter: TokenCounter, total: int):
+        self.counter = counter
+        self.total = total
+        self.remaining = total
+
+    def take(self, text: str, key: Hashable | None = None, extra: int = 0) -> bool:
+        """
+        Takes the tokens of the text, plus `extra`, if they fit. Returns
+        whether they did.
+        """
+        n = self.counter.count(text, key) + extra
+        if n > self.remaining:
+            return False
+        self.remaining -= n
+        return True
+
+    def spend(self, text: str, key: Hashable | None = None, extra: int = 0) -> None:
+        """
+        Takes the tokens of a text that is part of the prompt regardless
+        """
+        self.remaining -= self.counter.count(text, key) + extra
+
+    def give_back(self, text: str, key: Hashable | None = None, extra: int = 0) -> None:
+        self.remaining += self.counter.count(text, key) + extra
+
+    @property
+    def used(self) -> int:
+        return self.total - self.remaining
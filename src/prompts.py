@@ -0,0 +1,59 @@
+import logging
+from time import monotonic
+from typing import Dict, List, Protocol
+from src.models import SystemPrompt, SystemPromptKey
+
+class SystemPromptsSource(Protocol):
+    """
+    What the cache reads, implemented by SystemPromptsRepository
+    """
+    def get_system_prompts(self) -> List[SystemPrompt]: ...
+
+class SystemPromptsCache:
+    """
+    Read-through cache of all system prompts. Prompts only change when an
+    admin saves them, which is announced on the system prompts channel, so
+    the cache is reloaded when invalidated and otherwise only after
+    `max_age` seconds as a safety net for missed notifications.
+    """
+    system_prompts_repository: SystemPromptsSource
+    max_age: float
+    prompts: Dict[SystemPromptKey, SystemPrompt] | None
+    loaded_at: float
+    invalidated: bool
+    version: int
+
+    def __init__(
+        self, *,
+        system_prompts_repository: SystemPromptsSource,
+        max_age: float
+    ):
+        self.system_prompts_repository = system_prompts_repository
+        self.max_age = max_age
+        self.prompts = None
+        self.loaded_at = 0
+        self.invalidated = False
+        self.version = 0
+
+    def invalidate(self) -> None:
+        # The prompts are kept to compare the reloaded ones against
+        self.invalidated = True
+
+    def get(self, key: SystemPromptKey) -> SystemPrompt | None:
+        prompts = self.prompts
+        if prompts is None or self.invalidated or monotonic() - self.loaded_at > self.max_age:
+            prompts = self.load()
+        return prompts.get(key)
+
+    def load(self) -> Dict[SystemPromptKey, SystemPrompt]:
+        # Cleared before reading, so an invalidation during the query is kept
+        self.invalidated = False
+        prompts = {sp.key: sp for sp in self.system_prompts_repository.get_system_prompts()}
+        if prompts != self.prompts:
+            # Lets dependent caches tell prompt versions apart cheaply
+            self.version += 1
+            logging.info(f"SystemPromptsCache.load: loaded version {self.version}")
+
+        self.prompts = prompts
+        self.loaded_at = monotonic()
+        return prompts
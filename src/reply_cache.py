@@ -0,0 +1,150 @@
+import logging
+import random
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Hashable, List
+import numpy as np
+from numpy import ndarray
+from src.metrics import REPLY_CACHE_EVICTIONS, REPLY_CACHE_REQUESTS
+
+class CachedReply:
+    embedding: ndarray
+    replies: List[str]
+    created_at: float
+
+    def __init__(self, *, embedding: ndarray, reply: str, created_at: float):
+        self.embedding = embedding
+        self.replies = [reply]
+        self.created_at = created_at
+
+class SemanticReplyCache:
+    """
+    Replies to recently answered messages, looked up by the cosine similarity
+    of normalized message embeddings. Entries are only valid for the version
+    of the system prompts and concepts they were generated with, expire after
+    `ttl` seconds, and the least recently used entry is evicted when full.
+
+    With `variants` > 1 each entry collects that many generated replies before
+    it starts serving them, picking one at random, so that repeated questions
+    do not always get the exact same answer.
+    """
+    max_size: int
+    ttl: float
+    threshold: float
+    variants: int
+    entries: OrderedDict[int, CachedReply]
+    version: Hashable
+    next_id: int
+    ids: List[int]
+    matrix: ndarray | None
+    lock: Lock
+    hits: int
+    misses: int
+
+    def __init__(self, *, max_size: int, ttl: float, threshold: float, variants: int = 1):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.variants = max(1, variants)
+        self.entries = OrderedDict()
+        self.version = None
+        self.next_id = 0
+        self.ids = []
+        self.matrix = None
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, embedding: ndarray, version: Hashable) -> str | None:
+        """
+        A cached reply to a message similar enough to the embedded one, if any
+        """
+        with self.lock:
+            self._expire(version)
+            entry_id, score = self._nearest(embedding)
+
+            entry = self.entries.get(entry_id) if entry_id is not None else None
+            if entry_id is None or entry is None or len(entry.replies) < self.variants:
+                self.misses += 1
+                REPLY_CACHE_REQUESTS.inc(result="miss")
+                logging.info(f"SemanticReplyCache.lookup: miss (best score {score:.3f}), hit rate {self.hit_rate():.3f}")
+                return None
+
+            self.entries.move_to_end(entry_id)
+            self.hits += 1
+            REPLY_CACHE_REQUESTS.inc(result="hit")
+            logging.info(f"SemanticReplyCache.lookup: hit (score {score:.3f}), hit rate {self.hit_rate():.3f}")
+            return random.choice(entry.replies)
+
+    def insert(self, embedding: ndarray, version: Hashable, reply: str) -> None:
+        """
+        Caches a generated reply. Replies generated for an outdated version
+        are dropped.
+        """
+        if not reply:
+            return
+
+        with self.lock:
+            self._expire(version)
+            if version != self.version:
+                return
+
+            entry_id, _ = self._nearest(embedding)
+            if entry_id is not None:
+                entry = self.entries[entry_id]
+                if len(entry.replies) < self.variants:
+                    entry.replies.append(reply)
+                self.entries.move_to_end(entry_id)
+                return
+
+            self.entries[self.next_id] = CachedReply(
+                embedding=np.asarray(embedding, dtype=np.float32),
+                reply=reply,
+                created_at=monotonic()
+            )
+            self.next_id += 1
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                REPLY_CACHE_EVICTIONS.inc(reason="size")
+            self.matrix = None
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def _expire(self, version: Hashable) -> None:
+        if version != self.version:
+            # Replies may refer to prompts or concepts that have changed
+            REPLY_CACHE_EVICTIONS.inc(len(self.entries), reason="version")
+            self.entries.clear()
+            self.version = version
+            self.matrix = None
+            return
+
+        now = monotonic()
+        expired = [i for i, e in self.entries.items() if now - e.created_at > self.ttl]
+        for i in expired:
+            del self.entries[i]
+        if expired:
+            REPLY_CACHE_EVICTIONS.inc(len(expired), reason="ttl")
+            self.matrix = None
+
+    def _nearest(self, embedding: ndarray) -> tuple[int | None, float]:
+        """
+        The entry most similar to the embedding if it is within the
+        threshold, and the best score
+        """
+        if not self.entries:
+            return None, 0
+
+        if self.matrix is None:
+            self.ids = list(self.entries.keys())
+            self.matrix = np.stack([self.entries[i].embedding for i in self.ids])
+
+        scores = self.matrix @ np.asarray(embedding, dtype=np.float32)
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        if score < self.threshold:
+            return None, score
+        return self.ids[best], score
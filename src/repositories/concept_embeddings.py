@@ -0,0 +1,89 @@
+from psycopg_pool import ConnectionPool
+import psycopg
+from src.models import ConceptEmbedding
+from psycopg.rows import TupleRow, class_row
+from typing import List, Tuple
+from uuid import UUID
+from datetime import datetime
+
+SELECT_CONCEPT_EMBEDDINGS = """
+SELECT
+    concept_id,
+    timestamp,
+    model,
+    embedding
+FROM concept_embeddings
+WHERE
+    model = %(model)s
+    AND (concept_id, timestamp) IN (
+        SELECT *
+        FROM UNNEST(
+            %(concept_ids)s::UUID[],
+            %(timestamps)s::TIMESTAMPTZ[]
+        )
+    );
+"""
+
+BATCH_INSERT_CONCEPT_EMBEDDINGS = """
+INSERT INTO concept_embeddings (
+    concept_id,
+    timestamp,
+    model,
+    embedding
+)
+SELECT *
+FROM UNNEST(
+    %s::UUID[],
+    %s::TIMESTAMPTZ[],
+    %s::TEXT[],
+    %s::BYTEA[]
+)
+ON CONFLICT DO NOTHING;
+"""
+
+
+class ConceptEmbeddingsRepository:
+    pool: ConnectionPool[psycopg.Connection[TupleRow]]
+
+    def __init__(self, pool: ConnectionPool[psycopg.Connection[TupleRow]]):
+        self.pool = pool
+
+    def get_concept_embeddings(
+        self, *,
+        model: str,
+        keys: List[Tuple[UUID, datetime]]
+    ) -> List[ConceptEmbedding]:
+        """
+        Selects the stored embeddings of the given concept records for a model
+        """
+        if not keys:
+            return []
+
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=class_row(ConceptEmbedding)) as cur:
+                cur.execute(SELECT_CONCEPT_EMBEDDINGS, {
+                    'model': model,
+                    'concept_ids': [id for id, _ in keys],
+                    'timestamps': [timestamp for _, timestamp in keys],
+                })
+                return cur.fetchall()
+
+    def insert_concept_embeddings(self, embeddings: List[ConceptEmbedding]) -> None:
+        """
+        Batch insert concept embeddings. Embeddings that are already stored
+        (e.g. by another worker) are left untouched.
+        """
+        if not embeddings:
+            return
+
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    BATCH_INSERT_CONCEPT_EMBEDDINGS,
+                    (
+                        [e.concept_id for e in embeddings],
+                        [e.timestamp for e in embeddings],
+                        [e.model for e in embeddings],
+                        [e.embedding for e in embeddings],
+                    )
+                )
@@ -2,9 +2,10 @@ from psycopg_pool import ConnectionPool
 import psycopg
 from src.models import Concept
 from psycopg.rows import TupleRow,class_row
-from typing import List
+from typing import List, Tuple
 from uuid import UUID
 from datetime import datetime
+from src.metrics import timed_repository
 
 # FIXME: order by input date
 SELECT_CONCEPTS = """
@@ -17,6 +18,15 @@ SELECT_CONCEPTS = """
 FROM latest_concepts;
 """
 
+# Concepts are append-only, so any change to the set of latest concepts
+# changes the number of records or the most recent timestamp.
+SELECT_CONCEPTS_VERSION = """
+SELECT
+    COUNT(*),
+    MAX(timestamp)
+FROM concepts;
+"""
+
 BATCH_INSERT_CONCEPTS = """
 WITH inserted_records AS (
     INSERT INTO concepts (
@@ -46,6 +56,7 @@ class ConceptInsertionError(Exception):
     pass
 
 
+@timed_repository
 class ConceptsRepository:
     pool: ConnectionPool[psycopg.Connection[TupleRow]]
 
@@ -61,6 +72,18 @@ class ConceptsRepository:
                 cur.execute(SELECT_CONCEPTS)
                 return cur.fetchall()
 
+    def get_concepts_version(self) -> Tuple[int, datetime | None]:
+        """
+        Get a cheap version marker that changes whenever concepts are written
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SELECT_CONCEPTS_VERSION)
+                row = cur.fetchone()
+                if not row:
+                    return 0, None
+                return row[0], row[1]
+
     def upsert_concepts(self, concepts: List[Concept]) -> List[Concept]:
         """
         Batch insert new concept records using UNNEST for efficiency.
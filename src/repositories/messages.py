@@ -1,10 +1,11 @@
 from psycopg_pool import ConnectionPool
 from uuid import UUID
-from typing import Optional
+from typing import Dict, Optional
 import psycopg
-from src.models import Message, Reply, ReplyStatus
+from src.models import Message, Reply, ReplyJob, ReplyStatus
 from datetime import datetime
 from psycopg.rows import TupleRow,class_row
+from src.metrics import timed_repository
 
 INSERT_MESSAGE = """
 INSERT INTO messages (
@@ -24,13 +25,44 @@ FROM messages
 WHERE id = %s;
 """
 
+# Pages of messages are ordered by (timestamp, id) and the cursors are message
+# ids, so that pages are read from idx_messages_conversation_id_timestamp_id
+# however long the conversation
 SELECT_MESSAGES = """
 SELECT *
 FROM messages
+WHERE conversation_id = %(conversation_id)s::UUID
+ORDER BY timestamp DESC, id DESC
+LIMIT %(limit)s::INTEGER;
+"""
+
+SELECT_MESSAGES_BEFORE_MESSAGE = """
+SELECT *
+FROM messages
+WHERE
+    conversation_id = %(conversation_id)s::UUID
+    AND (timestamp, id) < (SELECT timestamp, id FROM messages WHERE id = %(cursor)s::UUID)
+ORDER BY timestamp DESC, id DESC
+LIMIT %(limit)s::INTEGER;
+"""
+
+SELECT_MESSAGES_AFTER_MESSAGE = """
+SELECT *
+FROM messages
 WHERE
     conversation_id = %(conversation_id)s::UUID
-    AND (%(timestamp)s::TIMESTAMPTZ IS NULL OR timestamp >= %(timestamp)s::TIMESTAMPTZ)
-ORDER BY timestamp
+    AND (timestamp, id) > (SELECT timestamp, id FROM messages WHERE id = %(cursor)s::UUID)
+ORDER BY timestamp, id
+LIMIT %(limit)s::INTEGER;
+"""
+
+SELECT_MESSAGES_BEFORE = """
+SELECT *
+FROM messages
+WHERE
+    conversation_id = %(conversation_id)s::UUID
+    AND timestamp < %(timestamp)s::TIMESTAMPTZ
+ORDER BY timestamp DESC
 LIMIT %(limit)s::INTEGER;
 """
 
@@ -67,6 +99,139 @@ ORDER BY timestamp DESC
 LIMIT %(limit)s::INTEGER;
 """
 
+# Locks the rows of a reply, so that concurrent status inserts for it are
+# serialized until the transaction ends
+LOCK_REPLY = """
+SELECT id
+FROM replies
+WHERE id = %s
+FOR UPDATE;
+"""
+
+MARK_REPLY_AS_PUBLISHED = """
+INSERT INTO replies (
+    id,
+    timestamp,
+    message_id,
+    status,
+    message
+)
+SELECT
+    id,
+    %(timestamp)s,
+    message_id,
+    'published',
+    message
+FROM latest_replies
+WHERE
+    id = %(reply_id)s::UUID
+    AND status = 'ready'
+RETURNING *;
+"""
+
+# Inserts a pending reply together with the job that asks a worker for it
+ENQUEUE_REPLY = """
+WITH inserted_reply AS (
+    INSERT INTO replies (
+        id,
+        timestamp,
+        message_id,
+        status,
+        message
+    ) VALUES (%s, %s, %s, %s, %s)
+    RETURNING *
+), inserted_job AS (
+    INSERT INTO reply_jobs (
+        reply_id,
+        message_id,
+        enqueued_at
+    )
+    SELECT
+        id,
+        message_id,
+        timestamp
+    FROM inserted_reply
+)
+SELECT *
+FROM inserted_reply;
+"""
+
+# Leases the oldest jobs that are either unclaimed or whose lease has expired.
+# Jobs leased by other workers are skipped rather than waited for.
+CLAIM_REPLY_JOBS = """
+UPDATE reply_jobs
+SET
+    worker_id = %(worker_id)s::UUID,
+    leased_until = NOW() + %(lease_seconds)s * INTERVAL '1 second',
+    attempts = attempts + 1
+WHERE reply_id IN (
+    SELECT reply_id
+    FROM reply_jobs
+    WHERE
+        leased_until IS NULL
+        OR leased_until < NOW()
+    ORDER BY enqueued_at
+    LIMIT %(limit)s::INTEGER
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING *;
+"""
+
+COUNT_REPLY_JOBS = """
+SELECT COUNT(*)
+FROM reply_jobs;
+"""
+
+COUNT_UNCLAIMED_REPLY_JOBS = """
+SELECT COUNT(*)
+FROM reply_jobs
+WHERE
+    leased_until IS NULL
+    OR leased_until < NOW();
+"""
+
+COUNT_REPLIES_BY_STATUS = """
+SELECT status, COUNT(*)
+FROM latest_replies
+GROUP BY status;
+"""
+
+EXTEND_REPLY_JOB_LEASES = """
+UPDATE reply_jobs
+SET leased_until = NOW() + %(lease_seconds)s * INTERVAL '1 second'
+WHERE
+    reply_id = ANY(%(reply_ids)s::UUID[])
+    AND worker_id = %(worker_id)s::UUID
+RETURNING reply_id;
+"""
+
+# Removes the job and records the reply, but only while the worker still
+# holds the job. A worker whose lease was taken over records nothing.
+COMPLETE_REPLY_JOB = """
+WITH completed_job AS (
+    DELETE FROM reply_jobs
+    WHERE
+        reply_id = %(reply_id)s::UUID
+        AND worker_id = %(worker_id)s::UUID
+    RETURNING reply_id, message_id
+)
+INSERT INTO replies (
+    id,
+    timestamp,
+    message_id,
+    status,
+    message
+)
+SELECT
+    reply_id,
+    %(timestamp)s::TIMESTAMPTZ,
+    message_id,
+    %(status)s::TEXT,
+    %(message)s::TEXT
+FROM completed_job
+RETURNING *;
+"""
+
 class MessageInsertionError(Exception):
     pass
 
@@ -76,6 +241,7 @@ class MessageNotFoundError(Exception):
 class ReplyInsertionError(Exception):
     pass
 
+@timed_repository
 class MessagesRepository:
     pool: ConnectionPool[psycopg.Connection[TupleRow]]
 
@@ -130,16 +296,55 @@ class MessagesRepository:
         self,
         *,
         conversation_id: UUID,
-        timestamp: Optional[datetime] = None,
+        before: Optional[UUID] = None,
+        after: Optional[UUID] = None,
+        limit: int
+    ) -> list[Message]:
+        """
+        Retrieves a page of messages of a conversation, oldest first. That is
+        the latest messages, those right before the message `before` or those
+        right after the message `after`.
+        """
+        if before and after:
+            raise ValueError("expected at most one of before and after")
+
+        cursor = before or after
+        query = SELECT_MESSAGES
+        if before:
+            query = SELECT_MESSAGES_BEFORE_MESSAGE
+        elif after:
+            query = SELECT_MESSAGES_AFTER_MESSAGE
+
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=class_row(Message)) as cur:
+                cur.execute(
+                    query,
+                    {
+                        'conversation_id': str(conversation_id),
+                        'cursor': str(cursor) if cursor else None,
+                        'limit': limit,
+                    },
+                )
+                messages = cur.fetchall()
+
+        if not after:
+            messages.reverse()
+        return messages
+
+    def get_messages_before(
+        self,
+        *,
+        conversation_id: UUID,
+        timestamp: datetime,
         limit: int
     ) -> list[Message]:
         """
-        Retrieves messages for a given conversation ID, optionally filtering by timestamp.
+        Selects the latest messages of a conversation sent before the timestamp, newest first
         """
         with self.pool.connection() as conn:
             with conn.cursor(row_factory=class_row(Message)) as cur:
                 cur.execute(
-                    SELECT_MESSAGES,
+                    SELECT_MESSAGES_BEFORE,
                     {
                         'conversation_id': str(conversation_id),
                         'timestamp': timestamp,
@@ -200,3 +405,131 @@ class MessagesRepository:
                     raise ReplyInsertionError("Failed to insert reply")
 
                 return new_reply
+
+    def mark_reply_as_published(self, *, reply_id: UUID, timestamp: datetime) -> Reply | None:
+        """
+        Inserts the published status of a reply whose latest status is ready.
+        The rows of the reply are locked first, and the status is checked by
+        a statement of its own, so that of two concurrent calls the one that
+        waited sees the other's insert and inserts nothing.
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=class_row(Reply)) as cur:
+                cur.execute(LOCK_REPLY, (str(reply_id), ))
+                cur.execute(
+                    MARK_REPLY_AS_PUBLISHED,
+                    {
+                        'reply_id': str(reply_id),
+                        'timestamp': timestamp,
+                    }
+                )
+                return cur.fetchone()
+
+    def enqueue_reply(self, reply: Reply) -> Reply:
+        """
+        Create a new reply record along with a job for the workers
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=class_row(Reply)) as cur:
+                cur.execute(
+                    ENQUEUE_REPLY,
+                    (
+                        str(reply.id),
+                        reply.timestamp,
+                        str(reply.message_id),
+                        reply.status.value,
+                        reply.message,
+                    ),
+                )
+
+                new_reply = cur.fetchone()
+                if not new_reply:
+                    raise ReplyInsertionError("Failed to enqueue reply")
+
+                return new_reply
+
+    def claim_reply_jobs(
+        self, *,
+        worker_id: UUID,
+        limit: int,
+        lease_seconds: float
+    ) -> list[ReplyJob]:
+        """
+        Leases up to `limit` available reply jobs to the worker
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=class_row(ReplyJob)) as cur:
+                cur.execute(CLAIM_REPLY_JOBS, {
+                    'worker_id': worker_id,
+                    'limit': limit,
+                    'lease_seconds': lease_seconds,
+                })
+                return cur.fetchall()
+
+    def count_reply_jobs(self) -> int:
+        """
+        Counts the reply jobs that are not yet completed, claimed or not
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(COUNT_REPLY_JOBS)
+                row = cur.fetchone()
+                return row[0] if row else 0
+
+    def count_unclaimed_reply_jobs(self) -> int:
+        """
+        Counts the reply jobs that no worker holds a lease on
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(COUNT_UNCLAIMED_REPLY_JOBS)
+                row = cur.fetchone()
+                return row[0] if row else 0
+
+    def count_replies_by_status(self) -> Dict[ReplyStatus, int]:
+        """
+        Counts replies by their latest status
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(COUNT_REPLIES_BY_STATUS)
+                return {ReplyStatus(status): n for status, n in cur.fetchall()}
+
+    def extend_reply_job_leases(
+        self, *,
+        worker_id: UUID,
+        reply_ids: list[UUID],
+        lease_seconds: float
+    ) -> list[UUID]:
+        """
+        Extends the leases the worker holds, returns the reply ids of the
+        jobs that are still held
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(EXTEND_REPLY_JOB_LEASES, {
+                    'worker_id': worker_id,
+                    'reply_ids': reply_ids,
+                    'lease_seconds': lease_seconds,
+                })
+                return [row[0] for row in cur.fetchall()]
+
+    def complete_reply_job(
+        self, *,
+        worker_id: UUID,
+        reply: Reply
+    ) -> Reply | None:
+        """
+        Removes a job held by the worker and records its reply. Returns None
+        if the worker no longer holds the job.
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=class_row(Reply)) as cur:
+                cur.execute(COMPLETE_REPLY_JOB, {
+                    'worker_id': worker_id,
+                    'reply_id': reply.id,
+                    'timestamp': reply.timestamp,
+                    'status': reply.status.value,
+                    'message': reply.message,
+                })
+                return cur.fetchone()
@@ -0,0 +1,87 @@
+from psycopg_pool import ConnectionPool
+import psycopg
+from psycopg.rows import TupleRow
+from datetime import datetime
+
+# Postgres NOTIFY payloads must be shorter than 8000 bytes
+MAX_PAYLOAD_BYTES = 7999
+
+NOTIFY = """
+SELECT pg_notify(%s, %s);
+"""
+
+# The notification is sent when the transaction commits, so listeners can
+# read the row as soon as they receive it
+INSERT_OUTBOX_MESSAGE_AND_NOTIFY = """
+WITH message AS (
+    INSERT INTO socketio_outbox (payload)
+    VALUES (%(payload)s)
+    RETURNING id
+)
+SELECT pg_notify(
+    %(channel)s,
+    json_build_object('host_id', %(host_id)s::TEXT, 'outbox_id', message.id)::TEXT
+)
+FROM message;
+"""
+
+SELECT_OUTBOX_MESSAGE = """
+SELECT payload
+FROM socketio_outbox
+WHERE id = %s;
+"""
+
+DELETE_OUTBOX_MESSAGES = """
+DELETE FROM socketio_outbox
+WHERE created_at < %s;
+"""
+
+class NotificationPayloadTooLargeError(Exception):
+    pass
+
+class NotificationsRepository:
+    pool: ConnectionPool[psycopg.Connection[TupleRow]]
+
+    def __init__(self, pool: ConnectionPool[psycopg.Connection[TupleRow]]):
+        self.pool = pool
+
+    def notify(self, channel: str, payload: str) -> None:
+        """
+        Sends a notification to all connections listening on the channel
+        """
+        if len(payload.encode()) > MAX_PAYLOAD_BYTES:
+            raise NotificationPayloadTooLargeError(f"payload for channel '{channel}' exceeds {MAX_PAYLOAD_BYTES} bytes")
+
+        with self.pool.connection() as conn:
+            conn.execute(NOTIFY, (channel, payload))
+
+    def notify_via_outbox(self, channel: str, payload: str, host_id: str) -> None:
+        """
+        Stores a payload of any size in the outbox and notifies the channel
+        with `{"host_id": ..., "outbox_id": ...}`
+        """
+        with self.pool.connection() as conn:
+            conn.execute(
+                INSERT_OUTBOX_MESSAGE_AND_NOTIFY,
+                {
+                    'payload': payload,
+                    'channel': channel,
+                    'host_id': host_id,
+                }
+            )
+
+    def get_outbox_message(self, outbox_id: int) -> str | None:
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SELECT_OUTBOX_MESSAGE, (outbox_id, ))
+                row = cur.fetchone()
+                return row[0] if row else None
+
+    def delete_outbox_messages(self, before: datetime) -> int:
+        """
+        Deletes outbox messages stored before the timestamp, returns how many
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(DELETE_OUTBOX_MESSAGES, (before, ))
+                return cur.rowcount
@@ -4,6 +4,7 @@ from src.models import SystemPrompt
 from psycopg.rows import TupleRow,class_row
 from typing import List
 from datetime import datetime
+from src.metrics import timed_repository
 
 SELECT_SYSTEM_PROMPT = """
 SELECT
@@ -43,6 +44,7 @@ class SystemPromptNotFound(Exception):
 class SystemPromptInsertionError(Exception):
     pass
 
+@timed_repository
 class SystemPromptsRepository:
     pool: ConnectionPool[psycopg.Connection[TupleRow]]
 
@@ -3,6 +3,7 @@ import psycopg
 from psycopg.rows import TupleRow, class_row
 from src.models import User, UserSession
 from uuid import UUID
+from src.metrics import timed_repository
 
 INSERT_USER = """
     INSERT INTO users (id, name, timestamp)
@@ -34,10 +35,17 @@ INSERT_USER_SESSION = """
     RETURNING *;
 """
 
-SELECT_USER_SESSION = """
+# One insert for a batch of session events
+INSERT_USER_SESSIONS = """
+    INSERT INTO user_sessions (id, user_id, timestamp, event)
+    SELECT *
+    FROM UNNEST(%s::UUID[], %s::UUID[], %s::TIMESTAMPTZ[], %s::TEXT[]);
+"""
+
+SELECT_CONNECTED_USER_SESSIONS = """
     SELECT id, user_id, timestamp, event
-    FROM user_sessions
-    WHERE id = %s;
+    FROM latest_user_sessions
+    WHERE event = 'connected';
 """
 
 SELECT_LATEST_USER_SESSION = """
@@ -59,6 +67,7 @@ class UserSessionInsertionError(Exception):
     pass
 
 
+@timed_repository
 class UsersRepository:
     pool: ConnectionPool[psycopg.Connection[TupleRow]]
 
@@ -145,23 +154,29 @@ class UsersRepository:
 
                 return new_user_session
 
-    def get_user_session(self, sid: UUID) -> UserSession:
+    def create_user_sessions(self, user_sessions: list[UserSession]) -> None:
         """
-        Selects a user session by id
+        Inserts user session records
         """
         with self.pool.connection() as conn:
-            with conn.cursor(row_factory=class_row(UserSession)) as cur:
-                cur.execute(
-                    SELECT_USER_SESSION,
-                    (str(sid), )
+            conn.execute(
+                INSERT_USER_SESSIONS,
+                (
+                    [s.id for s in user_sessions],
+                    [s.user_id for s in user_sessions],
+                    [s.timestamp for s in user_sessions],
+                    [s.event for s in user_sessions],
                 )
+            )
 
-                user = cur.fetchone()
-
-                if not user:
-                    raise UserSessionNotFoundError(f"User session {str(sid)} not found")
-
-                return user
+    def get_connected_user_sessions(self) -> list[UserSession]:
+        """
+        Selects the sessions whose latest event is a connection
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=class_row(UserSession)) as cur:
+                cur.execute(SELECT_CONNECTED_USER_SESSIONS)
+                return cur.fetchall()
 
     def get_latest_user_session(self, user_id: UUID) -> UserSession:
         """
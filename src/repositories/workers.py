@@ -0,0 +1,86 @@
+from psycopg_pool import ConnectionPool
+import psycopg
+from psycopg.rows import TupleRow, class_row
+from psycopg.types.json import Jsonb
+from src.models import Worker
+from datetime import datetime
+
+UPSERT_WORKER = """
+INSERT INTO workers (
+    id,
+    status,
+    started_at,
+    ready_at,
+    heartbeat_at,
+    startup
+) VALUES (%s, %s, %s, %s, %s, %s)
+ON CONFLICT (id) DO UPDATE SET
+    status = EXCLUDED.status,
+    ready_at = EXCLUDED.ready_at,
+    heartbeat_at = EXCLUDED.heartbeat_at,
+    startup = EXCLUDED.startup
+RETURNING *;
+"""
+
+UPDATE_WORKER_HEARTBEAT = """
+UPDATE workers
+SET heartbeat_at = %s
+WHERE id = %s;
+"""
+
+SELECT_READY_WORKERS = """
+SELECT *
+FROM workers
+WHERE
+    status = 'ready'
+    AND heartbeat_at >= %s;
+"""
+
+class WorkerInsertionError(Exception):
+    pass
+
+class WorkersRepository:
+    pool: ConnectionPool[psycopg.Connection[TupleRow]]
+
+    def __init__(self, pool: ConnectionPool[psycopg.Connection[TupleRow]]):
+        self.pool = pool
+
+    def upsert_worker(self, worker: Worker) -> Worker:
+        """
+        Records the current state of a worker
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=class_row(Worker)) as cur:
+                cur.execute(
+                    UPSERT_WORKER,
+                    (
+                        worker.id,
+                        worker.status.value,
+                        worker.started_at,
+                        worker.ready_at,
+                        worker.heartbeat_at,
+                        Jsonb(worker.startup) if worker.startup is not None else None,
+                    )
+                )
+
+                new_worker = cur.fetchone()
+                if not new_worker:
+                    raise WorkerInsertionError("Failed to upsert worker")
+
+                return new_worker
+
+    def update_worker_heartbeat(self, worker: Worker, timestamp: datetime) -> None:
+        """
+        Marks the worker as alive
+        """
+        with self.pool.connection() as conn:
+            conn.execute(UPDATE_WORKER_HEARTBEAT, (timestamp, worker.id))
+
+    def get_ready_workers(self, since: datetime) -> list[Worker]:
+        """
+        Selects workers that are ready and have been seen since the timestamp
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=class_row(Worker)) as cur:
+                cur.execute(SELECT_READY_WORKERS, (since, ))
+                return cur.fetchall()
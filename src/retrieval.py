@@ -0,0 +1,170 @@
+import abc
+import logging
+from typing import Tuple
+import numpy as np
+from numpy import ndarray
+
+class AbstractConceptIndex(abc.ABC):
+    """
+    Top-k maximum inner product search over row-normalized float32 embeddings.
+    """
+    @abc.abstractmethod
+    def build(self, matrix: ndarray) -> None:
+        pass
+
+    @abc.abstractmethod
+    def search(self, query: ndarray, k: int) -> Tuple[ndarray, ndarray]:
+        """Returns the row indices and scores of the k best matches, best first"""
+        pass
+
+def top_k(scores: ndarray, k: int) -> ndarray:
+    """
+    Indices of the k highest scores, best first. Uses a partial selection so
+    only the k selected scores are sorted.
+    """
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    if k < scores.shape[0]:
+        candidates = np.argpartition(scores, -k)[-k:]
+    else:
+        candidates = np.arange(scores.shape[0])
+
+    return candidates[np.argsort(scores[candidates])[::-1]]
+
+class ExactConceptIndex(AbstractConceptIndex):
+    """
+    Brute force search: one matrix-vector product and a partial selection.
+    """
+    matrix: ndarray
+
+    def __init__(self):
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+
+    def build(self, matrix: ndarray) -> None:
+        self.matrix = matrix
+
+    def search(self, query: ndarray, k: int) -> Tuple[ndarray, ndarray]:
+        if self.matrix.shape[0] == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        scores = self.matrix @ query
+        indices = top_k(scores, k)
+        return indices, scores[indices]
+
+class IVFConceptIndex(AbstractConceptIndex):
+    """
+    Inverted file index. Embeddings are clustered with spherical k-means and
+    stored contiguously per cluster; a search only scores the members of the
+    `nprobe` clusters whose centroids are closest to the query.
+    """
+    nprobe: int
+    iterations: int
+    max_training_points: int
+    centroids: ndarray
+    members: ndarray
+    vectors: ndarray
+    offsets: ndarray
+
+    def __init__(self, *, nprobe: int, iterations: int = 10, max_training_points: int = 50_000):
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.max_training_points = max_training_points
+        self.centroids = np.empty((0, 0), dtype=np.float32)
+        self.members = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def build(self, matrix: ndarray) -> None:
+        n = matrix.shape[0]
+        if n == 0:
+            self.members = np.empty(0, dtype=np.int64)
+            self.vectors = np.empty((0, 0), dtype=np.float32)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            return
+
+        nlist = max(1, int(np.sqrt(n)))
+
+        # Keep the trained centroids as long as the size of the glossary is
+        # roughly the same, re-assigning is much cheaper than re-training
+        if self.centroids.shape[0] == 0 or not (nlist / 2 <= self.centroids.shape[0] <= nlist * 2):
+            self.centroids = self._train(matrix, nlist)
+
+        assignments = np.argmax(matrix @ self.centroids.T, axis=1)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=self.centroids.shape[0])
+
+        self.members = order
+        self.vectors = np.ascontiguousarray(matrix[order], dtype=np.float32)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        logging.info(f"IVFConceptIndex.build: {n} embeddings in {self.centroids.shape[0]} lists")
+
+    def _train(self, matrix: ndarray, nlist: int) -> ndarray:
+        rng = np.random.default_rng(0)
+
+        sample = matrix
+        if matrix.shape[0] > self.max_training_points:
+            sample = matrix[rng.choice(matrix.shape[0], self.max_training_points, replace=False)]
+
+        centroids = sample[rng.choice(sample.shape[0], nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            empty = norms[:, 0] == 0
+            # Re-seed empty clusters rather than dropping them
+            sums[empty] = sample[rng.choice(sample.shape[0], int(empty.sum()))]
+            norms[empty] = 1
+
+            centroids = (sums / norms).astype(np.float32)
+
+        return centroids
+
+    def search(self, query: ndarray, k: int) -> Tuple[ndarray, ndarray]:
+        if self.vectors.shape[0] == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        lists = top_k(self.centroids @ query, self.nprobe)
+        ranges = [np.arange(int(self.offsets[i]), int(self.offsets[i + 1])) for i in lists]
+        candidates = np.concatenate(ranges)
+
+        scores = self.vectors[candidates] @ query
+        best = top_k(scores, k)
+        return self.members[candidates[best]], scores[best]
+
+class ConceptRetriever:
+    """
+    Chooses between exact search and an approximate index depending on the
+    number of embeddings, and rebuilds the index when the embeddings change.
+    """
+    ann_threshold: int
+    exact: ExactConceptIndex
+    ann: IVFConceptIndex
+    index: AbstractConceptIndex
+    matrix: ndarray | None
+
+    def __init__(self, *, ann_threshold: int, nprobe: int):
+        self.ann_threshold = ann_threshold
+        self.exact = ExactConceptIndex()
+        self.ann = IVFConceptIndex(nprobe=nprobe)
+        self.index = self.exact
+        self.matrix = None
+
+    def build(self, matrix: ndarray) -> None:
+        if matrix is self.matrix:
+            return
+
+        if matrix.shape[0] >= self.ann_threshold:
+            self.index = self.ann
+        else:
+            self.index = self.exact
+
+        self.index.build(matrix)
+        self.matrix = matrix
+
+    def search(self, query: ndarray, k: int) -> Tuple[ndarray, ndarray]:
+        return self.index.search(np.asarray(query, dtype=np.float32), k)
@@ -0,0 +1,68 @@
+import logging
+from src.models import GenerationLimits, GenerationStats
+
+class GenerationBudgetPolicy:
+    """
+    Chooses how many tokens a reply may generate depending on load. The time
+    until the last queued reply is done is estimated from this worker's share
+    of the queue and the observed per-sequence generation throughput, an
+    exponential moving average of tokens/s. When that exceeds `target_wait`
+    seconds, max_new_tokens is lowered so every queued reply fits, down to
+    `min_new_tokens`. A `target_wait` of zero or less disables the budget.
+    """
+    max_new_tokens: int
+    min_new_tokens: int
+    target_wait: float
+    stop_at_sentence: bool
+    alpha: float
+    tokens_per_second: float | None
+
+    def __init__(
+        self, *,
+        max_new_tokens: int,
+        min_new_tokens: int,
+        target_wait: float,
+        stop_at_sentence: bool = False,
+        alpha: float = 0.2
+    ):
+        self.max_new_tokens = max_new_tokens
+        self.min_new_tokens = min(min_new_tokens, max_new_tokens)
+        self.target_wait = target_wait
+        self.stop_at_sentence = stop_at_sentence
+        self.alpha = alpha
+        self.tokens_per_second = None
+
+    def observe(self, stats: GenerationStats | None) -> None:
+        """
+        Updates the throughput estimate with a finished generation
+        """
+        if stats is None or stats.new_tokens == 0 or stats.tokens_per_second <= 0:
+            return
+
+        if self.tokens_per_second is None:
+            self.tokens_per_second = stats.tokens_per_second
+        else:
+            self.tokens_per_second += self.alpha * (stats.tokens_per_second - self.tokens_per_second)
+
+    def choose(self, queue_depth: int) -> GenerationLimits:
+        """
+        The limits for the next reply, given the number of replies this
+        worker is expected to generate until the queue is drained, including
+        the next one
+        """
+        if self.target_wait <= 0 or self.tokens_per_second is None or queue_depth <= 0:
+            return GenerationLimits(max_new_tokens=self.max_new_tokens, stop_at_sentence_after=None)
+
+        estimated_wait = queue_depth * self.max_new_tokens / self.tokens_per_second
+        if estimated_wait <= self.target_wait:
+            return GenerationLimits(max_new_tokens=self.max_new_tokens, stop_at_sentence_after=None)
+
+        max_new_tokens = int(self.target_wait * self.tokens_per_second / queue_depth)
+        max_new_tokens = max(self.min_new_tokens, min(self.max_new_tokens, max_new_tokens))
+        logging.info(f"GenerationBudgetPolicy.choose: {queue_depth} queued at {self.tokens_per_second:.1f} tokens/s, estimated wait {estimated_wait:.1f}s, max_new_tokens {max_new_tokens}")
+
+        return GenerationLimits(
+            max_new_tokens=max_new_tokens,
+            # Ending on a full sentence reads better than being cut off
+            stop_at_sentence_after=self.min_new_tokens if self.stop_at_sentence else None
+        )
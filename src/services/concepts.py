@@ -5,21 +5,26 @@ from uuid import UUID
 from typing import Dict, List, Tuple
 from datetime import datetime
 from src.repositories.system_prompts import SystemPromptsRepository
+from src.repositories.notifications import NotificationsRepository
+from src.notifications import CONCEPTS_CHANNEL, SYSTEM_PROMPTS_CHANNEL
 
 
 class ConceptsService():
     config: Config
     concepts_repository: ConceptsRepository
     system_prompts_repository: SystemPromptsRepository
+    notifications_repository: NotificationsRepository
 
     def __init__(self, *,
         config: Config,
         concepts_repository: ConceptsRepository,
-        system_prompts_repository: SystemPromptsRepository
+        system_prompts_repository: SystemPromptsRepository,
+        notifications_repository: NotificationsRepository
     ):
         self.config = config
         self.concepts_repository = concepts_repository
         self.system_prompts_repository = system_prompts_repository
+        self.notifications_repository = notifications_repository
 
     def sync_concepts(
         self, *,
@@ -29,15 +34,19 @@ class ConceptsService():
         """
         Sync concepts to those present in the list. This will:
             1. Create concepts that do not yet exists
-            2. Insert a new record of concepts that do exist
+            2. Insert a new record of concepts that do exist and have changed
             3. Insert a new record with an "inactivated" flag for
             any existing concept not present in the provided list.
+
+        Unchanged concepts keep their current record, so downstream caches
+        keyed by concept id and timestamp (such as concept embeddings) are
+        only invalidated for concepts that actually changed.
         """
-        existing = self.concepts_repository.get_concepts()
+        existing = {c.id: c for c in self.concepts_repository.get_concepts()}
 
         to_upsert: Dict[UUID, Concept] = {}
 
-        for c in existing:
+        for c in existing.values():
             # Default to inactivate all existing concepts
             to_upsert[c.id] = Concept(
                 id=c.id,
@@ -47,7 +56,15 @@ class ConceptsService():
                 deleted=True
             )
 
+        unchanged: Dict[UUID, Concept] = {}
         for id, concept, meaning in concepts:
+            current = existing.get(id)
+            if current and current.concept == concept and current.meaning == meaning:
+                # Keep the current record as is
+                unchanged[id] = current
+                del to_upsert[id]
+                continue
+
             # Then overwrite with the new ones
             to_upsert[id] = Concept(
                 id=id,
@@ -57,7 +74,21 @@ class ConceptsService():
                 deleted=False
             )
 
-        return self.concepts_repository.upsert_concepts(list(to_upsert.values()))
+        upserted = {
+            c.id: c for c in self.concepts_repository.upsert_concepts(list(to_upsert.values()))
+        }
+
+        if to_upsert:
+            # Tell workers to refresh their concept embeddings
+            self.notifications_repository.notify(CONCEPTS_CHANNEL, timestamp.isoformat())
+
+        synced: List[Concept] = []
+        for id, _, _ in concepts:
+            c = upserted.get(id) or unchanged.get(id)
+            if c:
+                synced.append(c)
+
+        return synced
 
     def update_system_prompts(
         self, *,
@@ -71,4 +102,9 @@ class ConceptsService():
                 prompt=prompt,
                 timestamp=timestamp
             ))
-        return self.system_prompts_repository.upsert_system_prompts(system_prompts=system_prompts)
+        upserted = self.system_prompts_repository.upsert_system_prompts(system_prompts=system_prompts)
+
+        # Tell workers to drop their cached system prompts
+        self.notifications_repository.notify(SYSTEM_PROMPTS_CHANNEL, timestamp.isoformat())
+
+        return upserted
@@ -1,6 +1,8 @@
 from src.repositories.messages import MessagesRepository
+from src.repositories.notifications import NotificationsRepository
 from src.config.config import Config
-from src.models import Message, Reply, ReplyStatus
+from src.models import Message, Reply, ReplyDelta, ReplyJob, ReplyStatus
+from src.notifications import REPLY_DELTAS_CHANNEL
 from uuid import UUID, uuid4
 from datetime import datetime
 import logging
@@ -11,14 +13,17 @@ class ReplyWithoutBodyError(Exception):
 class MessagesService():
     config: Config
     messages_repository: MessagesRepository
+    notifications_repository: NotificationsRepository
 
     def __init__(
         self, *,
         config: Config,
-        messages_repository: MessagesRepository
+        messages_repository: MessagesRepository,
+        notifications_repository: NotificationsRepository
     ):
         self.config = config
         self.messages_repository = messages_repository
+        self.notifications_repository = notifications_repository
 
     def create_user_message(
         self, *,
@@ -66,17 +71,17 @@ class MessagesService():
         replies_in_progress = self.messages_repository.get_replies(
             status=[ReplyStatus.PENDING],
             message_id=None,
-            limit=1
+            limit=self.config.MAX_PENDING_REPLIES
         );
 
-        # if there are work in progress we just return
-        if replies_in_progress:
+        # if the queue is full we just return
+        if len(replies_in_progress) >= self.config.MAX_PENDING_REPLIES:
             logging.info("MessagesService.enqueue_if_available: no availability")
             return
 
         # If not we request a reply
         logging.info(f"MessagesService.enqueue_if_available: enqueued reply for {message_id}")
-        reply = self.messages_repository.create_reply(Reply(
+        reply = self.messages_repository.enqueue_reply(Reply(
             id=uuid4(),
             timestamp=timestamp,
             message_id=message_id,
@@ -86,20 +91,97 @@ class MessagesService():
 
         return reply
 
-    def get_next_enqueued_reply(
+    def claim_reply_jobs(
+        self, *,
+        worker_id: UUID,
+        limit: int
+    ) -> list[ReplyJob]:
+        """
+        Leases up to `limit` reply jobs to the worker, oldest first. Jobs
+        whose lease has expired are handed out again.
+        """
+        jobs = self.messages_repository.claim_reply_jobs(
+            worker_id=worker_id,
+            limit=limit,
+            lease_seconds=self.config.REPLY_JOB_LEASE
+        )
+
+        for job in jobs:
+            if job.attempts > 1:
+                logging.warning(f"MessagesService.claim_reply_jobs: re-claimed expired job for reply {job.reply_id}, attempt {job.attempts}")
+
+        return sorted(jobs, key=lambda j: j.enqueued_at)
+
+    def extend_reply_job_leases(
+        self, *,
+        worker_id: UUID,
+        jobs: list[ReplyJob]
+    ) -> list[UUID]:
+        return self.messages_repository.extend_reply_job_leases(
+            worker_id=worker_id,
+            reply_ids=[j.reply_id for j in jobs],
+            lease_seconds=self.config.REPLY_JOB_LEASE
+        )
+
+    def complete_reply_job(
+        self, *,
+        worker_id: UUID,
+        job: ReplyJob,
+        timestamp: datetime,
+        content: str
+    ) -> Reply | None:
+        """
+        Records the reply content and releases the job. Returns None if the
+        lease was lost, in which case another worker owns the reply.
+        """
+        logging.info(f"MessagesService.complete_reply_job: Appending content for reply {job.reply_id}")
+        reply = self.messages_repository.complete_reply_job(
+            worker_id=worker_id,
+            reply=Reply(
+                id=job.reply_id,
+                timestamp=timestamp,
+                message_id=job.message_id,
+                status=ReplyStatus.READY,
+                message=content,
+            )
+        )
+
+        if not reply:
+            logging.warning(f"MessagesService.complete_reply_job: lease for reply {job.reply_id} was lost")
+
+        return reply
+
+    def fail_reply_job(
         self, *,
+        worker_id: UUID,
+        job: ReplyJob,
         timestamp: datetime
     ) -> Reply | None:
+        """
+        Gives up on a job, marking its reply as failed
+        """
+        logging.error(f"MessagesService.fail_reply_job: giving up on reply {job.reply_id} after {job.attempts} attempts")
+        return self.messages_repository.complete_reply_job(
+            worker_id=worker_id,
+            reply=Reply(
+                id=job.reply_id,
+                timestamp=timestamp,
+                message_id=job.message_id,
+                status=ReplyStatus.FAILED,
+                message=None,
+            )
+        )
+
+    def has_replies_in_progress(self) -> bool:
+        """
+        Whether any reply is still being generated or waiting to be published
+        """
         replies = self.messages_repository.get_replies(
-            status=[ReplyStatus.PENDING],
+            status=[ReplyStatus.PENDING, ReplyStatus.READY],
             message_id=None,
             limit=1
         );
-
-        if not replies:
-            return
-
-        return replies[0]
+        return len(replies) > 0
 
     def get_next_reply_to_publish(self) -> Reply | None:
         replies = self.messages_repository.get_replies(
@@ -133,16 +215,34 @@ class MessagesService():
         ));
         return reply
 
+    def publish_reply_delta(
+        self, *,
+        reply_id: UUID,
+        seq: int,
+        delta: str
+    ) -> None:
+        """
+        Publishes a chunk of a reply that is still being generated. Deltas are
+        not persisted, the complete reply is written once generation is done.
+        """
+        self.notifications_repository.notify(
+            REPLY_DELTAS_CHANNEL,
+            ReplyDelta(
+                reply_id=reply_id,
+                seq=seq,
+                delta=delta
+            ).model_dump_json()
+        )
+
     def mark_reply_as_published(
         self, *,
         reply: Reply,
         timestamp: datetime
-    ) -> Reply:
-        reply = self.messages_repository.create_reply(Reply(
-             id=reply.id,
-             timestamp=timestamp,
-             message_id=reply.message_id,
-             status=ReplyStatus.PUBLISHED,
-             message=reply.message,
-        ));
-        return reply
+    ) -> Reply | None:
+        """
+        Marks a ready reply as published, returns None if it no longer was ready
+        """
+        return self.messages_repository.mark_reply_as_published(
+            reply_id=reply.id,
+            timestamp=timestamp
+        )
@@ -4,7 +4,6 @@ from src.config.config import Config
 from mong import get_random_name
 from datetime import datetime
 from uuid import UUID, uuid4
-import logging
 
 def generate_name():
     return get_random_name().replace('_', ' ').title()
@@ -57,22 +56,3 @@ class UsersService():
             ))
 
         return session
-
-    def register_user_disconnection(
-        self,
-        *,
-        sid: UUID,
-        timestamp: datetime
-    ) -> UserSession | None:
-        try:
-            user_session = self.users_repository.get_user_session(sid)
-        except UserSessionNotFoundError:
-            logging.error("The user session could not be found")
-            return
-
-        self.users_repository.create_user_session(UserSession(
-            id=user_session.id,
-            user_id=user_session.user_id,
-            timestamp=timestamp,
-            event="disconnected"
-        ))
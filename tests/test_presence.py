@@ -0,0 +1,236 @@
+import unittest
+from datetime import datetime, timezone
+from typing import List, cast
+from unittest import mock
+from uuid import UUID, uuid4
+from src.models import PresenceDiff, User, UserSession
+from src.presence import CONNECTED, DISCONNECTED, PresenceBroadcaster, PresenceRegistry
+from src.repositories.users import UsersRepository
+
+def new_user(name: str) -> User:
+    return User(id=uuid4(), timestamp=datetime.now(timezone.utc), name=name)
+
+class FakeUsersRepository:
+    connected: List[UserSession]
+    users: List[User]
+    written: List[UserSession]
+
+    def __init__(self, connected: List[UserSession] | None = None, users: List[User] | None = None):
+        self.connected = connected or []
+        self.users = users or []
+        self.written = []
+
+    def get_connected_user_sessions(self) -> List[UserSession]:
+        return self.connected
+
+    def get_users_by_id(self, ids: List[UUID]) -> List[User]:
+        return [u for u in self.users if u.id in ids]
+
+    def create_user_sessions(self, user_sessions: List[UserSession]) -> None:
+        self.written.extend(user_sessions)
+
+def announce(registry: PresenceRegistry, other: PresenceRegistry) -> None:
+    announcement = registry.announcement()
+    if announcement:
+        other.apply_process_presence(announcement)
+
+class PresenceRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('src.presence.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def new_registry(self, repository: FakeUsersRepository | None = None) -> PresenceRegistry:
+        return PresenceRegistry(
+            users_repository=cast(UsersRepository, repository or FakeUsersRepository()),
+            grace_period=30
+        )
+
+    def test_reports_a_user_once_for_several_connections(self):
+        registry = self.new_registry()
+        user = new_user("a")
+
+        registry.connect(user)
+        registry.connect(user)
+        self.assertEqual(registry.changes(), ([user], []))
+
+        registry.disconnect(user.id)
+        self.assertEqual(registry.changes(), ([], []))
+
+        registry.disconnect(user.id)
+        self.assertEqual(registry.changes(), ([], [user.id]))
+
+    def test_reconnecting_within_a_tick_reports_nothing(self):
+        registry = self.new_registry()
+        user = new_user("a")
+        registry.connect(user)
+        registry.changes()
+
+        registry.disconnect(user.id)
+        registry.connect(user)
+        self.assertEqual(registry.changes(), ([], []))
+
+    def test_user_stays_while_connected_to_another_process(self):
+        one, two = self.new_registry(), self.new_registry()
+        user = new_user("a")
+
+        one.connect(user)
+        announce(one, two)
+        two.connect(user)
+        announce(two, one)
+        self.assertEqual(one.changes(), ([user], []))
+        self.assertEqual(two.changes(), ([user], []))
+
+        one.disconnect(user.id)
+        announce(one, two)
+        self.assertEqual(one.changes(), ([], []))
+        self.assertEqual(two.changes(), ([], []))
+
+        two.disconnect(user.id)
+        announce(two, one)
+        self.assertEqual(one.changes(), ([], [user.id]))
+        self.assertEqual(two.changes(), ([], [user.id]))
+
+    def test_user_leaves_when_both_processes_disconnect_at_once(self):
+        one, two = self.new_registry(), self.new_registry()
+        user = new_user("a")
+        one.connect(user)
+        two.connect(user)
+        announce(one, two)
+        announce(two, one)
+        one.changes()
+        two.changes()
+
+        one.disconnect(user.id)
+        two.disconnect(user.id)
+        self.assertEqual(one.changes(), ([], []))
+        self.assertEqual(two.changes(), ([], []))
+
+        announce(one, two)
+        announce(two, one)
+        self.assertEqual(one.changes(), ([], [user.id]))
+        self.assertEqual(two.changes(), ([], [user.id]))
+
+    def test_announces_changes_and_periodically(self):
+        registry = self.new_registry()
+        user = new_user("a")
+
+        self.assertIsNotNone(registry.announcement())
+        self.assertIsNone(registry.announcement())
+
+        registry.connect(user)
+        announcement = registry.announcement()
+        assert announcement is not None
+        self.assertEqual([u.id for u in announcement.users], [user.id])
+        self.assertEqual(announcement.sessions, [registry.sessions[user.id]])
+        self.assertIsNone(registry.announcement())
+
+        self.now += registry.announce_interval
+        self.assertIsNotNone(registry.announcement())
+
+    def test_forgets_processes_that_stop_announcing(self):
+        one, two = self.new_registry(), self.new_registry()
+        user = new_user("a")
+        two.connect(user)
+        announce(two, one)
+        self.assertEqual(one.changes(), ([user], []))
+
+        self.now += 31
+        one.expire()
+        self.assertEqual(one.changes(), ([], [user.id]))
+
+    def test_closes_recovered_sessions_after_the_grace_period(self):
+        user = new_user("a")
+        session = UserSession(id=uuid4(), user_id=user.id, timestamp=datetime.now(timezone.utc), event=CONNECTED)
+        repository = FakeUsersRepository(connected=[session], users=[user])
+        registry = self.new_registry(repository)
+
+        registry.recover()
+        self.assertEqual(registry.changes(), ([user], []))
+
+        self.now += 31
+        registry.expire()
+        self.assertEqual(registry.changes(), ([], [user.id]))
+
+        registry.flush()
+        self.assertEqual([(s.id, s.event) for s in repository.written], [(session.id, DISCONNECTED)])
+
+    def test_leaves_recovered_sessions_of_running_processes_alone(self):
+        user = new_user("a")
+        running = self.new_registry()
+        running.connect(user)
+
+        session = UserSession(id=running.sessions[user.id], user_id=user.id, timestamp=datetime.now(timezone.utc), event=CONNECTED)
+        repository = FakeUsersRepository(connected=[session], users=[user])
+        restarted = self.new_registry(repository)
+        restarted.recover()
+
+        announce(running, restarted)
+        self.now += 31
+        announce(running, restarted)
+        restarted.expire()
+        restarted.flush()
+
+        self.assertEqual(repository.written, [])
+        self.assertEqual(restarted.changes(), ([user], []))
+
+    def test_reconnecting_after_a_restart_keeps_the_user(self):
+        user = new_user("a")
+        session = UserSession(id=uuid4(), user_id=user.id, timestamp=datetime.now(timezone.utc), event=CONNECTED)
+        repository = FakeUsersRepository(connected=[session], users=[user])
+        registry = self.new_registry(repository)
+        registry.recover()
+        registry.changes()
+
+        registry.connect(user)
+        self.now += 31
+        registry.expire()
+        self.assertEqual(registry.changes(), ([], []))
+
+        registry.flush()
+        self.assertEqual(
+            sorted((s.id == session.id, s.event) for s in repository.written),
+            [(False, CONNECTED), (True, DISCONNECTED)]
+        )
+
+    def test_writes_only_sessions_that_changed(self):
+        repository = FakeUsersRepository()
+        registry = self.new_registry(repository)
+        user = new_user("a")
+
+        registry.connect(user)
+        registry.disconnect(user.id)
+        registry.flush()
+        self.assertEqual(repository.written, [])
+
+        registry.connect(user)
+        registry.flush()
+        self.assertEqual([s.event for s in repository.written], [CONNECTED])
+
+class PresenceBroadcasterTest(unittest.TestCase):
+    def test_keeps_the_changes_of_a_failed_emit(self):
+        emitted: List[PresenceDiff] = []
+        failing = [True]
+
+        def emit(room: str, diff: PresenceDiff):
+            if failing[0]:
+                raise RuntimeError("disconnected")
+            emitted.append(diff)
+
+        broadcaster = PresenceBroadcaster(emit)
+        a, b = new_user("a"), new_user("b")
+
+        broadcaster.joined("room", a)
+        broadcaster.flush()
+        broadcaster.left("room", a.id)
+        broadcaster.joined("room", b)
+
+        failing[0] = False
+        broadcaster.flush()
+        self.assertEqual(len(emitted), 1)
+        self.assertEqual([u.id for u in emitted[0].joined], [b.id])
+        self.assertEqual(emitted[0].left, [])
+
+if __name__ == '__main__':
+    unittest.main()